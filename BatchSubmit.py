@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+from __future__ import print_function, division, absolute_import
+
+import json
+import telnetlib
+
+"""
+Synopsis
+--------
+Sends many commands to the server over one connection without waiting between them.  Each command goes as one line of JSON,
+{"id": n, "command": command}, and the server answers every one with a line holding the same "id" and the "job" ID the fit was
+queued as (or the "group" it started, the "result" of a show or an "error"), see MatchExecuter.batchReceived in ServerMATCH.py.
+
+Up to "window" commands are sent ahead of their answers.  That keeps the connection full without piling thousands of unread answers up
+in the server when we read slower than it answers.  Lines that aren't answers (the welcome and what the server sends to every client)
+are skipped.
+
+Usage
+-----
+>>> import BatchSubmit
+>>> for command, answer in zip(commands, BatchSubmit.submit(commands, HOST_IP_ADDRESS, PORT_NUMBER)):
+...     print(answer.get("job"), command)
+"""
+
+
+class SubmitError(Exception):
+    pass
+
+
+def submit(commands, host, port, window=500, timeout=60.0, answered=None):
+    """
+    Sends "commands" and returns their answers (dicts) in the same order.  "answered(command, answer)" is called as each answer comes
+    in.  Raises SubmitError if the server stops answering for "timeout" seconds or closes the connection.
+    """
+    tn = telnetlib.Telnet(host, port)
+    answers = [None] * len(commands)
+    sent = 0
+    received = 0
+    try:
+        while received < len(commands):
+            lines = []
+            while sent < len(commands) and sent - received < window:
+                lines.append(json.dumps({"id": sent, "command": commands[sent]}) + "\r\n")
+                sent += 1
+            if len(lines) > 0:
+                tn.write("".join(lines))
+
+            try:
+                line = tn.read_until("\n", timeout)
+            except EOFError:
+                raise SubmitError("server closed the connection after %d of %d answers" % (received, len(commands)))
+            if not line.endswith("\n"):
+                raise SubmitError("no answer from the server for %.0f seconds after %d of %d answers" % (timeout, received,
+                                                                                                        len(commands)))
+            line = line.strip()
+            if not line.startswith("{"):
+                continue
+            answer = json.loads(line)
+            if not isinstance(answer, dict) or answer.get("id") is None or answers[answer["id"]] is not None:
+                continue
+            answers[answer["id"]] = answer
+            received += 1
+            if answered is not None:
+                answered(commands[answer["id"]], answer)
+    finally:
+        tn.close()
+    return answers
@@ -4,12 +4,11 @@ from __future__ import division
 from __future__ import absolute_import
 
 import os
-import signal
-import subprocess
-import threading
-import time
 
 from UserParameters import *
+from ProcessStage import STDOUT
+from ProcessStage import Stage
+from ProcessStage import skipLines
 
 __author__ = "Tristan J. Hillis"
 
@@ -20,10 +19,13 @@ This is where all the pieces to run a fit are built.  That does not mean this is
 attributes of how post-processing is done.  If you want to change what gets passed into a script to be run in the shell you do it here.  Or maybe
 if you want to bake in a long running MATCH command that I haven't yet (eg calcsfh) this is the place to do it.
 
+Every command is a ProcessStage.Stage: an argv list, a working directory and the files its output goes to.  Nothing is run through a
+shell; outputs are redirected with file descriptors.  A stage can still be written out as a shell command (str(stage)) for Condor.
+
 Classes - This will be a basic run down of how these classes interact.
 -------
-MatchThread : This is where any of the classes are run.  Classes are threaded to run the fits in bash while not blocking.  However,
-              there are attributes needed in the thread
+MatchJob : This is where any of the classes are run (see ProcessEngine.py).  A job runs the commands of these classes one after another
+           without blocking the server.
 """
 
 
@@ -41,53 +43,40 @@ def findStringInList(s_list, s):
 ####################
 
 
-class MatchThread(threading.Thread):
-    """
-    This acts like a regular Thread object and is called the same only there are custom class variables.
-    """
-    def __init__(self, line, target=None, args=(), name=None):
-        """
-        Initializes Thread the same way just with an additive class variable.
-        Takes in a single string line that will be parsed by the target method
-        """
-        threading.Thread.__init__(self, target=target, args=args, name=name)
-        self.cancel = False # This gets set to True if the bash command is to be canceled
-        self.command = line # Saves the command sent to this thread
-        self.name = name
-
-
 class ProcessRunner(object):
     """
     This holds the generic running method used by all these objects.
     """
-    def __init__(self, command):
+    def __init__(self, stage=None):
         """
-        There will always be a command that is initially passed in when an object is created.
+        The Stage (or argv list) to run first can be passed in when an object is created.
         """
-        self.curr_command = command
+        if stage is not None and not isinstance(stage, Stage):
+            stage = Stage(stage)
+        self.stage = stage
 
-    def run(self):
+    @property
+    def curr_command(self):
         """
-        This is called to run the current command.  For example, when the object is first made, this is called to run the calcsfh command.
-        However, after the variable "self.curr_command" can be changed to something else, and calling this will execute that command.
+        The current stage written as a shell command.  Setting a string still works for classes written before stages, such a
+        command is run by /bin/sh.
         """
+        return None if self.stage is None else str(self.stage)
 
-        # This thread, t, should always be a MatchThread that has the attribute of a cancel variable.  If this cancel
-        # is ever changed from False to True then this method will exit.
-        t = threading.current_thread()
-        
-        pipe = subprocess.Popen(self.curr_command, shell=True, preexec_fn=os.setsid)
-
-        # poll the status of the process
-        while pipe.poll() is None:
-            #print("running sleep")
-            # if the thread is to be canceled then this will kill the process.
-            if t.cancel:
-                print("CANCELED", t.name)
-                os.killpg(os.getpgid(pipe.pid), signal.SIGTERM) # kills group of processes when present
-                self._cleanup()
-                break
-            time.sleep(0.5)
+    @curr_command.setter
+    def curr_command(self, command):
+        self.stage = Stage(["/bin/sh", "-c", command], shell=command)
+
+    def run(self, cpus=None):
+        """
+        This is called to run the current stage.  For example, when the object is first made, this is called to run the calcsfh command.
+        However, after the variable "self.stage" can be changed to something else, and calling this will execute that command.
+
+        Returns a ProcessEngine.ProcessHandle whose deferred fires when the command exits.  This is usually called through
+        MatchJob.run, which also takes care of canceling.  "cpus" is an optional list of CPUs to pin the command to.
+        """
+        import ProcessEngine # needs Twisted, which only the server has
+        return ProcessEngine.spawn(self.stage, cpus=cpus)
 
     def _cleanup(self):
         """
@@ -110,10 +99,8 @@ class DefaultCalcsfh(ProcessRunner):
         calcsfh command is passed in here.  This will parse the command of its attributes and then go to run the main
         calcsfh command.
         """
-        # save command initially
-        super(DefaultCalcsfh, self).__init__(command)
+        super(DefaultCalcsfh, self).__init__()
         self.original = command # this is the original beginning command
-        #self.curr_command = command # variable is populated for running in the run() method
 
         self.zcombine_name = None # initialize
         self.co_file = None # initialize
@@ -129,9 +116,6 @@ class DefaultCalcsfh(ProcessRunner):
         self.cwd = "/".join(command[1].split("/")[:-1]) + "/" # split the first command that has the parameter file and get the cwd
         print(self.cwd)
 
-        # Add 'cd' to the curr_command
-        self.curr_command = "cd %s; "%self.cwd + self.curr_command
-        
         # parameter file name
         self.parameter = command[1].split("/")[-1]
         print(self.parameter)
@@ -164,19 +148,24 @@ class DefaultCalcsfh(ProcessRunner):
 
         self._getDAv()
         self._checkGroup()
+        self._checkPriority()
         self._checkForFlags()
 
+        # the calcsfh command itself; custom flags never reach calcsfh
+        self.stage = Stage(command[:5] + [flag for flag in self.flags if flag != "-skip"], cwd=self.cwd,
+                           stdout=(self.cwd + self.co_file if self.co_file is not None else None), stderr=STDOUT)
+        self.fitStage = self.stage # kept for speculativeStage once self.stage moves on
+
     def condorCommands(self):
         """
-        Return a list of all the commands that will be run to put into a condor config file.
+        Return a list of all the commands that will be run to put into a condor config file.  Groups are told about the fit by
+        the server when Condor logs that the job ended (see CondorBackend.py).
         """
         forCondor = [self.curr_command]
         self.zcombine()
         forCondor.append(self.curr_command)
         self.processFit()
         forCondor.append(self.curr_command)
-        if self._group is not None:
-            forCondor.append("group %s %s" % (self._group, self.original))
         return forCondor
 
     def processFit(self):
@@ -185,11 +174,20 @@ class DefaultCalcsfh(ProcessRunner):
         files = [self.cwd+self.parameter, self.cwd+self.phot, self.cwd+self.fake, self.cwd+self.fit,
                  self.cwd+self.co_file, self.cwd+self.zcombine_name, self.cwd+self.cmd_file]
         if not self.isHybrid: # no -mcdata flag
-            self.curr_command = "%s/scripts/calcsfh_script.sh %s %s %s %s %s %s %s" % \
-                                (MATCH_SERVER_DIR, files[0], files[1], files[2], files[3], files[4], files[5], files[6])
+            self.stage = Stage(["%s/scripts/calcsfh_script.sh" % MATCH_SERVER_DIR] + files)
         else: # with -mcdata flag
-            self.curr_command = "%s/scripts/hybridMC_script.sh %s %s %s %s %s %s %s %s" % \
-                                (MATCH_SERVER_DIR, files[0], files[1], files[2], files[3], files[4], files[5], files[6], self.cwd+self.mcdata)
+            self.stage = Stage(["%s/scripts/hybridMC_script.sh" % MATCH_SERVER_DIR] + files + [self.cwd+self.mcdata])
+
+    def postTask(self):
+        """
+        Returns (task, arguments) of the post-processing a worker of scripts/post_worker.py runs in place of the script processFit
+        runs, or None if the script is run by the server (calcsfh_script.sh starts no Python for a worker to save).
+        """
+        if not self.isHybrid:
+            return None
+        files = [self.cwd+self.parameter, self.cwd+self.phot, self.cwd+self.fake, self.cwd+self.fit,
+                 self.cwd+self.co_file, self.cwd+self.zcombine_name, self.cwd+self.cmd_file]
+        return ("hybridMC", files + [self.cwd+self.mcdata])
 
     def zcombine(self):
         """
@@ -197,11 +195,95 @@ class DefaultCalcsfh(ProcessRunner):
         to employ something more complex than the default zcombine command
         """
         # set the current command
-        self.curr_command = "%szcombine -bestonly %s &> %s.zc" % (MATCH_EXECUTABLE_BIN, self.cwd + self.fit, self.cwd + self.fit)
+        self.stage = Stage(["%szcombine" % MATCH_EXECUTABLE_BIN, "-bestonly", self.cwd + self.fit], stdout=self.cwd + self.fit + ".zc",
+                           stderr=STDOUT)
         # set a file name for the new zcombine name
         self.zcombine_name = self.fit + ".zc"
         print(self.zcombine_name)
 
+    def outputFiles(self):
+        """
+        Returns the names (relative to cwd) of the files this fit leaves behind once zcombine is done.  These are what the result cache
+        stores and restores (see ResultCache.py).
+        """
+        files = [self.fit, self.cmd_file, self.co_file, self.fit + ".zc"]
+        if self.isHybrid:
+            files.append(self.mcdata)
+        return [name for name in files if name is not None]
+
+    def bestFit(self):
+        """
+        Returns the value on the "Best fit" line of the calcsfh output (the number scripts/ProcessDAv.py compares between fits) or None
+        if the output has no such line.
+        """
+        best = self.bestFitAv()
+        if best is None:
+            return None
+        return best[0]
+
+    def bestFitAv(self):
+        """
+        Returns (best fit value, Av) from the "Best fit" line of the calcsfh output or None if the output has no such line.  Av is None
+        if the line doesn't give it.
+        """
+        if self.co_file is None or not os.path.isfile(self.cwd + self.co_file):
+            return None
+        f = open(self.cwd + self.co_file, 'r')
+        for line in f:
+            if "Best" in line: # reached line where there is the best fit number
+                f.close()
+                av = None
+                for word in line.split():
+                    if word.startswith("Av="):
+                        try:
+                            av = float(word.split("=")[-1].rstrip(","))
+                        except ValueError:
+                            pass
+                try:
+                    return (float(line.split()[-1].split("=")[-1]), av)
+                except ValueError:
+                    return None
+        f.close()
+        return None
+
+    def speculativeStage(self):
+        """
+        The calcsfh stage writing to the names of speculativeFiles instead, so a duplicate of a slow fit can run next to it without
+        touching its files (see SpeculativeRun).
+        """
+        argv = list(self.fitStage.argv)
+        argv[4] = self.cwd + self._speculativeName(self.fit)
+        stdout = self.cwd + self._speculativeName(self.co_file) if self.co_file is not None else None
+        return Stage(argv, cwd=self.cwd, stdout=stdout, stderr=STDOUT)
+
+    def speculativeFiles(self):
+        """
+        Returns a list of (file written by the duplicate, file of the fit) for the outputs of the calcsfh stage.
+        """
+        names = [self.fit, self.cmd_file, self.co_file]
+        if self.isHybrid:
+            names.append(self.mcdata)
+        return [(self.cwd + self._speculativeName(name), self.cwd + name) for name in names if name is not None]
+
+    def adoptSpeculative(self):
+        """
+        Moves the outputs of a duplicate that finished first over the fit's own.  The fit's process must be dead.
+        """
+        for speculative, name in self.speculativeFiles():
+            if os.path.isfile(speculative):
+                os.rename(speculative, name)
+
+    def discardSpeculative(self):
+        for speculative, name in self.speculativeFiles():
+            if os.path.isfile(speculative):
+                os.remove(speculative)
+
+    def _speculativeName(self, name):
+        # fitA -> fitA_spec, fitA.co -> fitA_spec.co
+        if name.startswith(self.fit):
+            return self.fit + "_spec" + name[len(self.fit):]
+        return name + "_spec"
+
     def _checkForFlags(self):
         """
         This will check for the custom flag -skip.  "-skip" is used to skip the main fit, ie the first command, and go straight to the 
@@ -209,10 +291,10 @@ class DefaultCalcsfh(ProcessRunner):
 
         This will also check if the -mcdata flag is being used and will change the post-processing accordingly.  Se the processFit method.
         """
-        if "-skip" in self.curr_command:
+        if "-skip" in self.flags:
             self.skip = True
 
-        if "-mcdata" in self.curr_command:
+        if "-mcdata" in self.flags:
             self.isHybrid = True
 
     def _cleanup(self):
@@ -248,15 +330,25 @@ class DefaultCalcsfh(ProcessRunner):
                 idx = i
                 self._group = flag.split("=")[-1]
 
-        # remove group name from command so that it can run in bash
+        # remove group name from the flags so that it isn't passed to calcsfh
         if self._group is not None:
-            flag_command_idx = findStringInList(self.curr_command.split(), "-group")
-            command = self.curr_command.split()
-            command.pop(flag_command_idx)
             self.flags.pop(idx)
-            self.curr_command = " ".join(command)
     
 
+    def _checkPriority(self):
+        """
+        Removes the custom flag -priority=N, which is only used by the server to order its queue, so that it isn't passed to calcsfh.
+        A value that isn't an integer counts as 0 like it does when the server queues the fit (see priorityOf in ServerMATCH.py).
+        """
+        self.priority = 0
+        for flag in list(self.flags):
+            if flag.startswith("-priority="):
+                try:
+                    self.priority = int(flag.split("=")[-1])
+                except ValueError:
+                    self.priority = 0
+                self.flags.remove(flag)
+
     def _getDAv(self):
         """
         This will take the flags and process for a dAv
@@ -279,16 +371,20 @@ class GroupProcess(ProcessRunner):
         """
         Takes in a path and a baseName and will pass this to a script that will run the appropriate base name.
         """
-        # set the current command to run a bash script and pass in the path and baseName to the script
-        #calcsfhs = [DefaultCalcsfh(calcsfh) for calcsfh in commands]
-        #super(GroupProcess, self).__init__("%s/scripts/group_script.sh %s %s %s %s" % (MATCH_SERVER_DIR, path, baseName,
-        #calcsfhs[0].phot, calcsfhs[0].parameter))
-        s = "%s/scripts/group_script.sh %s %s \"%s\"" % (MATCH_SERVER_DIR, grouping, path, commands[0])
-        for command in commands[1:]:
-            s += " \"%s\"" % (command)
-        
-        #super(GroupProcess, self).__init__("%s/scripts/group_script.sh %s %s %s" % (MATCH_SERVER_DIR, path, baseName, commands))
-        super(GroupProcess, self).__init__(s)
+        # run a bash script and pass in the grouping, the path and every command of the group as its own argument
+        super(GroupProcess, self).__init__(["%s/scripts/group_script.sh" % MATCH_SERVER_DIR, grouping, path] + list(commands))
+
+class SpeculativeRun(ProcessRunner):
+    """
+    A duplicate of the calcsfh stage of a slow fit.  It writes its own files (see DefaultCalcsfh.speculativeStage) and removes them
+    when it is canceled.
+    """
+    def __init__(self, calcsfh):
+        super(SpeculativeRun, self).__init__(calcsfh.speculativeStage())
+        self.calcsfh = calcsfh
+
+    def _cleanup(self):
+        self.calcsfh.discardSpeculative()
 
 class SSPCalcsfh(DefaultCalcsfh):
     """
@@ -303,29 +399,40 @@ class SSPCalcsfh(DefaultCalcsfh):
         self.sspcombine_name = None
         
     def sspcombine(self):
-        self.co_shortened = self.fit + ".so"
-        self.curr_command = "tail -n +11 %s > %s; %ssspcombine %s &> %s.ssp" % (self.cwd + self.co_file, self.cwd + self.co_shortened, MATCH_EXECUTABLE_BIN,
-                                                                             self.cwd + self.co_shortened, self.cwd + self.fit)
+        """
+        sspcombine reads the calcsfh output without its 10 header lines.  They are skipped while the file is streamed into sspcombine's
+        stdin so no shortened copy (".so" file) is written.  Condor still gets the old two step command.
+        """
+        co = self.cwd + self.co_file
+        shell = "tail -n +11 %s > %s.so; %ssspcombine %s.so > %s.ssp" % (co, self.cwd + self.fit, MATCH_EXECUTABLE_BIN, self.cwd + self.fit,
+                                                                      self.cwd + self.fit)
+        self.stage = Stage(["%ssspcombine" % MATCH_EXECUTABLE_BIN, "/dev/stdin"], stdout=self.cwd + self.fit + ".ssp", stderr=STDOUT,
+                           feed=skipLines(co, 10), shell=shell)
         # set a file name for the new zcombine name
         self.sspcombine_name = self.fit + ".ssp"
 
+    def outputFiles(self):
+        files = [self.fit, self.cmd_file, self.co_file, self.fit + ".ssp"]
+        return [name for name in files if name is not None]
+
     def processFit(self):
         files = [self.cwd+self.parameter, self.cwd+self.phot, self.cwd+self.fake, self.cwd+self.fit,
                  self.cwd+self.co_file, self.cwd+self.sspcombine_name, self.cwd+self.cmd_file]
-        self.curr_command = "%s/scripts/ssp_script.sh %s %s %s %s %s %s %s" % \
-                            (MATCH_SERVER_DIR, files[0], files[1], files[2], files[3], files[4], files[5], files[6])
+        self.stage = Stage(["%s/scripts/ssp_script.sh" % MATCH_SERVER_DIR] + files)
+
+    def postTask(self):
+        return None # ssp_script.sh starts no Python
 
     def condorCommands(self):
         """
-        Return a list of all the commands that will be run to put into a condor config file.
+        Return a list of all the commands that will be run to put into a condor config file.  Groups are told about the fit by
+        the server when Condor logs that the job ended (see CondorBackend.py).
         """
         forCondor = [self.curr_command]
         self.sspcombine()
         forCondor.append(self.curr_command)
         self.processFit()
         forCondor.append(self.curr_command)
-        if self._group is not None:
-            forCondor.append("group %s %s" % (self._group, self.original))
         return forCondor
 
     def _cleanup(self):
@@ -347,11 +454,11 @@ class Sleep(ProcessRunner):
         """
         The sleep time in seconds is passed in.
         """
-        super(Sleep, self).__init__("sleep %s" % stime)
+        super(Sleep, self).__init__(["sleep", str(stime)])
         self.stime = stime # capture thread time
 
     def afterSleep(self):
-        self.curr_command = "./sleep_script.sh"
+        self.stage = Stage(["./sleep_script.sh"])
         
     def _cleanup(self):
         print("Cleaning up after sleep")
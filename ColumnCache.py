@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import hashlib
+import itertools
+import json
+import os
+import shutil
+
+"""
+Synopsis
+--------
+Works on Python 2.7 and Python 3.x.
+
+A binary columnar cache of the ASCII photometry, fake and background files that MatchParam.py and the group scripts read.  The first
+time a file is read its columns are written as raw float64 files to a directory of CACHE_DIR named after the SHA-1 of the file's
+contents.  After that readers get read only memory mapped views of them instead of parsing the text again.  Copies of a file (eg the
+same fake file in many fit directories) share one entry and a file that changes gets a new one.
+
+Once the entries add up to more than CACHE_SIZE bytes the least recently used ones are removed.  An entry is used whenever a file
+with its contents is read.
+
+Files are parsed CHUNK_ROWS rows at a time and the range of every column is recorded on the way, so neither building an entry nor
+going through a file with chunks() needs more memory for a bigger file.  If the cache can't be written (eg CACHE_DIR isn't writable)
+the file is just parsed like before.
+
+Values worked out from a file, like the completeness limits of a fake file, are kept with derived() under the SHA-1 of the file's contents
+too, so every copy of a fake file finds them without being parsed.  The SHA-1 of a file is remembered by path, size and modification
+time so a file is only read to hash it when it changes.
+
+Usage
+-----
+>>> from ColumnCache import chunks, columnRanges, loadColumns
+>>> V_in, I_in, V_outin, I_outin = loadColumns("/path/to/fake.fake", [0, 1, 2, 3])
+>>> (V_brightest, V_faintest), (I_brightest, I_faintest) = columnRanges("/path/to/phot.phot", [0, 1])
+>>> for V_in, V_outin in chunks("/path/to/fake.fake", [0, 2]):
+...     count(V_in, V_outin)
+>>> brightest = derived("/path/to/phot.phot", "brightest V", lambda: float(loadColumns("/path/to/phot.phot", [0])[0].min()))
+"""
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".match_columns") # set to None to always parse the files
+CACHE_SIZE = 5 * 1024**3 # bytes of columns kept, least recently used entries are removed past it.  None never removes any.
+CHUNK_ROWS = 100000 # rows parsed or handed out by chunks() at a time
+HASH_BLOCK = 1 << 20
+
+
+def loadColumns(path, usecols=None):
+    """
+    Returns the columns "usecols" (every column if None) of a whitespace separated file as a list of float64 arrays, the same as
+    np.loadtxt(path, usecols=usecols, unpack=True).  The arrays are read only.
+    """
+    import numpy as np
+    entry, meta = _entry(path)
+    if entry is None:
+        parsed = list(_parseChunks(path))
+        columns = [np.concatenate([chunk[i] for chunk in parsed]) for i in range(len(parsed[0]) if len(parsed) > 0 else 0)]
+    else:
+        columns = [_map(entry, meta, i) for i in range(meta["columns"])]
+    return _select(path, columns, usecols)
+
+def columnRanges(path, usecols=None):
+    """
+    Returns (min, max) of the columns "usecols" (every column if None) without reading the columns when the file is cached.
+    """
+    entry, meta = _entry(path)
+    if entry is not None:
+        ranges = [tuple(limits) for limits in meta["ranges"]]
+    else:
+        ranges = None
+        for chunk in _parseChunks(path):
+            ranges = _extend(ranges, chunk)
+    return _select(path, ranges or [], usecols)
+
+def chunks(path, usecols=None):
+    """
+    Yields the columns "usecols" (every column if None) CHUNK_ROWS rows at a time, as lists of float64 arrays.
+    """
+    entry, meta = _entry(path)
+    if entry is None:
+        for chunk in _parseChunks(path):
+            yield _select(path, chunk, usecols)
+        return
+    import numpy as np
+    # read rather than memory mapped so only one chunk of the file is ever in memory
+    files = [open(os.path.join(entry, "%d.f8" % i), 'rb') for i in _select(path, list(range(meta["columns"])), usecols)]
+    try:
+        for start in range(0, meta["rows"], CHUNK_ROWS):
+            yield [np.fromfile(f, dtype='<f8', count=CHUNK_ROWS) for f in files]
+    finally:
+        for f in files:
+            f.close()
+
+def derived(path, name, compute):
+    """
+    Returns the value "name" of the contents of a file.  "compute()" works it out the first time, its result has to be JSON
+    serializable (eg floats, not numpy floats).  The name should hold every setting the value depends on.
+    """
+    if CACHE_DIR is None:
+        return compute()
+    stored = os.path.join(CACHE_DIR, "derived", contentHash(path) + ".json")
+    try:
+        with open(stored) as f:
+            values = json.load(f)
+    except (IOError, OSError, ValueError):
+        values = {}
+    if name in values:
+        return values[name]
+    value = compute()
+    values[name] = value
+    try:
+        _writeJson(stored, values)
+    except (IOError, OSError):
+        pass
+    return value
+
+def contentHash(path):
+    """
+    Returns the SHA-1 of the contents of a file.
+    """
+    stat = os.stat(path)
+    stamp = {"path": os.path.realpath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+    memo = None
+    if CACHE_DIR is not None:
+        memo = os.path.join(CACHE_DIR, "hashes", hashlib.sha1(stamp["path"].encode("utf-8")).hexdigest() + ".json")
+        try:
+            with open(memo) as f:
+                known = json.load(f)
+            if all(known[key] == stamp[key] for key in stamp):
+                return known["sha1"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            sha.update(block)
+    if memo is not None:
+        try:
+            _writeJson(memo, dict(stamp, sha1=sha.hexdigest()))
+        except (IOError, OSError):
+            pass
+    return sha.hexdigest()
+
+def _writeJson(path, value):
+    """
+    Writes a JSON file by renaming a finished temporary file over it so readers never see half of it.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory): # else made by another process just now
+                raise
+    temporary = "%s.%d" % (path, os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump(value, f)
+    os.rename(temporary, path)
+
+def _select(path, columns, usecols):
+    if usecols is None:
+        return columns
+    for i in usecols:
+        if i >= len(columns):
+            raise ValueError("%s has %d columns, no column %d" % (path, len(columns), i))
+    return [columns[i] for i in usecols]
+
+def _map(entry, meta, i):
+    import numpy as np
+    if meta["rows"] == 0: # an empty file can't be memory mapped
+        return np.zeros(0)
+    return np.memmap(os.path.join(entry, "%d.f8" % i), dtype='<f8', mode='r')
+
+def _extend(ranges, chunk):
+    """
+    Widens the (min, max) of every column to the values of a chunk.
+    """
+    limits = [(float(column.min()), float(column.max())) for column in chunk]
+    if ranges is None:
+        return limits
+    return [(min(old[0], new[0]), max(old[1], new[1])) for old, new in zip(ranges, limits)]
+
+def _entry(path):
+    """
+    Returns (directory, meta) of the cache entry of a file's contents, building it if it is missing.  (None, None) if there is no cache.
+    """
+    if CACHE_DIR is None:
+        return None, None
+    try:
+        entry = os.path.join(CACHE_DIR, contentHash(path))
+    except (IOError, OSError):
+        return None, None
+    try:
+        with open(os.path.join(entry, "meta.json")) as f:
+            meta = json.load(f)
+        if "ranges" in meta:
+            _touch(entry)
+            return entry, meta
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    try:
+        meta = _store(path, entry)
+        _evict(entry)
+        return entry, meta
+    except (IOError, OSError):
+        return None, None
+
+def _touch(entry):
+    """
+    Marks an entry as just used, see _evict.
+    """
+    try:
+        os.utime(os.path.join(entry, "meta.json"), None)
+    except OSError:
+        pass
+
+def _evict(keep):
+    """
+    Removes the least recently used entries (by the modification time of their meta.json) until the entries add up to no more than
+    CACHE_SIZE bytes.  "keep" is never removed.
+    """
+    if CACHE_SIZE is None:
+        return
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if "." in name: # being stored by some process
+            continue
+        meta = os.path.join(CACHE_DIR, name, "meta.json")
+        try:
+            with open(meta) as f:
+                info = json.load(f)
+            entries.append((os.stat(meta).st_mtime, os.path.join(CACHE_DIR, name), 8 * info["rows"] * info["columns"]))
+        except (IOError, OSError, ValueError, KeyError):
+            continue # not an entry (eg "derived")
+    total = sum(size for used, entry, size in entries)
+    for used, entry, size in sorted(entries):
+        if total <= CACHE_SIZE:
+            break
+        if entry != keep:
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+def _parseChunks(path):
+    """
+    Yields the columns of a text file CHUNK_ROWS rows at a time.
+    """
+    import numpy as np
+    f = open(path)
+    try:
+        while True:
+            lines = list(itertools.islice(f, CHUNK_ROWS))
+            if len(lines) == 0:
+                break
+            data = np.loadtxt(lines, ndmin=2)
+            if data.size > 0:
+                yield [np.ascontiguousarray(data[:, i]) for i in range(data.shape[1])]
+    finally:
+        f.close()
+
+def _store(path, entry):
+    """
+    Parses a file into a new directory that is then renamed to "entry" so readers never see a half written entry.  Returns its meta.
+    """
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    temporary = "%s.%d" % (entry, os.getpid())
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.mkdir(temporary)
+    try:
+        files = []
+        rows = 0
+        ranges = None
+        for chunk in _parseChunks(path):
+            if len(files) == 0:
+                files = [open(os.path.join(temporary, "%d.f8" % i), 'wb') for i in range(len(chunk))]
+            for f, column in zip(files, chunk):
+                column.astype('<f8').tofile(f)
+            rows += len(chunk[0])
+            ranges = _extend(ranges, chunk)
+        for f in files:
+            f.close()
+        meta = dict(columns=len(files), rows=rows, ranges=ranges or [])
+        with open(os.path.join(temporary, "meta.json"), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(temporary, entry)
+        except OSError:
+            if not os.path.isdir(entry): # else another process just stored the file, its entry is just as good
+                raise
+        return meta
+    finally:
+        shutil.rmtree(temporary, ignore_errors=True)
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import heapq
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+
+"""
+Synopsis
+--------
+Runs fits on Condor and follows them through the Condor job event log (the "user log") instead of asking condor_q.
+
+Every batch is written to a submit file whose jobs all log to the same event log (CONDOR_EVENT_LOG, which has to be on a file system the
+server and the Condor submit host share) and is submitted with CONDOR_SUBMIT.  condor_submit prints the cluster the batch went to and
+job i of the batch is process i of that cluster, so "cluster.proc" is mapped back to the server's job ID.  Condor appends an event to
+the log for every job as it moves along; poll() reads what was appended since the last call and returns the jobs that terminated (event
+005, with the return value of the job) or were removed (event 009, no return value).  Reading a few new bytes every few seconds is
+cheap so jobs and groups are marked done within seconds of finishing instead of after the next 5 minute condor_q.
+
+Execute events (001) tell the backend which jobs got a Condor slot.  How long jobs wait between being submitted and executing is
+averaged into "overhead" and, while jobs have been waiting twice that long, the number of jobs executing is taken as all the
+capacity Condor has for us.  planSpill uses both to decide which queued fits are worth sending to Condor at all.
+
+A group can also be submitted as one DAG (submitGroup, with condor_submit_dag): its fits are the parents of a node running the group
+script, so the group is processed on Condor as soon as its last fit ends.  The nodes are named after the job IDs of the fits ("fit17")
+and the group ("reduce_dAv_3") and are matched to their Condor jobs by the "DAG Node" line of their submit events.
+
+The jobs Condor still has and how far the log has been read are saved to CONDOR_STATE_FILE so a restarted server picks up where it left
+off.  An event log in the same format is written by scripts/fake_condor_submit.py, which runs the jobs on the local machine, so the
+backend can be tried without Condor.
+
+submitJobs(), submitGroup(), removeJobs() and poll() block on ssh and file IO, call them with twisted.internet.threads.deferToThread.  They are thread safe.
+"""
+
+EXECUTING = "001"
+TERMINATED = "005"
+ABORTED = "009"
+SUBMIT = "000"
+EVENT_HEAD = re.compile(r"^(\d{3}) \((\d+)\.(\d+)\.\d+\)")
+DAG_NODE = re.compile(r"DAG Node: (\S+)")
+RETURN_VALUE = re.compile(r"return value (-?\d+)")
+SUBMITTED = re.compile(r"submitted to cluster (\d+)")
+
+
+class CondorBackend(object):
+    """
+    Submits batches of jobs to Condor and reads back when each of them ends.
+    """
+    def __init__(self, submit, submitDag, remove, eventLog, stateFile, serverDir, slots=100, overhead=300.0):
+        self.submit = list(submit) # argv the submit file is appended to, eg ["ssh", "-x", "condor", "condor_submit"]
+        self.submitDag = list(submitDag) # argv the DAG file is appended to, eg ["ssh", "-x", "condor", "condor_submit_dag"]
+        self.remove = list(remove) # argv the jobs to remove are appended to, eg ["ssh", "-x", "condor", "condor_rm"]
+        self.eventLog = eventLog
+        self.stateFile = stateFile
+        self.serverDir = serverDir
+        self.slots = slots # Condor slots we expect to get until the event log shows otherwise
+        self.overhead = overhead # seconds from submitting a job to it executing, averaged over the jobs that executed
+        self.jobs = {} # "cluster.proc" -> [job ID, command, expected runtime, submit time, execute time or None, DAG or None] of the
+                       # jobs Condor still has
+        self.nodes = {} # DAG node -> the same list for the nodes of submitted DAGs that Condor hasn't made jobs of yet.  The group
+                        # script node has no job ID and the group name as its command.
+        self.offset = 0 # bytes of the event log already read
+        self._lock = threading.Lock()
+        self._load()
+
+    def outstanding(self):
+        """
+        Returns the number of submitted jobs that haven't ended yet.
+        """
+        with self._lock:
+            return len(self.jobs) + len(self.nodes)
+
+    def commands(self):
+        """
+        Returns the commands of the fits Condor still has.
+        """
+        with self._lock:
+            return [job[1] for job in list(self.jobs.values()) + list(self.nodes.values()) if job[0] is not None]
+
+    def capacity(self, now=None):
+        """
+        Returns the number of Condor slots we can expect.  While jobs are stuck waiting Condor is full and only the jobs executing now
+        count.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            executing = len([job for job in self.jobs.values() if job[4] is not None])
+            if len(self._stuck(now)) > 0:
+                return max(executing, 1)
+            return max(self.slots, executing)
+
+    def stuck(self, now=None):
+        """
+        Returns ("cluster.proc", job ID, command) of the jobs that have waited for a Condor slot twice the usual overhead, the longest
+        waiting first.
+        """
+        with self._lock:
+            return self._stuck(time.time() if now is None else now)
+
+    def _stuck(self, now):
+        waiting = sorted((job[3], name, job[0], job[1]) for name, job in self.jobs.items()
+                         if job[4] is None and job[5] is None and now - job[3] > 2*self.overhead)
+        return [(name, jobId, command) for submitted, name, jobId, command in waiting]
+
+    def busy(self, now=None):
+        """
+        Returns the seconds until each Condor slot is expected to be free once the jobs Condor has now are done.
+        """
+        now = time.time() if now is None else now
+        capacity = self.capacity(now)
+        with self._lock:
+            slots = sorted(max(job[2] - (now - job[4]), 0.0) for job in self.jobs.values() if job[4] is not None)[-capacity:]
+            slots += [0.0]*(capacity - len(slots))
+            heapq.heapify(slots)
+            for job in sorted(list(self.jobs.values()) + list(self.nodes.values()), key=lambda job: job[3]):
+                if job[4] is None:
+                    heapq.heappush(slots, max(heapq.heappop(slots), self.overhead - (now - job[3])) + job[2])
+            return slots
+
+    def submitJobs(self, batch):
+        """
+        Submits a list of (job ID, command, analysis, expected runtime) where analysis is the list of commands the job runs (see
+        DefaultCalcsfh.condorCommands).  Returns the cluster the batch went to.  Raises RuntimeError if condor_submit fails.
+        """
+        path = self.writeSubmitFile([analysis for jobId, command, analysis, expected in batch])
+        process = subprocess.Popen(self.submit + [path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        match = SUBMITTED.search(output)
+        if process.returncode != 0 or match is None:
+            raise RuntimeError("condor_submit failed (%s): %s" % (process.returncode, output.strip()))
+        cluster = int(match.group(1))
+        now = time.time()
+        with self._lock:
+            for proc, (jobId, command, analysis, expected) in enumerate(batch):
+                self.jobs["%d.%d" % (cluster, proc)] = [jobId, command, expected, now, None, None]
+            self._save()
+        return cluster
+
+    def submitGroup(self, name, nodes, reducer):
+        """
+        Submits the group "name" as a DAG.  "nodes" is a list of (job ID, command, analysis, expected runtime) of its fits, which are the
+        parents of one node running "reducer" (the argv of the group script).  A fit that fails doesn't stop the group script.  The
+        files of the DAG are written to dags/name in the server directory.  Raises RuntimeError if condor_submit_dag fails.
+        """
+        directory = "%s/dags/%s/" % (self.serverDir, name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = directory + name + ".dag"
+        f = open(path, 'w')
+        for jobId, command, analysis, expected in nodes:
+            node = "fit%d" % jobId
+            self._writeNode(directory + node + ".sub", "%s/scripts/condor_script.sh" % self.serverDir, " | ".join(analysis))
+            f.write("JOB %s %s%s.sub\n" % (node, directory, node))
+            f.write("SCRIPT POST %s /bin/true\n" % node)
+        reduce = "reduce_%s" % name
+        self._writeNode(directory + reduce + ".sub", reducer[0], condorArguments(reducer[1:]))
+        f.write("JOB %s %s%s.sub\n" % (reduce, directory, reduce))
+        f.write("PARENT %s CHILD %s\n" % (" ".join("fit%d" % node[0] for node in nodes), reduce))
+        f.close()
+
+        process = subprocess.Popen(self.submitDag + [path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        if process.returncode != 0 or SUBMITTED.search(output) is None:
+            raise RuntimeError("condor_submit_dag failed (%s): %s" % (process.returncode, output.strip()))
+        now = time.time()
+        with self._lock:
+            for jobId, command, analysis, expected in nodes:
+                self.nodes["fit%d" % jobId] = [jobId, command, expected, now, None, name]
+            self.nodes[reduce] = [None, name, 0.0, now, None, name]
+            self._save()
+
+    def removeJobs(self, names):
+        """
+        Removes jobs ("cluster.proc") from Condor and returns (job ID, command) of each.  They are forgotten first so their abort events
+        are ignored.
+        """
+        with self._lock:
+            removed = [self.jobs.pop(name) for name in names if name in self.jobs]
+            self._save()
+        if len(names) > 0:
+            process = subprocess.Popen(self.remove + list(names), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+            if process.returncode != 0:
+                print("condor_rm failed (%s): %s" % (process.returncode, output.strip()))
+        return [(job[0], job[1]) for job in removed]
+
+    def writeSubmitFile(self, jobs):
+        """
+        Writes the submit file of a batch and returns its path.
+        """
+        path = self.serverDir + "/jobs.cfg"
+        f = open(path, 'w')
+        self._writeHeader(f, "%s/scripts/condor_script.sh" % self.serverDir)
+        for analysis in jobs:
+            f.write("Arguments = \"%s\"\n" % " | ".join(analysis))
+            f.write("Queue\n\n")
+        f.close()
+        return path
+
+    def _writeHeader(self, f, executable):
+        f.write("Notification = never\n")
+        f.write("getenv = true\n")
+        f.write("Executable = %s\n" % executable)
+        f.write("Initialdir = %s/scripts/\n" % self.serverDir)
+        f.write("Universe = vanilla\n")
+        f.write("Log = %s\n" % self.eventLog)
+        f.write("Output = /dev/null\n")
+        f.write("Error = /dev/null\n\n")
+
+    def _writeNode(self, path, executable, arguments):
+        f = open(path, 'w')
+        self._writeHeader(f, executable)
+        f.write("Arguments = \"%s\"\n" % arguments)
+        f.write("Queue\n")
+        f.close()
+
+    def poll(self):
+        r"""
+        Reads the events appended to the event log since the last call.  Returns a list of (job ID, command, return value) of the jobs
+        that ended, the return value is None if the job was removed or killed by a signal.  The group script node of a DAG is returned
+        as (None, group name, return value).  An event Condor is still writing is left for the next call.
+
+        Example
+        -------
+        >>> import shutil, tempfile
+        >>> directory = tempfile.mkdtemp()
+        >>> condor = CondorBackend([], [], [], directory + "/events.log", directory + "/state.json", directory)
+        >>> condor.jobs["12.0"] = [17, "calcsfh a", 60.0, time.time(), None, None]
+        >>> log = open(condor.eventLog, 'a')
+        >>> log.writelines(["001 (012.000.000) 10/18 12:00:05 Job executing on host: <10.0.0.2>\n", "...\n",
+        ...                 "005 (012.000.000) 10/18 12:10:00 Job terminated.\n"])
+        >>> log.flush()
+        >>> condor.poll() # the job executed, its terminated event is half written
+        []
+        >>> condor.jobs["12.0"][4] is not None
+        True
+        >>> log.writelines(["\t(1) Normal termination (return value 0)\n", "...\n"])
+        >>> log.close()
+        >>> condor.poll()
+        [(17, 'calcsfh a', 0)]
+        >>> condor.outstanding()
+        0
+        >>> shutil.rmtree(directory)
+        """
+        with self._lock:
+            if not os.path.exists(self.eventLog):
+                return []
+            f = open(self.eventLog, 'r')
+            if os.fstat(f.fileno()).st_size < self.offset: # the log was removed and started over
+                self.offset = 0
+            f.seek(self.offset)
+            text = f.read()
+            f.close()
+            end = text.rfind("...\n") # events end with a "..." line, the last one may be half written
+            if end < 0:
+                return []
+            text = text[:end + 4]
+            self.offset += len(text)
+
+            ended = []
+            for code, job, returnValue, node in parseEvents(text):
+                if code == SUBMIT and node in self.nodes:
+                    self.jobs[job] = self.nodes.pop(node)
+                elif code == EXECUTING and job in self.jobs and self.jobs[job][4] is None:
+                    started = time.time()
+                    self.jobs[job][4] = started
+                    self.overhead = 0.8*self.overhead + 0.2*(started - self.jobs[job][3])
+                elif code in (TERMINATED, ABORTED) and job in self.jobs:
+                    jobId, command = self.jobs.pop(job)[:2]
+                    ended.append((jobId, command, returnValue))
+            self._save()
+            return ended
+
+    def _load(self):
+        if not os.path.exists(self.stateFile):
+            return
+        f = open(self.stateFile, 'r')
+        state = json.load(f)
+        f.close()
+        self.jobs = state["jobs"]
+        for job in self.jobs.values():
+            if len(job) == 5: # saved before DAGs
+                job.append(None)
+        self.nodes = state.get("nodes", {})
+        self.offset = state["offset"]
+        self.overhead = state.get("overhead", self.overhead)
+
+    def _save(self):
+        """
+        Must hold the lock.  Replaces the state file in one rename.
+        """
+        temp = self.stateFile + ".tmp"
+        f = open(temp, 'w')
+        json.dump({"jobs": self.jobs, "nodes": self.nodes, "offset": self.offset, "overhead": self.overhead}, f)
+        f.close()
+        os.rename(temp, self.stateFile)
+
+
+def planSpill(queued, local, condor, overhead):
+    """
+    Decides which queued jobs go to Condor.  "queued" is a list of (job ID, expected runtime, local first) in the order the local slots
+    would take them, "local" and "condor" are the seconds until each local and Condor slot is free (see CondorBackend.busy).  Jobs
+    whose group is nearly done ("local first") are placed first, then the shortest.  Each is played out on whichever side would finish
+    it sooner, a Condor slot costing "overhead" seconds before the job starts, so local slots keep the short jobs and the jobs that
+    finish groups while Condor gets the long tail, and only as much of it as the Condor slots can start before local ones would.
+    Returns the IDs of the jobs to send to Condor.
+
+    Example
+    -------
+    >>> queued = [(1, 60.0, False), (2, 7200.0, False), (3, 7200.0, True)]
+    >>> planSpill(queued, [0.0], [0.0, 0.0], 300.0) # job 3 finishes a group, the one local slot keeps it
+    [1, 2]
+    >>> planSpill(queued[:2], [0.0, 0.0], [0.0], 300.0) # both start sooner locally
+    []
+    """
+    local = list(local)
+    condor = list(condor)
+    heapq.heapify(local)
+    heapq.heapify(condor)
+    spill = []
+    for jobId, expected, localFirst in sorted(queued, key=lambda job: (not job[2], job[1])):
+        localDone = (local[0] if len(local) > 0 else float("inf")) + expected
+        condorDone = (max(condor[0], overhead) if len(condor) > 0 else float("inf")) + expected
+        if localDone <= condorDone or (localFirst and len(local) > 0):
+            heapq.heapreplace(local, localDone)
+        elif len(condor) > 0:
+            heapq.heapreplace(condor, condorDone)
+            spill.append(jobId)
+    return spill
+
+def condorArguments(argv):
+    """
+    Writes a list of arguments the way the Arguments of a submit file take them: arguments with spaces are put in single quotes and
+    quotes are doubled.
+
+    Example
+    -------
+    >>> print(condorArguments(["bestdAv", "/data/fit dir", "it's", 'a"b']))
+    bestdAv '/data/fit dir' it''s a""b
+    """
+    arguments = []
+    for arg in argv:
+        arg = arg.replace('"', '""').replace("'", "''")
+        if len(arg.split()) != 1:
+            arg = "'%s'" % arg
+        arguments.append(arg)
+    return " ".join(arguments)
+
+def parseEvents(text):
+    r"""
+    Returns a list of (event code, "cluster.proc", return value, DAG node) for the events in "text".  The return value is only set for
+    jobs that terminated normally and the DAG node only on the submit events of DAG nodes.  A half written event at the end of "text"
+    reads like a job that was killed, so poll only passes complete events.
+
+    Example
+    -------
+    >>> parseEvents("000 (012.000.000) 10/18 12:00:00 Job submitted from host: <10.0.0.1>\n    DAG Node: fit17\n...\n"
+    ...             "005 (012.000.000) 10/18 12:10:00 Job terminated.\n\t(1) Normal termination (return value 1)\n...\n"
+    ...             "005 (012.001.000) 10/18 12:11:00 Job terminated.\n\t(0) Abnormal termination (signal 9)\n...\n"
+    ...             "009 (012.002.000) 10/18 12:12:00 Job was aborted by the user.\n...\n")
+    [('000', '12.0', None, 'fit17'), ('005', '12.0', 1, None), ('005', '12.1', None, None), ('009', '12.2', None, None)]
+    >>> parseEvents("005 (012.003.000) 10/18 12:13:00 Job terminated.\n") # its return value isn't written yet
+    [('005', '12.3', None, None)]
+    """
+    events = []
+    for event in text.split("...\n"):
+        lines = event.strip().splitlines()
+        if len(lines) == 0:
+            continue
+        match = EVENT_HEAD.match(lines[0])
+        if match is None:
+            continue
+        code = match.group(1)
+        returnValue = None
+        if code == TERMINATED:
+            value = RETURN_VALUE.search(event)
+            if value is not None and "Normal termination" in event:
+                returnValue = int(value.group(1))
+        node = DAG_NODE.search(event) if code == SUBMIT else None
+        events.append((code, "%s.%s" % (int(match.group(2)), int(match.group(3))), returnValue, None if node is None else node.group(1)))
+    return events
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
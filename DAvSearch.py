@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+"""
+Synopsis
+--------
+The search behind the custom flag -dAvsearch=lower,upper,tol.  Instead of fitting every dAv of a -dAvrange grid, a few dAvs spread
+over the bracket [lower, upper] are fit at once.  When all of them report their best fit value the bracket shrinks to the neighbours
+of the best one and a new round is spread over it.  This goes on until the bracket is no wider than "tol".
+
+Every round shrinks the bracket by a factor of 2/(points + 1) so with 4 points a [0, 1] bracket gets to 0.02 in 5 rounds (about 20
+fits instead of the 51 of a 0.02 grid), and the points of a round run side by side.  dAvs are kept on a 0.01 grid since that is the
+precision of the fit names ("_dAv_0-15") scripts/ProcessDAv.py reads.
+
+The object only does the bookkeeping; ServerMATCH.py fits the dAvs it hands out and reports the results back.
+"""
+
+GRID = 0.01 # dAvs are rounded to this
+INFINITY = float("inf")
+
+
+class DAvSearch(object):
+    """
+    Coarse to fine minimisation of the best fit value over dAv.
+    """
+    def __init__(self, lower, upper, tol, points=4):
+        self.lower = _round(min(lower, upper))
+        self.upper = _round(max(lower, upper))
+        self.tol = max(tol, GRID)
+        self.points = max(points, 1) # points inside the bracket each round
+        self.values = {} # dAv -> best fit value (infinity if the fit failed)
+        self.pending = set() # dAvs handed out that haven't reported yet
+        self.done = False
+
+    def nextPoints(self):
+        """
+        Returns the dAvs to fit next, which are then pending.  Returns an empty list while a round is still running and once the search
+        is done.
+        """
+        if self.done or len(self.pending) > 0:
+            return []
+        if len(self.values) > 0 and self.upper - self.lower <= self.tol + GRID/2: # the first round always runs
+            self.done = True
+            return []
+        width = self.upper - self.lower
+        grid = set(_round(self.lower + width*i/(self.points + 1)) for i in range(self.points + 2))
+        new = sorted(dAv for dAv in grid if dAv not in self.values)
+        if len(new) == 0: # the bracket can't be split any finer
+            self.done = True
+            return []
+        self.pending.update(new)
+        return new
+
+    def report(self, dAv, value):
+        """
+        Records the best fit value (None if the fit failed) of a dAv.  The bracket is narrowed when the last pending dAv reports.
+        """
+        dAv = _round(dAv)
+        self.pending.discard(dAv)
+        self.values[dAv] = INFINITY if value is None else value
+        if len(self.pending) == 0:
+            self._narrow()
+
+    @property
+    def best(self):
+        """
+        (dAv, best fit value) of the best dAv so far or None.
+        """
+        if len(self.values) == 0:
+            return None
+        dAv = min(self.values, key=lambda dAv: self.values[dAv])
+        return (dAv, self.values[dAv])
+
+    def _narrow(self):
+        inside = sorted(dAv for dAv in self.values if self.lower - GRID/2 <= dAv <= self.upper + GRID/2)
+        if len(inside) == 0:
+            return
+        i = inside.index(min(inside, key=lambda dAv: self.values[dAv]))
+        self.lower = inside[max(i - 1, 0)]
+        self.upper = inside[min(i + 1, len(inside) - 1)]
+
+
+def _round(dAv):
+    return round(round(dAv / GRID) * GRID, 2)
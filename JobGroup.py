@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+from collections import OrderedDict
+import os
+import threading
+
+"""
+Synopsis
+--------
+A group of fits made from one command (-dAvrange, -dAvsearch or -sweep) that is processed as a whole once every member is done.
+
+Every group is named after its kind and a job ID ("dAv_17", "sweep_18") so names are never reused, even across restarts.  The
+working directory, base fit name, photometry and parameter file of the group are taken from the command it was made from instead of
+being parsed back out of its members.  A counter of the members left is kept under a lock so finding out whether a group is done is
+O(1) no matter how large it is.
+
+As each member finishes it reports its best fit value and Av.  The group keeps the best member so far and the summary file
+(workingD + baseName + "_group.ls") lists every member with a fit, best first, as
+
+    fit_name best_fit_value Av dAv
+
+so the group script only has to read one file (scripts/ProcessDAv.py plots from it) instead of scanning every fit's output.
+
+Methods that write files are meant to be called with twisted.internet.threads.deferToThread.  They are thread safe.
+"""
+
+
+class JobGroup(object):
+    """
+    The members, metadata and running best fit of a group of fits.
+    """
+    def __init__(self, name, kind, line, reducer):
+        self.name = name
+        self.kind = kind # "dAvrange", "dAvsearch" or "sweep"
+        self.line = line # the command the group was made from
+        self.reducer = reducer # grouping passed to the group script (see scripts/group_python_script.py)
+        args = _args(line)
+        self.workingD = "/".join(args[1].split("/")[:-1]) + "/"
+        self.param = args[1].split("/")[-1]
+        self.phot = args[2].split("/")[-1]
+        self.baseName = args[4].split("/")[-1]
+        self.search = None # DAvSearch of a -dAvsearch group
+        self.sweep = None # ParamSweep of a -sweep group
+        self.members = OrderedDict() # command -> True once it is done
+        self.results = {} # command -> (best fit value, Av) of the members that finished with a fit
+        self.remaining = 0 # members not done yet
+        self.best = None # (command, best fit value, Av) of the best member so far
+        self.reducing = False # the group script has been started
+        self.dag = False # the group runs on Condor as a DAG whose last node runs the group script
+        self.runtimes = [] # seconds the calcsfh stage of each finished member took
+        self._lock = threading.Lock()
+
+    def add(self, command):
+        """
+        Adds a member that isn't done yet.
+        """
+        with self._lock:
+            if command not in self.members:
+                self.members[command] = False
+                self.remaining += 1
+
+    def done(self, command, result=None):
+        """
+        Marks a member done.  "result" is its (best fit value, Av) or None if it has no fit (it failed or was pruned).  Returns False
+        if the member isn't in the group or was already done.
+        """
+        with self._lock:
+            if self.members.get(command) is not False:
+                return False
+            self.members[command] = True
+            self.remaining -= 1
+            if result is not None:
+                self.results[command] = result
+                if self.best is None or result[0] < self.best[1]:
+                    self.best = (command,) + tuple(result)
+            return True
+
+    @property
+    def finished(self):
+        """
+        True once every member is done and no more members are coming.
+        """
+        return self.remaining == 0 and (self.search is None or self.search.done)
+
+    def recordRuntime(self, seconds):
+        """
+        Records how long the calcsfh stage of a member took.
+        """
+        with self._lock:
+            self.runtimes.append(seconds)
+
+    def typicalRuntime(self, minimum=3):
+        """
+        Returns the median calcsfh time of the members or None until "minimum" of them have finished.
+        """
+        with self._lock:
+            runtimes = sorted(self.runtimes)
+        if len(runtimes) < max(minimum, 1):
+            return None
+        middle = len(runtimes) // 2
+        if len(runtimes) % 2 == 1:
+            return runtimes[middle]
+        return (runtimes[middle - 1] + runtimes[middle]) / 2
+
+    def claim(self):
+        """
+        Returns True once, for the caller that gets to run the group script of a finished group.
+        """
+        with self._lock:
+            if self.finished and not self.reducing:
+                self.reducing = True
+                return True
+            return False
+
+    def fitted(self):
+        """
+        Returns the commands of the members that finished with a fit in the order they were added.
+        """
+        with self._lock:
+            return [command for command in self.members if command in self.results]
+
+    def summaryFile(self):
+        return self.workingD + self.baseName + "_group.ls"
+
+    def writeSummary(self):
+        """
+        Writes the summary file.  It is replaced in one rename so a reader never sees half of it.
+        """
+        with self._lock:
+            rows = sorted((value, av, command) for command, (value, av) in self.results.items())
+            temp = self.summaryFile() + ".tmp"
+            f = open(temp, 'w')
+            for value, av, command in rows:
+                f.write("%s %f %s %s\n" % (_args(command)[4].split("/")[-1], value, "nan" if av is None else "%f" % av,
+                                           _flag(command, "-dAv")))
+            f.close()
+            os.rename(temp, self.summaryFile())
+
+    def meta(self):
+        """
+        Returns what the journal needs besides the members to rebuild the group.
+        """
+        meta = {"kind": self.kind, "line": self.line, "reducer": self.reducer, "search": None, "dag": self.dag}
+        if self.search is not None:
+            meta["search"] = {"lower": self.search.lower, "upper": self.search.upper, "tol": self.search.tol}
+        return meta
+
+
+def _args(command):
+    """
+    Returns the arguments of a calcsfh command without a leading "cd directory".
+    """
+    args = command.split()
+    if args[0] == "cd":
+        return args[2:]
+    return args
+
+def _flag(command, name):
+    """
+    Returns the value of the flag "name" in a command or "nan".
+    """
+    for arg in command.split():
+        if arg.startswith(name + "="):
+            return arg.split("=", 1)[1]
+    return "nan"
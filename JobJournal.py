@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+from collections import OrderedDict
+import json
+import sqlite3
+import time
+
+from twisted.internet import reactor
+
+"""
+Synopsis
+--------
+An append-only journal of everything the server is asked to do so that queued fits and half finished dAv groups survive a restart.
+
+Each event (a job being submitted, started, finishing a stage or finishing, and a group being made or reduced) is one row in an SQLite
+database kept in WAL mode.  Rows are written as they happen but only committed every JOURNAL_FLUSH_INTERVAL seconds, so thousands of
+submissions cost one fsync instead of thousands.  At most that many seconds of events can be lost in a crash.
+
+On startup replay() folds the events back into the state of every job and group.  Jobs that never finished are queued again and the
+stages they already finished are remembered so a fit picks up where it left off (like the -skip flag, see CommandMethods.calcsfh).
+Finished jobs are then compacted out of the journal.
+
+The journal is only used from the reactor thread.
+"""
+
+FINISHED = ("done", "canceled", "failed", "condor") # job states that are never run again
+
+
+class JobJournal(object):
+    """
+    Records job and group events and replays them after a restart.
+
+    Example
+    -------
+    >>> journal = JobJournal(":memory:")
+    >>> journal.submitted(1, "calcsfh a")
+    >>> journal.started(1)
+    >>> journal.stage(1, "calcsfh")
+    >>> journal.submitted(2, "calcsfh b")
+    >>> journal.finished(2, "done")
+    >>> journal.issued(3) # eg a group name
+    >>> journal.group("dAv_3", ["calcsfh a"])
+    >>> jobs, groups, lastId = journal.replay()
+    >>> [jobId for jobId, job in jobs.items() if job["state"] not in FINISHED], lastId # job 1 is run again after a restart
+    ([1], 3)
+    >>> "calcsfh" in journal.stagesDone(1), groups["dAv_3"]["reduced"]
+    (True, False)
+    >>> journal.compact([2], [])
+    >>> jobs, groups, lastId = journal.replay() # job 2 is gone, the largest job ID is kept
+    >>> list(jobs.keys()), len(groups), lastId
+    ([1], 1, 3)
+    >>> journal.close()
+    """
+    def __init__(self, fileName, flushInterval=1.0):
+        self.fileName = fileName
+        self.flushInterval = flushInterval
+        self._db = sqlite3.connect(fileName)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL") # every commit is fsynced, commits are batched by flush()
+        self._db.execute("CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, time REAL, job INTEGER, "
+                         "kind TEXT, data TEXT)")
+        self._db.commit()
+        self._flushCall = None
+        self._stagesDone = {} # job ID -> set of stages finished before the last restart
+
+    def submitted(self, jobId, command):
+        self._record(jobId, "submit", command)
+
+    def issued(self, jobId):
+        """
+        Records a job ID handed out to something that isn't journaled as a job (a group name or a job that isn't durable) so it is never
+        handed out again.
+        """
+        self._record(jobId, "issued")
+
+    def started(self, jobId):
+        self._record(jobId, "start")
+
+    def stage(self, jobId, stage):
+        """
+        Records that "stage" (eg calcsfh, zcombine, processFit) of a job finished.
+        """
+        self._record(jobId, "stage", stage)
+
+    def finished(self, jobId, state):
+        """
+        state is one of FINISHED.
+        """
+        self._record(jobId, "finish", state)
+        self._stagesDone.pop(jobId, None)
+
+    def group(self, name, commands, meta=None):
+        """
+        Records a group of commands (eg the fits made by -dAvrange).  Groups that grow (-dAvsearch) are recorded again with all of their
+        commands every time.  "meta" is what is needed to rebuild the group (see JobGroup.meta).
+        """
+        self._record(None, "group", json.dumps({"name": name, "commands": commands, "meta": meta}))
+
+    def reduced(self, name):
+        """
+        Records that the script processing a finished group is done.
+        """
+        self._record(None, "reduced", name)
+
+    def stagesDone(self, jobId):
+        """
+        Returns the set of stages the job finished before the server was restarted.
+        """
+        return self._stagesDone.get(jobId, set())
+
+    def flush(self):
+        """
+        Commits (and fsyncs) everything recorded since the last flush.
+        """
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        self._db.commit()
+
+    def replay(self):
+        """
+        Folds the journal into the state of every job and group.  Returns (jobs, groups, lastId) where jobs is an OrderedDict of job ID ->
+        {"command", "state", "stages"} in submission order, groups is a dict of name -> {"commands", "meta", "reduced"} and
+        lastId is the largest job ID ever handed out.
+        """
+        jobs = OrderedDict()
+        groups = {}
+        lastId = 0
+        for jobId, kind, data in self._db.execute("SELECT job, kind, data FROM events ORDER BY seq"):
+            if jobId is not None:
+                lastId = max(lastId, jobId)
+            if kind == "submit":
+                jobs[jobId] = {"command": data, "state": "queued", "stages": set()}
+            elif kind == "group":
+                group = json.loads(data)
+                groups[group["name"]] = {"commands": group["commands"], "meta": group.get("meta"), "reduced": False}
+            elif kind == "reduced":
+                if data in groups:
+                    groups[data]["reduced"] = True
+            elif jobId in jobs:
+                if kind == "start":
+                    jobs[jobId]["state"] = "running"
+                elif kind == "stage":
+                    jobs[jobId]["stages"].add(data)
+                elif kind == "finish":
+                    jobs[jobId]["state"] = data
+
+        for jobId, job in jobs.items():
+            if job["state"] not in FINISHED:
+                self._stagesDone[jobId] = job["stages"]
+        return jobs, groups, lastId
+
+    def compact(self, jobIds, groupNames):
+        """
+        Removes the events of finished jobs and reduced groups so the journal only holds live work.  One marker row holding the largest
+        job ID ever handed out (journaled jobs and issued IDs) is kept so job IDs are never handed out twice.
+        """
+        lastId = self._db.execute("SELECT MAX(job) FROM events").fetchone()[0]
+        self._db.executemany("DELETE FROM events WHERE job = ?", [(jobId,) for jobId in jobIds])
+        groupNames = set(groupNames)
+        for seq, kind, data in self._db.execute("SELECT seq, kind, data FROM events WHERE job IS NULL").fetchall():
+            if (kind == "group" and json.loads(data)["name"] in groupNames) or (kind == "reduced" and data in groupNames):
+                self._db.execute("DELETE FROM events WHERE seq = ?", (seq,))
+        self._db.execute("DELETE FROM events WHERE kind IN ('marker', 'issued')")
+        if lastId is not None:
+            self._record(lastId, "marker")
+        self.flush()
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def _record(self, jobId, kind, data=None):
+        self._db.execute("INSERT INTO events (time, job, kind, data) VALUES (?, ?, ?, ?)", (time.time(), jobId, kind, data))
+        if self._flushCall is None:
+            self._flushCall = reactor.callLater(self.flushInterval, self.flush)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import heapq
+from Queue import Empty
+import threading
+import time
+
+"""
+Synopsis
+--------
+Holds every command the server knows about under a stable job ID.  It replaces the plain Queue the server used as its work queue so
+that looking up, listing and canceling commands never has to drain the queue and put it back together.
+
+Queued commands are kept in a heap ordered by priority first and then by shortest expected runtime, so quick fits are not stuck
+behind a long -full -ssp run and mean turnaround is kept low.  To keep long jobs from starving every job is aged: each second spent
+waiting takes "aging" seconds off its expected runtime.  Because every job ages at the same rate this ordering never changes once a job
+is queued, so the heap key is simply
+
+    (-priority, expected runtime + aging * submit time, job ID)
+
+and ties fall back to submission order.  Every job also carries its expected peak memory so the server only takes the next job when
+it fits in the memory that is left (see get_nowait).  Canceled or re-estimated entries are left in the heap and skipped when they come up (lazy
+deletion); the heap is rebuilt when more than half of it is stale.
+
+A dictionary maps job IDs to their live heap entry and a second dictionary maps each command string to the IDs it was submitted under.
+Running jobs (MatchJob objects) are indexed by the same IDs.  Canceling by ID or by command and looking up a job are O(1), taking the
+next command is O(log n).  Listings are built from the index under the lock and never touch the queue.
+
+The registry is used from the reactor thread and from the Condor thread so every method takes the lock.
+"""
+
+
+class JobRegistry(object):
+    """
+    Queue like object (put, get_nowait, qsize) with job IDs and indices for lookups.  "defaultRuntime" is the expected runtime in
+    seconds and "defaultMemory" the expected peak memory in bytes of a job that hasn't been estimated yet.
+
+    Example
+    -------
+    >>> registry = JobRegistry(aging=0.0)
+    >>> registry.put("calcsfh long", expected=7200.0)
+    1
+    >>> registry.put("calcsfh short", expected=60.0)
+    2
+    >>> registry.put("calcsfh urgent", expected=7200.0, priority=1)
+    3
+    >>> registry.snapshot() # priority first, then the shortest
+    [(3, 'calcsfh urgent'), (2, 'calcsfh short'), (1, 'calcsfh long')]
+    >>> registry.reprioritize(1, expected=1.0)
+    >>> registry.cancelCommand("calcsfh urgent")
+    [(3, 'queued')]
+    >>> registry.get_nowait()
+    (1, 'calcsfh long')
+    >>> registry.take(maxMemory=2**20) # the next job is expected to need defaultMemory
+    Traceback (most recent call last):
+        ...
+    Empty
+    >>> registry.get_nowait()
+    (2, 'calcsfh short')
+    """
+    def __init__(self, aging=1.0, defaultRuntime=3600.0, defaultMemory=2**30):
+        self._lock = threading.Lock()
+        self._nextId = 1
+        self.aging = aging
+        self.defaultRuntime = defaultRuntime
+        self.defaultMemory = defaultMemory
+        self._heap = [] # [key, job ID, command, priority, expected, submitted, memory]; entries no longer in _pending are stale
+        self._pending = {} # job ID -> its live heap entry
+        self._running = {} # job ID -> MatchJob
+        self._byCommand = {} # command -> set of job IDs (pending or running)
+
+    def newId(self):
+        """
+        Hands out the next job ID.  Used for commands that are started without being queued.
+        """
+        with self._lock:
+            return self._newId()
+
+    def reserve(self, lastId):
+        """
+        Makes sure job IDs up to and including "lastId" (eg from the journal of a previous run) are never handed out again.
+        """
+        with self._lock:
+            self._nextId = max(self._nextId, lastId + 1)
+
+    def put(self, command, jobId=None, priority=0, expected=None, memory=None):
+        """
+        Queues a command and returns its job ID.  Higher priorities run first.  "expected" is the expected runtime in seconds and
+        "memory" the expected peak memory in bytes.
+        """
+        with self._lock:
+            if jobId is None:
+                jobId = self._newId()
+            self._push(jobId, command, priority, expected, time.time(), memory)
+            self._index(jobId, command)
+            return jobId
+
+    def reprioritize(self, jobId, expected=None, priority=None, memory=None):
+        """
+        Changes the expected runtime, priority and/or memory of a queued job.  Does nothing if the job isn't queued anymore.
+        """
+        with self._lock:
+            entry = self._pending.get(jobId)
+            if entry is None:
+                return
+            self._push(jobId, entry[2], entry[3] if priority is None else priority, entry[4] if expected is None else expected,
+                       entry[5], entry[6] if memory is None else memory)
+            self._compact()
+
+    def get_nowait(self):
+        """
+        Removes and returns (job ID, command) of the next command to run.  Raises Queue.Empty if there is nothing queued.
+        """
+        return self.take()[:2]
+
+    def take(self, maxMemory=None):
+        """
+        Removes and returns (job ID, command, expected memory) of the next command to run.  Raises Queue.Empty if there is nothing
+        queued or if the next command is expected to use more than "maxMemory" bytes.
+        """
+        with self._lock:
+            while len(self._heap) > 0:
+                entry = self._heap[0]
+                jobId = entry[1]
+                if self._pending.get(jobId) is not entry: # stale
+                    heapq.heappop(self._heap)
+                    continue
+                if maxMemory is not None and entry[6] > maxMemory:
+                    break
+                heapq.heappop(self._heap)
+                del self._pending[jobId]
+                self._unindex(jobId, entry[2])
+                return jobId, entry[2], entry[6]
+            raise Empty
+
+    def takeId(self, jobId):
+        """
+        Removes a queued job out of turn (eg to send it to Condor) and returns its command, or None if it isn't queued anymore.
+        """
+        with self._lock:
+            entry = self._pending.pop(jobId, None)
+            if entry is None:
+                return None
+            self._unindex(jobId, entry[2])
+            self._compact()
+            return entry[2]
+
+    def qsize(self):
+        with self._lock:
+            return len(self._pending)
+
+    def running(self, jobId, job):
+        """
+        Records that the job with this ID is now running as "job".
+        """
+        with self._lock:
+            self._running[jobId] = job
+            self._index(jobId, job.command)
+
+    def finished(self, jobId):
+        with self._lock:
+            job = self._running.pop(jobId, None)
+            if job is not None:
+                self._unindex(jobId, job.command)
+
+    def lookup(self, jobId):
+        """
+        Returns ("queued", command), ("running", MatchJob) or None if the job is not known.
+        """
+        with self._lock:
+            if jobId in self._pending:
+                return ("queued", self._pending[jobId][2])
+            if jobId in self._running:
+                return ("running", self._running[jobId])
+            return None
+
+    def cancel(self, jobId):
+        """
+        Removes a queued job or cancels a running one.  Returns "queued" or "running" depending on what the job was, or None if it
+        wasn't found.
+        """
+        with self._lock:
+            job = self._cancel(jobId)
+        if job is None:
+            return None
+        if job is True:
+            return "queued"
+        job.cancel() # kill outside the lock
+        return "running"
+
+    def cancelCommand(self, command):
+        """
+        Cancels every queued or running job that was submitted as "command".  Returns a list of (job ID, "queued" or "running").
+        """
+        with self._lock:
+            ids = sorted(self._byCommand.get(command, ()))
+            jobs = [self._cancel(jobId) for jobId in ids]
+        canceled = []
+        for jobId, job in zip(ids, jobs):
+            if job is True:
+                canceled.append((jobId, "queued"))
+            else:
+                job.cancel()
+                canceled.append((jobId, "running"))
+        return canceled
+
+    def cancelQueued(self, command):
+        """
+        Removes every queued job that was submitted as "command" and returns their IDs.  Running jobs are left alone.
+        """
+        with self._lock:
+            ids = sorted(jobId for jobId in self._byCommand.get(command, ()) if jobId in self._pending)
+            for jobId in ids:
+                self._cancel(jobId)
+            return ids
+
+    def clear(self):
+        """
+        Empties the queue and returns the IDs of the removed commands.  Running jobs are left alone.
+        """
+        with self._lock:
+            ids = [entry[1] for entry in sorted(self._pending.values())]
+            for entry in self._pending.values():
+                self._unindex(entry[1], entry[2])
+            self._pending.clear()
+            del self._heap[:]
+            return ids
+
+    def snapshot(self, offset=0, limit=None):
+        """
+        Returns a list of (job ID, command) for the queued commands in run order starting at "offset".
+        """
+        return [(jobId, command) for jobId, command, expected in self.scheduled(offset, limit)]
+
+    def scheduled(self, offset=0, limit=None):
+        """
+        Same as snapshot but returns (job ID, command, expected runtime in seconds).
+        """
+        with self._lock:
+            if limit is None:
+                entries = sorted(self._pending.values())
+            else:
+                entries = heapq.nsmallest(offset + limit, self._pending.values())
+            return [(entry[1], entry[2], entry[4]) for entry in entries[offset:]]
+
+    def runningJobs(self):
+        """
+        Returns a list of (job ID, MatchJob) ordered by job ID.
+        """
+        with self._lock:
+            return sorted(self._running.items())
+
+    def _newId(self):
+        jobId = self._nextId
+        self._nextId += 1
+        return jobId
+
+    def _push(self, jobId, command, priority, expected, submitted, memory):
+        """
+        Must hold the lock.  Adds a heap entry for the job, which makes any older entry for it stale.
+        """
+        if expected is None:
+            expected = self.defaultRuntime
+        if memory is None:
+            memory = self.defaultMemory
+        entry = [(-priority, expected + self.aging*submitted, jobId), jobId, command, priority, expected, submitted, memory]
+        self._pending[jobId] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _compact(self):
+        """
+        Must hold the lock.  Drops stale entries once they make up more than half of the heap.
+        """
+        if len(self._heap) > 2*len(self._pending) + 64:
+            self._heap = list(self._pending.values())
+            heapq.heapify(self._heap)
+
+    def _index(self, jobId, command):
+        self._byCommand.setdefault(command, set()).add(jobId)
+
+    def _unindex(self, jobId, command):
+        ids = self._byCommand.get(command)
+        if ids is not None:
+            ids.discard(jobId)
+            if len(ids) == 0:
+                del self._byCommand[command]
+
+    def _cancel(self, jobId):
+        """
+        Must hold the lock.  Returns True for a removed queued job, the MatchJob for a running one, or None.
+        """
+        if jobId in self._pending:
+            self._unindex(jobId, self._pending.pop(jobId)[2])
+            self._compact()
+            return True
+        if jobId in self._running:
+            return self._running[jobId]
+        return None
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
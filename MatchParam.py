@@ -1,17 +1,22 @@
 #!/usr/bin/env python
 from __future__ import print_function, division, absolute_import
 
+import copy
 import glob
 import os
 import sys
 
-import numpy as np
-import pandas as pd
+from ColumnCache import chunks, columnRanges, derived
 
 """
 Synopsis
 --------
-Works on Python 2.7 and Python 3.x.
+Works on Python 2.7 and Python 3.x.  numpy is only imported once a magnitude limit has to be calculated from the
+photometry or fake file, so parsing and saving a filled out parameter file doesn't pay for it.  The photometry, fake and background
+files are read through ColumnCache.py, which keeps a binary copy of their columns so they are only parsed once, and the fake file is
+gone through a chunk at a time so building a MatchParam doesn't need more memory for a bigger fake file.  The completeness limits and
+brightest magnitudes are remembered by the contents of the files they came from, so making another parameter file from the same fake
+and photometry files doesn't work them out again.
 
 This is a module that helps to quickly script the making of new parameter files.  Suppose you have a lot of MATCH fits and each one is slightly
 different.  If you feed MatchParam a master parameter file that reflects the common across the fits you can tweak the fit specific
@@ -43,6 +48,16 @@ Usage (For more advanced usage like changing exclude gates see UsingMatchParam.p
 >>> type(minDistMod) # check the type
 <type 'float'>
 
+# A batch of parameter files from one master: the master is parsed once and every file is a copy with its row of changes.
+>>> param = MatchParam("/path/to/your/param.param")
+>>> param.saveBatch([{"dAv": 0.1}, {"dAv": 0.2, "BF": 0.3}], path="/to/save/directory") # parameters_01.param, parameters_02.param
+>>> param.saveBatch(table, path="/to/save/directory", names=["%s.param" % snr for snr in table["id"]]) # table is a DataFrame
+
+# Completeness curves (fraction of fake stars recovered per magnitude bin) of every filter in the fake file.
+>>> param = MatchParam("/path/to/your/param.param", "/path/to/phot.phot", "/path/to/fake.fake")
+>>> for mags, fractions in param.completenessCurves(size_of_bin=0.1):
+...     print(mags[np.argmax(fractions < 0.5)])
+
 Keys (Use the printKeys function in MatchParam to see the object's instance of keys)
 ----
 m-Mmin m-Mmax d(m-M) Avmin Avmax dAv
@@ -189,6 +204,75 @@ class MatchParam(object):
         
         return None
 
+    def copy(self):
+        """Returns a copy of this parameter file that can be changed and saved without touching this one.  Nothing is parsed again.
+
+        Return
+        ------
+        MatchParam
+        """
+        clone = copy.copy(self)
+        # change() replaces values instead of changing them in place so the values themselves can be shared
+        clone.parameters = dict(self.parameters)
+        clone.filterSet = list(self.filterSet)
+        clone.savedTo = None
+        clone.name = None
+        return clone
+
+    def derive(self, overrides):
+        """Returns one copy (see copy) per row of "overrides" with the values of its row changed.
+
+        Parameters
+        ----------
+        overrides : list of dicts or a pandas DataFrame
+                    Each row maps keys to new values.  Empty (NaN) cells of a DataFrame are left as they are.
+
+        Return
+        ------
+        list of MatchParam
+        """
+        if hasattr(overrides, "to_dict"): # DataFrame
+            overrides = overrides.to_dict("records")
+        clones = []
+        for row in overrides:
+            clone = self.copy()
+            for key, value in row.items():
+                if isinstance(value, float) and value != value: # NaN
+                    continue
+                clone.change(key, value)
+            clones.append(clone)
+        return clones
+
+    def saveBatch(self, overrides, path=None, names=None, prefix="parameters"):
+        """Writes a parameter file for every row of "overrides" (see derive).
+
+        Parameters
+        ----------
+        overrides : list of dicts or a pandas DataFrame
+                    The changes of each parameter file.
+        path : {string}
+               Path to save directory, the CWD if None.
+        names : {list of strings}
+                Names of the files in the order of the rows.  By default they are numbered by row ("prefix"_01.param, ...) so the
+                same table always gives the same names.
+        prefix : {string}
+                 Start of the default names.
+
+        Return
+        ------
+        list of MatchParam
+            The saved copies, their savedTo holds where each went.
+        """
+        clones = self.derive(overrides)
+        if names is None:
+            width = max(2, len(str(len(clones))))
+            names = ["%s_%0*d.param" % (prefix, width, i + 1) for i in range(len(clones))]
+        if len(names) != len(clones):
+            raise ValueError("%d names for %d parameter files" % (len(names), len(clones)))
+        for clone, name in zip(clones, names):
+            clone.save(path=path, name=name)
+        return clones
+
     def get(self, key):
         """Pass in a key to retrieve the value of from the self.parameters dictionary.  Raises exception if it is not
         a valid key.
@@ -817,23 +901,40 @@ class MatchParam(object):
                 file_to_use = path + self.parameters['background']
             else:
                 file_to_use = self.parameters['background']
-        if n == 1:
-            lowest_cmd, higher_cmd = np.loadtxt(file_to_use, usecols=[0,1], unpack=True)
+        # remembered by the contents of the file so copies of it in other fit directories aren't read again
+        return derived(file_to_use, "brightest %d" % n, lambda: self._brightest(n, file_to_use))
 
-            lowest_min = lowest_cmd.min()
-            higher_min = higher_cmd.min()
+    def _brightest(self, n, file_to_use):
+        # the ranges of the columns are found while the file is read into the column cache, the columns aren't loaded
+        if n == 1:
+            (lowest_min, lowest_max), (higher_min, higher_max) = columnRanges(file_to_use, [0, 1])
 
             return [lowest_min, higher_min]
         
         else:# when the number of cmds is 2 we grab 3 filters
-            lowest_cmd, middle_cmd, largest_cmd = np.loadtxt(file_to_use, usecols=[0, 1, 2], unpack=True)
-
-            lowest_min = lowest_cmd.min()
-            middle_min = middle_cmd.min()
-            largest_min = largest_cmd.min()
+            (lowest_min, lowest_max), (middle_min, middle_max), (largest_min, largest_max) = columnRanges(file_to_use, [0, 1, 2])
 
             return [lowest_min, middle_min, largest_min]
 
+    def completenessCurves(self, size_of_bin=0.1):
+        """Returns the completeness curve of every filter in the fake file.
+
+        Parameters
+        ----------
+        size_of_bin : {float} (optional)
+                      Width in magnitudes of the bins the fake stars are counted in.
+
+        Returns
+        -------
+        out : list of (mags, fractions) tuples
+              One per filter in the order of the fake file columns.  "fractions" is the fraction of the fake stars recovered within a
+              magnitude in the bin ending at "mags" (the first bin is also given at its bright edge).  Empty bins take the fraction of the
+              next bin with stars.
+        """
+        if self.fake is None:
+            raise GetMagError("Tried to calculate completeness but there is no passed in fake star file.")
+        return self._completenessCurves(int(self.parameters["Ncmds"]), size_of_bin)
+
     def _calculateComp(self, n, completeness):
         """
         Calculates the 50 percent completeness limit for the passed in fake file. The passed in value is the number of CMDs.
@@ -842,81 +943,70 @@ class MatchParam(object):
         # change this to get finer/coarser binning
         size_of_bin = 0.1 # set size of bin
 
-        # read in fake file columns
-        if n == 1:
-            V_in, I_in, V_outin, I_outin = np.loadtxt(self.fake, usecols=[0,1,2,3], unpack=True)
-
-            V_comp = self._getCompleteness(V_in, V_outin, size_of_bin, completeness)
-
-            I_comp = self._getCompleteness(I_in, I_outin, size_of_bin, completeness)
-
-            return [V_comp, I_comp]
-
-            
-        else:
-            f336_in, f438_in, f814_in, f336_outin, f438_outin, f814_outin = np.loadtxt(self.fake,
-                                                                                       usecols=[0, 1, 2, 3, 4, 5], unpack=True)
-
-            ### Get the 50% completeness of F336W
-            f336_50 = self._getCompleteness(f336_in, f336_outin, size_of_bin, completeness)
-
-            #### Get the 50% completeness for F438W
-            f438_50 = self._getCompleteness(f438_in, f438_outin, size_of_bin, completeness)
-
-            ### Get the 50% completeness for F814W
-            f814_50 = self._getCompleteness(f814_in, f814_outin, size_of_bin,completeness)
+        # many fits share a fake file so the limits are remembered by its contents, the completeness and the binning
+        return derived(self.fake, "completeness %d %r %r" % (n, completeness, size_of_bin),
+                       lambda: [float(self._interpolateCompMag(mags, fractions, completeness))
+                                for mags, fractions in self._completenessCurves(n, size_of_bin)])
 
-            return [f336_50, f438_50, f814_50]
-
-
-    def _getCompleteness(self, mag_in, mag_outin, size_of_bin, completeness):
-        good_idx = np.where(mag_in < 30.0)[0]
-        mag_in, mag_outin = mag_in[good_idx], mag_outin[good_idx]
-        mag_brightest, mag_faintest = mag_in.min(), mag_in.max()
+    def _completenessCurves(self, n, size_of_bin):
+        """
+        Goes through the fake file once, a chunk of stars at a time, and bins every filter, see completenessCurves.
+        """
+        filters = 2 if n == 1 else 3 # input magnitudes come first followed by the output - input of each filter
+        counts = [None] * filters
+        for columns in chunks(self.fake, list(range(2*filters))):
+            for i in range(filters):
+                counts[i] = self._countMagnitudes(columns[i], columns[filters + i], counts[i])
+        return [self._completenessCurve(mags, total, found, size_of_bin) for mags, total, found in counts]
+
+    def _countMagnitudes(self, mag_in, mag_outin, counts=None):
+        """
+        Returns (mags, total, found): the distinct input magnitudes (below 30) with how many fake stars have each and how many of those were
+        recovered within a magnitude.  A chunk is added to the "counts" of the chunks before it.  Fake magnitudes come with a few decimals
+        so the counts stay small however many stars there are.
+        """
+        import numpy as np
+        good = mag_in < 30.0
+        mags = mag_in[good]
+        total = np.ones(mags.size)
+        found = ((mag_outin[good] >= -1.0) & (mag_outin[good] <= 1.0)).astype(float)
+        if counts is not None:
+            mags, total, found = np.concatenate([counts[0], mags]), np.concatenate([counts[1], total]), np.concatenate([counts[2], found])
+        mags, inverse = np.unique(mags, return_inverse=True)
+        return mags, np.bincount(inverse, weights=total, minlength=mags.size), np.bincount(inverse, weights=found, minlength=mags.size)
+
+    def _completenessCurve(self, mags, total, found, size_of_bin):
+        """
+        Bins the counts of _countMagnitudes in bins of "size_of_bin" from the brightest star on.
+        """
+        import numpy as np
+        mag_brightest, mag_faintest = mags.min(), mags.max()
         number_of_bins = int(np.ceil((mag_faintest - mag_brightest) / size_of_bin))
+        # edges summed up bin by bin like they always were so stars right on an edge land in the same bin
+        edges = np.cumsum(np.append(mag_brightest, np.repeat(size_of_bin, number_of_bins)))
 
-        mag_mag = []
-        mag_fraction = []
-
-        begin_mag = mag_brightest
-        end_mag = mag_brightest + size_of_bin
-        for i in range(number_of_bins):
-            idx = np.where((mag_in >= begin_mag) & (mag_in < end_mag))[0]
-            recovered = mag_outin[idx]
-            recovered = recovered[(recovered>=-1.0) & (recovered<=1.0)]
-            if i == 0:
-                mag_mag.append(begin_mag)
-                mag_mag.append(end_mag)
-
-                if idx.size <= 0:
-                    mag_fraction.append(np.nan)
-                    mag_fraction.append(np.nan)
-                else:
-                    mag_fraction.append(recovered.size / idx.size)
-                    mag_fraction.append(recovered.size / idx.size)
-            else:
-                mag_mag.append(end_mag)
+        bins = np.digitize(mags, edges) - 1
+        inside = bins < number_of_bins # a star right on the faint edge falls outside the last bin
+        total = np.bincount(bins[inside], weights=total[inside], minlength=number_of_bins)
+        found = np.bincount(bins[inside], weights=found[inside], minlength=number_of_bins)
 
-                if idx.size <= 0:
-                    mag_fraction.append(np.nan)
-                else:
-                    mag_fraction.append(recovered.size / idx.size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = found / total # nan where a bin has no stars
+        # Fill in the bins that didn't have any "fraction" with the next valid entry.
+        valid = np.where(np.isnan(fraction), fraction.size, np.arange(fraction.size))
+        fraction = np.append(fraction, np.nan)[np.minimum.accumulate(valid[::-1])[::-1]]
 
-            begin_mag = end_mag
-            end_mag = end_mag + size_of_bin
-            
-        mag_mag, mag_fraction = np.asarray(mag_mag), np.asarray(mag_fraction)
-        # Fill in the bins that didn't have any "fraction" and were assigned nan.  Filled with
-        # next valid entry.
-        mag_fraction = pd.Series(mag_fraction).fillna(method='backfill').values        
-        mag_comp = self._interpolateCompMag(mag_mag, mag_fraction, completeness)
+        return edges, np.concatenate([fraction[:1], fraction])
 
-        return mag_comp
+    def _getCompleteness(self, mag_in, mag_outin, size_of_bin, completeness):
+        mags, fractions = self._completenessCurve(*(self._countMagnitudes(mag_in, mag_outin) + (size_of_bin,)))
+        return self._interpolateCompMag(mags, fractions, completeness)
 
     def _interpolateCompMag(self, mags, fracs, completeness):
         """
         Linearly extrapolates between the points that bound 0.5. 
         """
+        import numpy as np
         # Make sure that we only get the data from the right half of the graph.
         max_idx = np.argmax(fracs)
         fracs = fracs[max_idx:]
@@ -5,10 +5,8 @@ import glob
 import os
 import subprocess
 import sys
-import telnetlib
-import time
 
-from MatchParam import MatchParam
+import BatchSubmit
 from UserParameters import *
 import MyLogger
 
@@ -147,6 +145,8 @@ def singleRun(args):
         flags = parse(args)
     print("Retrieved flags:", flags)
     
+    from MatchParam import MatchParam # not needed by list runs, which only build command strings
+
     # if there is not passed in ".param" file then generate one based off the default one in the executable directory
     param = None
     if paramFile is None: # generate ".param" file and save it in working directory.
@@ -291,6 +291,12 @@ def parse(args):
         if "-dAvrange=" in arg:
             flags.append(arg)
             idx.append(i)
+        if "-dAvsearch=" in arg:
+            flags.append(arg)
+            idx.append(i)
+        if "-sweep=" in arg or "-prune=" in arg or "-reducer=" in arg:
+            flags.append(arg)
+            idx.append(i)
                 
         if "-mcdata" in arg:
             flags.append(arg)
@@ -315,6 +321,15 @@ def parse(args):
         if "-skip" in arg:
             flags.append(arg)
             idx.append(i)
+
+        if "-priority=" in arg:
+            try:
+                int(arg.split("=")[1])
+                flags.append(arg)
+                idx.append(i)
+            except ValueError:
+                print("Could not convert -priority value into an integer...please check argument.")
+                sys.exit(1)
             
     args = [args[i] for i in xrange(len(args)) if i not in set(idx)] # make a list excluding those in idx
     if len(args) > 0:
@@ -326,28 +341,24 @@ def parse(args):
 
 def send(commandList):
     """
-    Takes a MATCH command and sends it to a server and writes info to the local command.log file in the
-    working directory.
-    
-    Opens telnet connection useing "telnetlib" python package and sends the line to port 42424
+    Takes a list of MATCH commands and sends them to the server in one batch (see BatchSubmit.py), logging the job ID the server
+    queued each one as to the local send_log.
     """
     log = MyLogger.myLogger("send", toExecutable + "/logs/send_log")
-    HOST = HOST_IP_ADDRESS
-    #HOST = "10.155.88.139" # eagle
-    #HOST = "10.155.88.135" # astrolab18
-    #HOST = "10.155.88.133"
-    PORT = PORT_NUMBER
-
-    tn = telnetlib.Telnet(HOST, PORT)
-    #print("sleeping")
-    #time.sleep(1)
-    for command in commandList:
-        tn.write(command + "\r\n") # twisted server appears to need the \r\n at the end; write to port
-        log.info("Sent command: %s" % command)
-        time.sleep(0.5)
-
-    # close connection cleanly
-    tn.close()
+
+    def answered(command, answer):
+        if "error" in answer:
+            log.info("Server refused command (%s): %s" % (answer["error"], command))
+        elif "job" in answer:
+            log.info("Sent command as job %d: %s" % (answer["job"], command))
+        else:
+            log.info("Sent command: %s" % command)
+
+    try:
+        BatchSubmit.submit(commandList, HOST_IP_ADDRESS, PORT_NUMBER, window=SUBMIT_WINDOW, timeout=SUBMIT_TIMEOUT, answered=answered)
+    except BatchSubmit.SubmitError as e:
+        print("Sending failed:", e)
+        sys.exit(1)
 
 
 
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import itertools
+
+from MatchParam import MatchParam
+
+"""
+Synopsis
+--------
+The grid behind the custom flag -sweep.  A calcsfh command with
+
+    -sweep=m-M=24.0,24.2,24.4+Av=0.0:0.3:0.1+BF=0.3,0.35
+
+is turned into one fit for every cell of the grid made by the axes (separated by "+").  An axis is a MatchParam key with either a
+comma separated list of values or an inclusive lower:upper:step range.  Besides the MatchParam keys (Avmin, BF, dlogZ, ...) these
+axes are understood:
+
+    m-M, Av, logZ    fit at a single value by setting both the min and max of the range (eg m-Mmin and m-Mmax)
+    tbins            time bins of this width (in log years) over the span of the bins in the parameter file
+
+The parameter file of the command is parsed once and the parameter file of every cell is written from it in a single pass.  Cells are
+named after their values ("fit_m-M24-2_Av0-1") so a rerun of the same sweep writes the same files.
+
+"-prune=margin" lets the server drop queued cells that are clearly worse than the best fit so far.  Along every axis the best fit is
+assumed to get worse the further a cell is from the best cell, so once a finished cell is worse than the best by more than "margin"
+every queued cell behind it on that axis (further from the best, same values on every other axis) is pruned.  "-reducer=name" picks
+the group script run once every cell is done (see scripts/group_python_script.py).
+
+The object only does the bookkeeping; ServerMATCH.py queues the fits and reports their best fit values back.
+"""
+
+PAIRED = {"m-M": ("m-Mmin", "m-Mmax"), "Av": ("Avmin", "Avmax"), "logZ": ("logZmin", "logZmax")} # axes that fix a range to one value
+SWEEP_FLAGS = ("-sweep=", "-prune=", "-reducer=") # custom flags that never reach calcsfh
+
+
+class ParamSweep(object):
+    """
+    Fan out of a calcsfh command over a grid of parameter file values.
+    """
+    def __init__(self, line, name, reducer="sweep", margin=None):
+        self.line = line
+        self.name = name # group the fits belong to
+        self.reducer = reducer
+        self.margin = margin # prune cells worse than the best by more than this, None to never prune
+        self.axes = []
+        for arg in line.split():
+            if arg.startswith("-sweep="):
+                self.axes = parseSpec(arg[len("-sweep="):])
+            elif arg.startswith("-reducer="):
+                self.reducer = arg.split("=", 1)[1]
+            elif arg.startswith("-prune="):
+                self.margin = float(arg.split("=", 1)[1])
+        if len(self.axes) == 0:
+            raise ValueError("no -sweep axes in %s" % line)
+
+        args = line.split()
+        self._cd = args[:2] if args[0] == "cd" else []
+        self._args = args[len(self._cd):]
+        self.cwd = "/".join(self._args[1].split("/")[:-1]) + "/"
+        self.parameter = self._args[1].split("/")[-1]
+        self.baseName = self._args[4].split("/")[-1]
+        self.ssp = "-ssp" in self._args
+
+        self.cells = list(itertools.product(*[values for key, values in self.axes]))
+        self.commands = [self.command(cell) for cell in self.cells]
+        self.cellOf = dict(zip(self.commands, self.cells))
+        self.values = {} # cell -> best fit value of finished cells (infinity if the fit failed)
+        self.pruned = set() # cells that were dropped before they ran
+
+    def suffix(self, cell):
+        """
+        Returns the name suffix of a cell, eg "_m-M24-2_Av0-1".
+        """
+        return "".join("_%s%s" % (key.replace("(", "").replace(")", ""), ("%g" % value).replace(".", "-"))
+                       for (key, values), value in zip(self.axes, cell))
+
+    def command(self, cell):
+        """
+        Returns the calcsfh command that fits a cell.  The sweep flags become the custom flag -group=name.
+        """
+        suffix = self.suffix(cell)
+        args = list(self._args)
+        args[1] = self.cwd + self.parameter.rsplit(".", 1)[0] + suffix + ".param"
+        args[4] = self._args[4] + suffix
+        output = self._args[-1].split("/")
+        outputName = output[-1].split(".")
+        outputName[0] += suffix
+        output[-1] = ".".join(outputName)
+        args[-1] = "/".join(output)
+        args = [arg for arg in args if not arg.startswith(SWEEP_FLAGS)]
+        args.insert(-2, "-group=%s" % self.name)
+        return " ".join(self._cd + args)
+
+    def writeParams(self):
+        """
+        Writes the parameter file of every cell and returns the commands of the sweep.  Blocks on file IO, call it with
+        twisted.internet.threads.deferToThread.
+        """
+        param = MatchParam(self.cwd + self.parameter, ssp=self.ssp)
+        tstart = list(param.get("tstart"))
+        tend = list(param.get("tend"))
+        for key, values in self.axes:
+            if key not in PAIRED and key != "tbins" and key not in param.parameters:
+                raise KeyError("Can't sweep over %s, it is not a parameter file key" % key)
+        rows = []
+        for cell in self.cells:
+            row = {}
+            for (key, values), value in zip(self.axes, cell):
+                if key in PAIRED:
+                    row[PAIRED[key][0]] = value
+                    row[PAIRED[key][1]] = value
+                elif key == "tbins":
+                    start, end = timeBins(min(tstart), max(tend), value)
+                    row["Ntbins"] = len(start)
+                    row["tstart"] = start
+                    row["tend"] = end
+                else:
+                    row[key] = value
+            rows.append(row)
+        param.saveBatch(rows, path=self.cwd, names=[command.split()[len(self._cd) + 1].split("/")[-1] for command in self.commands])
+        return self.commands
+
+    def report(self, command, value):
+        """
+        Records the best fit value (None if the fit failed) of a finished cell.  Returns the commands of the cells that can be pruned
+        now and marks them pruned.
+        """
+        self.values[self.cellOf[command]] = float("inf") if value is None else value
+        if self.margin is None:
+            return []
+        prune = [cell for cell in self._prunable() if cell not in self.pruned]
+        self.pruned.update(prune)
+        return [self.command(cell) for cell in prune]
+
+    @property
+    def best(self):
+        """
+        (command, best fit value) of the best cell so far or None.
+        """
+        if len(self.values) == 0:
+            return None
+        cell = min(self.values, key=lambda cell: self.values[cell])
+        return (self.command(cell), self.values[cell])
+
+    def _prunable(self):
+        best = min(self.values, key=lambda cell: self.values[cell])
+        worse = [cell for cell in self.values if self.values[cell] > self.values[best] + self.margin]
+        prune = []
+        for cell in self.cells:
+            if cell in self.values or cell in self.pruned:
+                continue
+            for bad in worse:
+                differ = [i for i in range(len(cell)) if cell[i] != bad[i]]
+                if len(differ) != 1:
+                    continue
+                i = differ[0]
+                # bad lies between the best cell and this one
+                if (bad[i] - best[i])*(cell[i] - bad[i]) > 0:
+                    prune.append(cell)
+                    break
+        return prune
+
+
+def parseSpec(spec):
+    """
+    Parses "key=v1,v2+key=lower:upper:step" into a list of (key, list of values).
+    """
+    axes = []
+    for axis in spec.split("+"):
+        if "=" not in axis:
+            raise ValueError("sweep axis %s needs to be key=values" % axis)
+        key, values = axis.split("=", 1)
+        if ":" in values:
+            lower, upper, step = [float(value) for value in values.split(":")]
+            if step <= 0:
+                raise ValueError("sweep step of %s must be positive" % key)
+            count = int(round((upper - lower) / step)) + 1
+            values = [round(lower + i*step, 6) for i in range(count)]
+        else:
+            values = [float(value) for value in values.split(",")]
+        axes.append((key, values))
+    return axes
+
+def timeBins(first, last, width):
+    """
+    Returns (tstart, tend) of bins "width" wide from "first" to "last".  The last bin is cut short at "last".
+    """
+    start, end = [], []
+    edge = first
+    while edge < last - 1e-6:
+        start.append(round(edge, 6))
+        end.append(round(min(edge + width, last), 6))
+        edge += width
+    return start, end
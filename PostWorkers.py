@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+from collections import deque
+import json
+import os
+import resource
+import sys
+import time
+
+from twisted.internet import defer, protocol, reactor
+
+from ProcessEngine import ProcessResult
+
+"""
+Synopsis
+--------
+A pool of long lived post-processing workers (scripts/post_worker.py).  hybridMC_script.sh and group_script.sh end by starting a new
+Python that imports numpy, pandas, scipy, matplotlib and seaborn, which takes seconds for every fit or group.  A worker imports them
+once and then runs post-processing tasks ("hybridMC", "group") with the arguments the scripts got.
+
+call() hands a task to the next idle worker and returns a PostCall.  Like a ProcessHandle its "deferred" fires with a ProcessResult
+(the task's wall time, CPU time and peak memory as measured by the worker) and kill() stops it, so a PostTask can be run with
+MatchJob.run like any ProcessRunner and be canceled with its job.  The deferred fails with PostTaskFailed if the task raised and with
+WorkerUnavailable if no worker could run it (the task's modules are missing or the workers keep dying), in which case the caller runs
+the script instead.  A killed call fires with None.  A worker that dies is started again unless MAX_RESTARTS workers in a row died
+before answering anything; killed workers don't count.
+
+Everything here must be called from the reactor thread.
+"""
+
+MAX_RESTARTS = 3
+
+
+class WorkerUnavailable(Exception):
+    pass
+
+
+class PostTaskFailed(Exception):
+    pass
+
+
+class PostTask(object):
+    """
+    Runs the task "name" with "args" on a PostWorkerPool in place of a ProcessRunner's command (see MatchJob.run).
+    """
+    def __init__(self, pool, name, args):
+        self.pool = pool
+        self.name = name
+        self.args = args
+
+    def run(self, cpus=None):
+        """
+        Returns the PostCall of the task.  The workers were pinned when they were started so "cpus" is ignored.
+        """
+        return self.pool.call(self.name, self.args)
+
+    def _cleanup(self):
+        pass
+
+
+class PostCall(object):
+    """
+    A task handed to the pool, see call().
+    """
+    def __init__(self, pool, task, args):
+        self.pool = pool
+        self.task = task
+        self.args = args
+        self.deferred = defer.Deferred()
+        self.worker = None # PostWorker running the task
+        self.killed = False
+        self.pid = None # the workers share the server's process group, so there is none to measure (see pollMemory)
+
+    def kill(self):
+        if self.killed or self.deferred.called:
+            return
+        self.killed = True
+        self.pool._kill(self)
+
+
+class PostWorker(protocol.ProcessProtocol):
+    """
+    One worker process.  Answers are read line by line from its stdout, its stderr is passed on to the server's stdout.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.call = None # PostCall the worker is running
+        self.killed = False # sent SIGTERM to cancel its call
+        self._buffer = ""
+
+    def outReceived(self, data):
+        self._buffer += data
+        while "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            self.pool._answered(self, json.loads(line))
+
+    def errReceived(self, data):
+        sys.stdout.write(data)
+
+    def processEnded(self, reason):
+        self.pool._lost(self, reason)
+
+
+class PostWorkerPool(object):
+    """
+    "argv" starts a worker, eg ["python", "scripts/post_worker.py"], in the directory "cwd".  "size" workers run side by side.
+    """
+    def __init__(self, argv, size, cwd=None):
+        self.argv = list(argv)
+        self.size = max(size, 1)
+        self.cwd = cwd
+        self.workers = []
+        self.idle = []
+        self.waiting = deque() # PostCalls waiting for an idle worker
+        self.deaths = 0 # workers in a row that died before answering
+        self.stopping = False
+
+    def start(self):
+        for i in range(self.size):
+            self._spawn()
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            worker.transport.closeStdin() # the worker exits once stdin is closed
+
+    @property
+    def available(self):
+        return not self.stopping and self.deaths < MAX_RESTARTS
+
+    def call(self, task, args):
+        """
+        Runs a task on the next idle worker and returns its PostCall.
+        """
+        call = PostCall(self, task, args)
+        if not self.available:
+            call.deferred.errback(WorkerUnavailable("the post-processing workers keep dying"))
+            return call
+        self.waiting.append(call)
+        self._next()
+        return call
+
+    def _spawn(self):
+        worker = PostWorker(self)
+        reactor.spawnProcess(worker, self.argv[0], self.argv, env=os.environ, path=self.cwd)
+        self.workers.append(worker)
+        self.idle.append(worker)
+        self._next()
+
+    def _next(self):
+        while len(self.idle) > 0 and len(self.waiting) > 0:
+            worker = self.idle.pop()
+            call = self.waiting.popleft()
+            worker.call, call.worker = call, worker
+            worker.transport.write(json.dumps({"task": call.task, "args": call.args}) + "\n")
+
+    def _kill(self, call):
+        if call in self.waiting:
+            self.waiting.remove(call)
+            call.deferred.callback(None)
+        elif call.worker is not None and not call.worker.killed:
+            call.worker.killed = True
+            call.worker.transport.signalProcess("TERM") # the call fires when the worker is lost
+
+    def _answered(self, worker, answer):
+        self.deaths = 0
+        call, worker.call = worker.call, None
+        if not worker.killed:
+            self.idle.append(worker)
+        if call.killed:
+            call.deferred.callback(None)
+        elif answer["ok"]:
+            call.deferred.callback(_result(worker, answer))
+        elif answer.get("unavailable"):
+            call.deferred.errback(WorkerUnavailable(answer["error"]))
+        else:
+            call.deferred.errback(PostTaskFailed(answer["error"]))
+        self._next()
+
+    def _lost(self, worker, reason):
+        self.workers.remove(worker)
+        if worker in self.idle:
+            self.idle.remove(worker)
+        if worker.call is not None:
+            call, worker.call = worker.call, None
+            if call.killed:
+                call.deferred.callback(None)
+            else:
+                call.deferred.errback(WorkerUnavailable("post-processing worker died: %s" % reason.getErrorMessage()))
+        if self.stopping:
+            return
+        if not worker.killed:
+            self.deaths += 1
+        if self.available:
+            self._spawn()
+        elif len(self.workers) == 0:
+            while len(self.waiting) > 0:
+                self.waiting.popleft().deferred.errback(WorkerUnavailable("the post-processing workers keep dying"))
+
+
+def _result(worker, answer):
+    """
+    Makes a ProcessResult out of the times and memory a worker answered a task with.
+    """
+    ended = time.time()
+    rusage = resource.struct_rusage((answer["utime"], answer["stime"], answer["maxrss"]) + (0,)*13)
+    return ProcessResult(worker.transport.pid, 0, rusage, ended - answer["wall"], ended)
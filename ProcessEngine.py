@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import glob
+import os
+import signal
+import subprocess
+import time
+
+from twisted.internet import defer
+from twisted.internet import process
+from twisted.internet import threads
+
+from ProcessStage import STDOUT
+from ProcessStage import Stage
+from ProcessStage import skipLines
+
+"""
+Synopsis
+--------
+This is where the processes built by the classes in Calcsfh.py are actually run.  Nothing here polls a process or parks a thread on
+one.  Every spawned process is handed to Twisted's SIGCHLD reaper (the same one "reactor.spawnProcess" uses) and is reaped with
+os.wait4 the moment it exits, which fires a Deferred carrying the exit status and the resource usage of the process.
+
+Everything in this module must be called from the reactor thread.
+
+Processes are started straight from an argv list (a Stage), never through a shell.  Output files are opened here and handed to the
+process as its stdout/stderr, and a stage can have its stdin fed from a thread (eg skipLines) instead of a temporary file.
+
+Stage, STDOUT and skipLines are defined in ProcessStage.py, which doesn't need Twisted, and can be imported from here too.
+
+Classes
+-------
+ProcessHandle : A running process.  Its "deferred" fires with a ProcessResult when the process exits (or fails with ProcessLost if
+                its exit status was taken by someone else).
+ProcessResult : Exit status, resource usage and wall times of a reaped process.
+processGroupMemory : Resident memory of every process group, read from /proc.
+numaNodes : The CPUs of every NUMA node, read from /sys.
+MatchJob : Takes the place of a thread per fit.  A job runs the commands of a ProcessRunner one after another by chaining Deferreds
+           and can be canceled at any time, which kills the running process group right away.
+"""
+
+
+def _feed(feed, pipe):
+    """
+    Runs a Stage feed in a thread.  A process that exits (or is killed) before reading everything just closes the pipe.
+    """
+    try:
+        feed(pipe)
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        try:
+            pipe.close()
+        except IOError:
+            pass
+
+
+class ProcessCanceled(Exception):
+    """This is raised down a job's Deferred chain when the job was canceled.
+    """
+    pass
+
+
+class ProcessLost(Exception):
+    """This is raised down a job's Deferred chain when a process's exit status could not be read, so whether it worked is unknown.
+    """
+    pass
+
+
+class ProcessResult(object):
+    """
+    Holds what is known about a process after it has been reaped.
+    """
+    def __init__(self, pid, status, rusage, started, ended):
+        self.pid = pid
+        self.status = status # raw status from wait4
+        self.rusage = rusage # None when the process exited before it could be handed to the reaper
+        self.started = started
+        self.ended = ended
+
+    @property
+    def returncode(self):
+        """
+        Same convention as subprocess: negative numbers are the signal that killed the process.
+        """
+        if os.WIFSIGNALED(self.status):
+            return -os.WTERMSIG(self.status)
+        return os.WEXITSTATUS(self.status)
+
+    @property
+    def wallTime(self):
+        return self.ended - self.started
+
+
+class ProcessHandle(object):
+    """
+    Wraps a started process.  Twisted calls reapProcess on every SIGCHLD it receives so the exit is seen immediately.
+    """
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.pid = pipe.pid # also the process group id since every process is started with os.setsid
+        self.started = time.time()
+        self.deferred = defer.Deferred()
+        self._registered = False
+
+    def kill(self, sig=signal.SIGTERM):
+        """
+        Kills the whole process group (eg the shell and the MATCH program it started).
+        """
+        try:
+            os.killpg(self.pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH: # already gone
+                raise
+
+    def reapProcess(self):
+        """
+        Called by Twisted's reaper (twisted.internet.process.reapAllProcesses) whenever a child exits.
+        """
+        try:
+            pid, status, rusage = os.wait4(self.pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            # reaped elsewhere so the exit status is lost, the stage may not have finished its output
+            self._unregister()
+            self.pipe.returncode = -1 # so subprocess doesn't try to reap it either
+            self.deferred.errback(ProcessLost("exit status of process %d was lost, it was reaped elsewhere" % self.pid))
+            return True
+
+        if pid == 0: # still running
+            return False
+
+        self._unregister()
+        self._ended(status, rusage)
+        return True
+
+    def processEnded(self, status):
+        """
+        Called by Twisted instead of reapProcess if the process exited in the short window between our first check and registering it.
+        """
+        self._ended(status, None)
+
+    def _unregister(self):
+        if self._registered:
+            process.unregisterReapProcessHandler(self.pid, self)
+            self._registered = False
+
+    def _ended(self, status, rusage):
+        result = ProcessResult(self.pid, status, rusage, self.started, time.time())
+        # let subprocess know this pid is gone so it never tries to reap it again
+        self.pipe.returncode = result.returncode
+        self.deferred.callback(result)
+
+
+def spawn(stage, preexec_fn=os.setsid, cpus=None):
+    """
+    Starts a Stage in its own process group and returns a ProcessHandle.  If "cpus" (a list of CPU numbers) is given the process, and
+    everything it starts, is pinned to those CPUs.
+    """
+    if cpus is not None:
+        preexec_fn = _pinned(preexec_fn, cpus)
+    files = [] # our copies of the files handed to the process, closed once it has them
+    try:
+        stdin = subprocess.PIPE if stage.feed is not None else _open(stage.stdin, 'rb', files)
+        stdout = _open(stage.stdout, 'wb', files)
+        stderr = stage.stderr if stage.stderr == STDOUT and stdout is not None else _open(stage.stderr, 'wb', files)
+        pipe = subprocess.Popen(stage.argv, cwd=stage.cwd, stdin=stdin, stdout=stdout, stderr=stderr, close_fds=True,
+                                preexec_fn=preexec_fn)
+    finally:
+        for f in files:
+            f.close()
+    if stage.feed is not None:
+        threads.deferToThread(_feed, stage.feed, pipe.stdin).addErrback(
+            lambda failure: print("Feeding %s failed: %s" % (stage, failure.getErrorMessage())))
+    handle = ProcessHandle(pipe)
+    # check once ourselves so a process that has already exited still reports its resource usage
+    if not handle.reapProcess():
+        handle._registered = True
+        process.registerReapProcessHandler(handle.pid, handle)
+    return handle
+
+
+def _open(name, mode, files):
+    if name is None or name == STDOUT:
+        return None
+    f = open(name, mode)
+    files.append(f)
+    return f
+
+def _pinned(preexec_fn, cpus):
+    """
+    Returns a preexec_fn that calls "preexec_fn" and then sets the CPU affinity of the child.  os.sched_setaffinity only exists on
+    Python 3 so on Python 2 sched_setaffinity is called from libc.  The mask is built here, before the fork.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        def preexec():
+            preexec_fn()
+            os.sched_setaffinity(0, cpus)
+        return preexec
+
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    bits = 8*ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (max(cpus)//bits + 1))()
+    for cpu in cpus:
+        mask[cpu//bits] |= 1 << (cpu % bits)
+    def preexec():
+        preexec_fn()
+        if _libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+            raise OSError(ctypes.get_errno(), "sched_setaffinity failed")
+    return preexec
+
+_libc = None
+
+
+def parseCpuList(cpulist):
+    """
+    Turns a Linux CPU list like "0-3,8,10-11" into a list of CPU numbers.
+    """
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if part == "":
+            continue
+        if "-" in part:
+            low, high = part.split("-")
+            cpus.extend(range(int(low), int(high) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def numaNodes():
+    """
+    Returns a list with the CPUs of each NUMA node in node order.  Empty if the system doesn't report its nodes.
+    """
+    nodes = []
+    paths = glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    for path in sorted(paths, key=lambda path: int(path.split("/")[-2][4:])):
+        f = open(path, 'r')
+        cpus = parseCpuList(f.read())
+        f.close()
+        if len(cpus) > 0: # memory only nodes have no CPUs
+            nodes.append(cpus)
+    return nodes
+
+def processGroupMemory():
+    """
+    Returns a dictionary of process group id -> resident memory in bytes summed over the processes in the group.  Since every process
+    is spawned with os.setsid the group id of a job's process is its pid.  Returns an empty dictionary where there is no /proc.
+    """
+    pageSize = os.sysconf("SC_PAGE_SIZE")
+    groups = {}
+    try:
+        pids = [pid for pid in os.listdir("/proc") if pid.isdigit()]
+    except OSError:
+        return groups
+    for pid in pids:
+        try:
+            f = open("/proc/%s/stat" % pid, 'r')
+            stat = f.read()
+            f.close()
+        except IOError: # exited while we were looking
+            continue
+        fields = stat[stat.rfind(")") + 2:].split() # the command name may contain spaces
+        pgid = int(fields[2])
+        groups[pgid] = groups.get(pgid, 0) + int(fields[21])*pageSize
+    return groups
+
+
+class MatchJob(object):
+    """
+    This takes the place of a MatchThread.  "target" is called with the job as its first argument followed by "args" and returns a
+    Deferred (see CommandMethods in ServerMATCH.py).  The target runs each command with job.run(runner) so the job knows which process
+    to kill when it is canceled.
+    """
+    def __init__(self, line, target=None, args=(), name=None, jobId=None):
+        self.command = line # Saves the command sent to this job
+        self.name = name # slot the job runs in
+        self.id = jobId # stable job ID handed out by the JobRegistry
+        self.canceled = False # This gets set to True if the job is to be canceled
+        self.process = None # ProcessHandle of the currently running command
+        self.cpus = None # CPUs the slot's processes are pinned to, None to let them float
+        self._target = target
+        self._args = args
+
+    def start(self):
+        """
+        Calls the target and returns a Deferred that fires when the whole job is done.
+        """
+        return defer.maybeDeferred(self._target, self, *self._args)
+
+    def run(self, runner, cpus=None):
+        """
+        Runs the current command of the passed in ProcessRunner pinned to "cpus" (the job's own CPUs by default).  The returned
+        Deferred fires with a ProcessResult when the command exits or fails with ProcessCanceled if the job was canceled.
+        """
+        if self.canceled:
+            return defer.fail(ProcessCanceled(self.command))
+
+        self.process = runner.run(self.cpus if cpus is None else cpus)
+        d = self.process.deferred
+        d.addCallback(self._processEnded, runner)
+        return d
+
+    def cancel(self):
+        """
+        Kills the running process, if any, and stops the rest of the job's commands from running.
+        """
+        self.canceled = True
+        if self.process is not None:
+            self.process.kill()
+
+    def _processEnded(self, result, runner):
+        self.process = None
+        if self.canceled:
+            print("CANCELED", self.name)
+            runner._cleanup()
+            raise ProcessCanceled(self.command)
+        return result
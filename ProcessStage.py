@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import pipes
+import shutil
+import subprocess
+
+"""
+Synopsis
+--------
+The commands the classes in Calcsfh.py build, kept apart from ProcessEngine.py (which runs them) so Calcsfh.py can be imported without
+Twisted, eg by the group scripts on Condor execute hosts.
+
+Classes
+-------
+Stage : One command: argv, working directory and the files its stdin/stdout/stderr are connected to.
+skipLines : A Stage feed that writes a file without its first lines.
+"""
+
+
+STDOUT = subprocess.STDOUT # pass as a Stage's stderr to send it to the same file as stdout (like "&>")
+
+
+class Stage(object):
+    """
+    One command of a job run without a shell.  "argv" is the program and its arguments, "cwd" the directory it runs in.  stdin, stdout
+    and stderr are file names (stdout is truncated first, stderr may be STDOUT) or None to use the server's.  "feed" is a function
+    that is handed the write end of a pipe to the process's stdin and is run in a thread (see skipLines).  "shell" is how the stage is
+    written as a shell command when that can't be worked out from the rest (ie when there is a feed).
+    """
+    def __init__(self, argv, cwd=None, stdin=None, stdout=None, stderr=None, feed=None, shell=None):
+        self.argv = [str(arg) for arg in argv]
+        self.cwd = cwd
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.feed = feed
+        self.shell = shell
+
+    def __str__(self):
+        """
+        The stage as a shell command, in the "command > output 2>&1" form scripts/condor_python_script.py expects.
+        """
+        if self.shell is not None:
+            return self.shell
+        s = " ".join(pipes.quote(arg) for arg in self.argv)
+        if self.cwd is not None:
+            s = "cd %s; %s" % (pipes.quote(self.cwd), s)
+        if self.stdin is not None:
+            s += " < %s" % pipes.quote(self.stdin)
+        if self.stdout is not None:
+            s += " > %s" % pipes.quote(self.stdout)
+        if self.stderr == STDOUT:
+            if self.stdout is not None: # else both go to the server's stdout, see ProcessEngine.spawn
+                s += " 2>&1"
+        elif self.stderr is not None:
+            s += " 2> %s" % pipes.quote(self.stderr)
+        return s
+
+    def __repr__(self):
+        return "Stage(%r, cwd=%r, stdout=%r)" % (self.argv, self.cwd, self.stdout)
+
+
+def skipLines(path, count):
+    """
+    Returns a Stage feed that writes the file at "path" without its first "count" lines (like "tail -n +<count + 1>").
+    """
+    def feed(out):
+        f = open(path, 'rb')
+        for i in range(count):
+            f.readline()
+        shutil.copyfileobj(f, out, 1 << 16)
+        f.close()
+    return feed
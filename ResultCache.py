@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import errno
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+
+"""
+Synopsis
+--------
+A content addressed cache of finished calcsfh runs.  Resubmitting the same fit (same parameter, photometry, fake and background file
+contents and the same MATCH flags) is answered by copying the outputs of the earlier run instead of spending hours recomputing it.
+
+The key of a run is a SHA-1 over the contents of its input files and its normalized flags (custom flags like -group and -skip are
+dropped, flag values are compared as numbers).  Hashing a file is remembered by path, size and modification time so a large fake file
+shared by many fits is only read once.  Each entry is a directory named by its key holding copies of the fit, ".cmd", ".co" and
+".zc" (".ssp" for -ssp runs) files.  Entries are copied in and out rather than hard linked so rerunning a fit in place can never
+change what is in the cache.
+
+An index (SQLite) keeps the size and last use of every entry and the least recently used entries are evicted once the cache grows
+past its size cap.
+
+All methods block on file IO and are meant to be called with twisted.internet.threads.deferToThread.  They are thread safe.
+"""
+
+CUSTOM_FLAGS = ("-group", "-priority", "-skip") # flags only the server uses, they don't change what calcsfh computes
+HASH_BLOCK = 1 << 20
+
+
+class ResultCache(object):
+    """
+    Stores and restores the outputs of calcsfh runs keyed by the contents of their inputs.
+    """
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._hashes = {} # (path, size, mtime) -> sha1 of the file contents
+        self._db = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, used REAL)")
+        self._db.commit()
+
+    def key(self, calcsfh):
+        """
+        Returns the cache key of a DefaultCalcsfh (or SSPCalcsfh) object.
+        """
+        sha = hashlib.sha1()
+        inputs = [calcsfh.parameter, calcsfh.phot, calcsfh.fake]
+        background = self._background(calcsfh.cwd + calcsfh.parameter)
+        if background is not None:
+            inputs.append(background)
+        for name in inputs:
+            sha.update(self._hashFile(calcsfh.cwd + name).encode("ascii"))
+        sha.update(" ".join(normalizeFlags(calcsfh.flags)).encode("ascii"))
+        return sha.hexdigest()
+
+    def fetch(self, key, calcsfh):
+        """
+        Copies the cached outputs of "key" to the output names of calcsfh.  Returns True on a hit.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT key FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return False
+            entry = os.path.join(self.directory, key)
+            try:
+                for i, name in enumerate(calcsfh.outputFiles()):
+                    shutil.copyfile(os.path.join(entry, str(i)), calcsfh.cwd + name)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._remove(key) # entry was damaged
+                return False
+            self._db.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return True
+
+    def store(self, key, calcsfh):
+        """
+        Copies the outputs of a finished run into the cache and evicts old entries if the cache is over its size.
+        """
+        with self._lock:
+            entry = os.path.join(self.directory, key)
+            temp = entry + ".tmp"
+            if os.path.isdir(temp):
+                shutil.rmtree(temp)
+            os.makedirs(temp)
+            size = 0
+            for i, name in enumerate(calcsfh.outputFiles()):
+                path = calcsfh.cwd + name
+                if not os.path.isfile(path): # run didn't finish properly so don't cache it
+                    shutil.rmtree(temp)
+                    return False
+                shutil.copyfile(path, os.path.join(temp, str(i)))
+                size += os.path.getsize(path)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(temp, entry)
+            self._db.execute("INSERT OR REPLACE INTO entries (key, size, used) VALUES (?, ?, ?)", (key, size, time.time()))
+            self._evict()
+            self._db.commit()
+            return True
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while total > self.maxBytes:
+            key, size = self._db.execute("SELECT key, size FROM entries ORDER BY used LIMIT 1").fetchone()
+            self._remove(key)
+            total -= size
+
+    def _remove(self, key):
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+        self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._db.commit()
+
+    def _hashFile(self, path):
+        st = os.stat(path)
+        memo = (path, st.st_size, st.st_mtime)
+        with self._lock:
+            if memo in self._hashes:
+                return self._hashes[memo]
+        sha = hashlib.sha1()
+        f = open(path, 'rb')
+        block = f.read(HASH_BLOCK)
+        while block:
+            sha.update(block)
+            block = f.read(HASH_BLOCK)
+        f.close()
+        with self._lock:
+            self._hashes[memo] = sha.hexdigest()
+        return self._hashes[memo]
+
+    def _background(self, paramPath):
+        """
+        Returns the background file named on the last line of a parameter file (eg "-1 1 -1bg.phot") or None.
+        """
+        f = open(paramPath, 'r')
+        lines = [line.split() for line in f if line.strip() != ""]
+        f.close()
+        if len(lines) == 0 or len(lines[-1]) != 3:
+            return None
+        name = re.sub(r"^(scale|-?[0-9.]+)", "", lines[-1][2])
+        if name != "" and os.path.isfile(os.path.join(os.path.dirname(paramPath), name)):
+            return name
+        return None
+
+
+def normalizeFlags(flags):
+    """
+    Drops custom flags and writes flag values as floats when they are numbers so "-dAv=0.1" and "-dAv=0.100" are the same.
+    """
+    normalized = []
+    for flag in flags:
+        name = flag.split("=")[0]
+        if name in CUSTOM_FLAGS:
+            continue
+        if "=" in flag:
+            value = flag.split("=", 1)[1]
+            try:
+                value = repr(float(value))
+            except ValueError:
+                pass
+            flag = "%s=%s" % (name, value)
+        normalized.append(flag)
+    return sorted(normalized)
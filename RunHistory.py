@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import os
+import sqlite3
+import threading
+
+from ResultCache import CUSTOM_FLAGS
+
+"""
+Synopsis
+--------
+Learns how long fits take so the scheduler (see JobRegistry.py) can run the quick ones first.
+
+A fit is described by its features: the size of its parameter file grid (the number of m-M, Av and logZ steps multiplied together),
+its number of time bins, the number of stars in its fake file and the set of MATCH flags it uses (flag names only, "-dAv=0.1" and
+"-dAv=0.3" cost the same, and the server's own flags like -group= are left out).  They are taken from the words of the command and
+the header of its parameter file, which is all that is read of it, so working them out for every queued fit stays cheap.  The
+runtime of every finished fit is folded into an exponential moving average stored for its exact features.  A fit that has never been seen is estimated from the seconds per unit of work (grid size * time bins * fake stars) of fits
+with the same flags, then of all fits, and finally falls back to the default runtime.
+
+Every stage of a job (calcsfh, zcombine, the post-processing scripts, ...) is recorded too: its wall time, CPU time and peak resident
+memory as reported by os.wait4 for the stage's process and everything it waited on.  To keep the database small one row is kept per
+features and stage holding the number of runs, moving averages of the wall and CPU times and the largest peak memory seen.
+
+The peak memory of a fit is estimated the same way as its runtime from its calcsfh stages only (the post-processing runs outside its
+slot): the largest peak seen for its exact features, otherwise the largest bytes per fake star of fits with the same flags (then of all
+fits) times its number of fake stars, and finally the default memory.
+
+The history is kept in SQLite.  Methods read files and the database and are meant to be called with
+twisted.internet.threads.deferToThread.  They are thread safe.
+"""
+
+LEARNING_RATE = 0.3 # weight of the newest runtime in the moving average
+
+
+class RunHistory(object):
+    """
+    Runtime model of calcsfh commands.
+    """
+    def __init__(self, fileName, defaultRuntime=3600.0, defaultMemory=2**30):
+        self.fileName = fileName
+        self.defaultRuntime = defaultRuntime
+        self.defaultMemory = defaultMemory
+        self._lock = threading.Lock()
+        self._fakeCounts = {} # (path, size, mtime) -> number of fake stars
+        self._db = sqlite3.connect(fileName, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS runtimes (features TEXT PRIMARY KEY, flags TEXT, work REAL, seconds REAL, "
+                         "runs INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS stages (features TEXT, stage TEXT, runs INTEGER, wall REAL, cpu REAL, maxrss INTEGER, "
+                         "PRIMARY KEY (features, stage))")
+        self._db.commit()
+
+    def features(self, command):
+        """
+        Returns (grid size, time bins, fake stars, flags) of a calcsfh command or None if it isn't one or its files can't be read.
+        """
+        args = command.split()
+        if len(args) < 5 or args[0] != "calcsfh":
+            return None
+        # the files are found like DefaultCalcsfh does: in the directory of the parameter file
+        cwd = os.path.dirname(args[1])
+        try:
+            grid, tbins = _header(args[1])
+            fakes = self._countFakes(os.path.join(cwd, os.path.basename(args[3])))
+        except (EnvironmentError, ValueError, IndexError) as e:
+            print("Can't estimate the runtime of %s: %s" % (command, e))
+            return None
+        flags = " ".join(sorted(set(flag.split("=")[0] for flag in args[5:-2]) - set(CUSTOM_FLAGS)))
+        return (grid, tbins, fakes, flags)
+
+    def estimate(self, features):
+        """
+        Returns the expected runtime in seconds of a command with these features.
+        """
+        if features is None:
+            return self.defaultRuntime
+        grid, tbins, fakes, flags = features
+        with self._lock:
+            row = self._db.execute("SELECT seconds FROM runtimes WHERE features = ?", (_key(features),)).fetchone()
+            if row is not None:
+                return row[0]
+            rate = self._db.execute("SELECT SUM(seconds) / SUM(work) FROM runtimes WHERE flags = ?", (flags,)).fetchone()[0]
+            if rate is None:
+                rate = self._db.execute("SELECT SUM(seconds) / SUM(work) FROM runtimes").fetchone()[0]
+        if rate is None:
+            return self.defaultRuntime
+        return rate * _work(features)
+
+    def memory(self, features):
+        """
+        Returns the expected peak memory in bytes of a command with these features.
+        """
+        if features is None:
+            return self.defaultMemory
+        with self._lock:
+            row = self._db.execute("SELECT maxrss FROM stages WHERE features = ? AND stage = 'calcsfh'", (_key(features),)).fetchone()
+            if row is not None:
+                return row[0]
+            rows = self._db.execute("SELECT features, maxrss FROM stages WHERE features != '' AND stage = 'calcsfh'").fetchall()
+        perFake = {} # flags -> largest bytes per fake star
+        for key, maxrss in rows:
+            grid, tbins, fakes, flags = _unkey(key)
+            perFake[flags] = max(perFake.get(flags, 0.0), maxrss / max(fakes, 1))
+        if features[3] in perFake:
+            return int(perFake[features[3]] * max(features[2], 1))
+        if len(perFake) > 0:
+            return int(max(perFake.values()) * max(features[2], 1))
+        return self.defaultMemory
+
+    def expected(self, command):
+        """
+        Returns (expected runtime in seconds, expected peak memory in bytes) of a command.
+        """
+        features = self.features(command)
+        return self.estimate(features), self.memory(features)
+
+    def learn(self, features, seconds):
+        """
+        Folds the runtime of a finished command into the history.
+        """
+        if features is None:
+            return
+        key = _key(features)
+        with self._lock:
+            row = self._db.execute("SELECT seconds, runs FROM runtimes WHERE features = ?", (key,)).fetchone()
+            if row is None:
+                self._db.execute("INSERT INTO runtimes (features, flags, work, seconds, runs) VALUES (?, ?, ?, ?, 1)",
+                                 (key, features[3], _work(features), seconds))
+            else:
+                self._db.execute("UPDATE runtimes SET seconds = ?, runs = ? WHERE features = ?",
+                                 ((1 - LEARNING_RATE)*row[0] + LEARNING_RATE*seconds, row[1] + 1, key))
+            self._db.commit()
+
+    def recordStage(self, features, stage, result):
+        """
+        Folds the wall time, CPU time and peak memory of a finished stage (a ProcessResult) into the history.  "features" may be None
+        for jobs that aren't fits (eg sleep).
+        """
+        if result is None or result.rusage is None:
+            return
+        key = "" if features is None else _key(features)
+        cpu = result.rusage.ru_utime + result.rusage.ru_stime
+        maxrss = result.rusage.ru_maxrss * 1024 # Linux reports kilobytes
+        with self._lock:
+            row = self._db.execute("SELECT runs, wall, cpu, maxrss FROM stages WHERE features = ? AND stage = ?", (key, stage)).fetchone()
+            if row is None:
+                self._db.execute("INSERT INTO stages (features, stage, runs, wall, cpu, maxrss) VALUES (?, ?, 1, ?, ?, ?)",
+                                 (key, stage, result.wallTime, cpu, maxrss))
+            else:
+                self._db.execute("UPDATE stages SET runs = ?, wall = ?, cpu = ?, maxrss = ? WHERE features = ? AND stage = ?",
+                                 (row[0] + 1, (1 - LEARNING_RATE)*row[1] + LEARNING_RATE*result.wallTime,
+                                  (1 - LEARNING_RATE)*row[2] + LEARNING_RATE*cpu, max(row[3], maxrss), key, stage))
+            self._db.commit()
+
+    def stages(self, features):
+        """
+        Returns a dictionary of stage -> (runs, wall seconds, CPU seconds, peak memory in bytes) for commands with these features.
+        """
+        key = "" if features is None else _key(features)
+        with self._lock:
+            rows = self._db.execute("SELECT stage, runs, wall, cpu, maxrss FROM stages WHERE features = ?", (key,)).fetchall()
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def _countFakes(self, path):
+        st = os.stat(path)
+        memo = (path, st.st_size, st.st_mtime)
+        with self._lock:
+            if memo in self._fakeCounts:
+                return self._fakeCounts[memo]
+        f = open(path, 'rb')
+        count = sum(1 for line in f)
+        f.close()
+        with self._lock:
+            self._fakeCounts[memo] = count
+        return count
+
+
+def _header(path):
+    """
+    Returns (grid size, time bins) of a parameter file, reading only up to its Ntbins line (see MatchParam._parseDefault for the layout).
+    """
+    f = open(path, 'r')
+    try:
+        line = lambda: f.readline().split()
+        mM = list(map(float, line()))
+        logZ = list(map(float, line()))
+        line() # BF Bad0 Bad1
+        ncmds = int(float(line()[0]))
+        filters = set()
+        for i in range(ncmds):
+            filters.update(line()[5].split(","))
+        for i in range(len(filters) + ncmds): # filter limits then exclude/combine gates
+            line()
+        tbins = int(line()[0])
+    finally:
+        f.close()
+    grid = _steps(mM[0], mM[1], mM[2]) * _steps(mM[3], mM[4], mM[5]) * _steps(logZ[0], logZ[1], logZ[2])
+    return grid, tbins or 1
+
+def _steps(low, high, step):
+    if low is None or high is None or not step:
+        return 1
+    return int(round((high - low) / step)) + 1
+
+def _work(features):
+    grid, tbins, fakes, flags = features
+    return float(grid * tbins * max(fakes, 1))
+
+def _key(features):
+    return "%d %d %d %s" % features
+
+def _unkey(key):
+    grid, tbins, fakes, flags = (key.split(" ", 3) + [""])[:4]
+    return (int(grid), int(tbins), int(fakes), flags)
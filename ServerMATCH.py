@@ -3,28 +3,43 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
 
-import getpass
+import heapq
+import json
 import multiprocessing
 import os
-from Queue import Queue
-import signal
-import subprocess
+from Queue import Empty
 import sys
-import thread
-import threading
 import time
 
 from twisted.protocols import basic
-from twisted.internet import protocol, reactor
-from threading import Thread
+from twisted.internet import defer, protocol, reactor, task, threads
 
 from UserParameters import *
 import MyLogger
 from Calcsfh import DefaultCalcsfh
 from Calcsfh import GroupProcess
-from Calcsfh import MatchThread
+from Calcsfh import ProcessRunner
 from Calcsfh import Sleep
+from Calcsfh import SpeculativeRun
 from Calcsfh import SSPCalcsfh
+from CondorBackend import CondorBackend
+from CondorBackend import planSpill
+from DAvSearch import DAvSearch
+from JobJournal import FINISHED
+from JobGroup import JobGroup
+from JobJournal import JobJournal
+from JobRegistry import JobRegistry
+from ParamSweep import ParamSweep
+from PostWorkers import PostTask
+from PostWorkers import PostTaskFailed
+from PostWorkers import PostWorkerPool
+from PostWorkers import WorkerUnavailable
+from ProcessEngine import MatchJob
+from ProcessEngine import ProcessCanceled
+from ProcessEngine import numaNodes
+from ProcessEngine import processGroupMemory
+from ResultCache import ResultCache
+from RunHistory import RunHistory
 
 """
 This server runs on port 42424
@@ -37,27 +52,33 @@ This server runs on port 42424
 #MAX_CONDOR_SIZE = 3000 # this controlls the maximum size of a condor run
 #CONDOR_ON = True
 
-workQueue = Queue()
-activeThreads = {} # this should only every be one more larger than the number of CPUs on the system.
-                   # main thread handles incoming data and one thread waits on events and the other threads
-                   # execute the bash commands.
-dAvRangeThreads = {}
-dAvRangeGroup = {} # dictionary that holds a dictionary of commands
-doneThreads = Queue()
-
-# Events for watchdogs
-watcherEvent = threading.Event() # a single thread waits for set to join a certain thread
-condorEvent = threading.Event() # activates the condor thread
+workQueue = JobRegistry(SCHEDULER_AGING, DEFAULT_RUNTIME, DEFAULT_JOB_MEMORY) # queued commands and running jobs, shortest job first
+SHOW_PAGE_SIZE = 200 # number of queued commands listed per page by "show queue <page>"
+journal = None # JobJournal, opened when the server starts
+resultCache = None # ResultCache of finished fits, None if RESULT_CACHE_ON is False
+history = None # RunHistory that estimates how long queued commands will take, opened when the server starts
+liveMemory = {} # job ID -> resident memory in bytes of its process group, measured by pollMemory
+slotCpus = {} # slot number -> list of CPUs its processes are pinned to, see makeCpuMap
+postCpus = None # CPUs the post-processing stages are pinned to, None to let them float
+POST_STAGES = ("zcombine", "sspcombine", "processFit", "group") # stages that run on postCpus
+postPool = defer.DeferredSemaphore(POST_PROCESS_SLOTS) # post-processing runs outside the fit slots, at most this many at a time
+postWorkers = None # PostWorkerPool the post-processing runs in, None if POST_WORKERS is False
+activeJobs = {} # this should never be larger than the number of cores given to the server.  Jobs don't hold a thread, the
+                # reactor starts their processes and is told the moment one exits (see ProcessEngine.py).
+groups = {} # group name -> JobGroup of the groups whose group script hasn't finished
+condor = None # CondorBackend, None if CONDOR_ON is False
+condorCall = None # pending call of submitCondor, see wakeCondor
+condorSubmitting = False # a batch is being submitted
 
 log = MyLogger.myLogger("MatchServer", "server")
 
 def getThreadNumber():
-    print(activeThreads)
+    print(activeJobs)
     num = None
-    if len(activeThreads) == 0: # no threads yet
+    if len(activeJobs) == 0: # no jobs yet
         num = '1'
-    else: # get the thread number that is missing in the range of 1 to 8
-        keys = activeThreads.keys()
+    else: # get the slot number that is missing in the range of 1 to 8
+        keys = activeJobs.keys()
         print(keys)
         keys = map(int, keys)
         keys = sorted(keys, key=int)
@@ -71,33 +92,58 @@ def getThreadNumber():
         num = count
     return num
 
-def getdAvName():
-    print(dAvRangeThreads)
-    num = None
-    grouped = dAvRangeGroup.keys()
-    grouped = [key for key in grouped if "dAv" in key]
-    if len(dAvRangeThreads) == 0 and len(grouped) == 0: # no threads yet
-        num = '1'
-    else: # get the thread number that is missing in the range of 1 to 8
-        keys = []
-        if len(dAvRangeThreads) != 0:
-            keys += dAvRangeThreads.keys()
-        if len(grouped) != 0:
-            keys += grouped
-        
-        keys = [key.split("_")[-1] for key in keys]
-        print(keys)
-        keys = map(int, keys)
-        keys = sorted(keys, key=int)
-        print(keys)
-        count = 1
-        for name in keys:
-            if count == name:
-                count += 1 
-            else:
-                break
-        num = count
-    return int(num)
+def makeCpuMap():
+    """
+    Fills slotCpus and postCpus from CPU_AFFINITY and POST_PROCESS_CPUS (see UserParameters.py).  With CPU_AFFINITY = "numa" the
+    slots are spread round robin over the NUMA nodes and each slot may use any CPU of its node (except the post-processing CPUs).
+    """
+    global postCpus
+    slotCpus.clear()
+    postCpus = None if POST_PROCESS_CPUS is None else list(POST_PROCESS_CPUS)
+    if CPU_AFFINITY is None:
+        return
+    if CPU_AFFINITY == "numa":
+        reserved = set(postCpus or [])
+        sets = [[cpu for cpu in node if cpu not in reserved] for node in numaNodes()]
+        sets = [cpus for cpus in sets if len(cpus) > 0]
+        if len(sets) == 0:
+            log.info("No NUMA nodes found, worker slots are not pinned")
+            return
+    else:
+        sets = [list(cpus) for cpus in CPU_AFFINITY]
+    for slot in range(1, max(CORE_COUNT, 1) + 1):
+        slotCpus[slot] = sets[(slot - 1) % len(sets)]
+    log.info("Slot CPUs: %s, post-processing CPUs: %s" % (slotCpus, postCpus))
+
+def cpusOfSlot(slot):
+    """
+    Returns the CPUs of a slot (slot numbers past CORE_COUNT wrap around) or None if slots aren't pinned.
+    """
+    if len(slotCpus) == 0:
+        return None
+    return slotCpus[(int(slot) - 1) % len(slotCpus) + 1]
+
+def formatCpus(cpus):
+    """
+    Formats a list of CPUs like Linux does (eg "0-3,8").
+    """
+    if cpus is None:
+        return "any"
+    ranges = []
+    for cpu in sorted(cpus):
+        if len(ranges) > 0 and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(("%d" % low) if low == high else ("%d-%d" % (low, high)) for low, high in ranges)
+
+def newGroupName(prefix):
+    """
+    Returns a group name that was never used before, eg "dAv_17".  The number is a journaled job ID so it is unique across restarts too.
+    """
+    jobId = workQueue.newId()
+    journal.issued(jobId)
+    return "%s_%d" % (prefix, jobId)
 
 class MatchExecuter(basic.LineReceiver):
     """
@@ -120,20 +166,52 @@ class MatchExecuter(basic.LineReceiver):
         """
         Method desc.
         """
+        if line.startswith("{"): # one request of a batch, see batchReceived
+            self.batchReceived(line)
+            return
         log.info("Received:" +  line)
         input = line.split(" ")
-        # If there are enough open threads then assign a command
-        if len(activeThreads) + 1 <= CORE_COUNT or input[0] == "cancel" or input[0] == "show" or "-dAvrange" in line or input[0] == "group": 
+        # If there are enough open slots (and memory for a job of unknown size) then assign a command
+        if (len(activeJobs) + 1 <= CORE_COUNT and memoryFree() >= DEFAULT_JOB_MEMORY) or input[0] == "cancel" or input[0] == "show" or "-dAvrange" in line or "-dAvsearch" in line or "-sweep" in line or input[0] == "group": 
             cp = CommandParser()
             data = cp.parse(line)
             if data is not None:
                 self.sendData(data)
-        else: # If all processes are used put received line in a work Queue
-            condorEvent.set()
-            condorEvent.clear()
-            log.info("All threads taking adding command to queue - " + line)
-            workQueue.put(line) 
+        else: # If all processes or all the memory are used put received line in a work Queue
+            jobId = queueCommand(line)
+            wakeCondor()
+            log.info("All slots taken adding command to queue as job %d - %s" % (jobId, line))
         
+    def batchReceived(self, line):
+        """
+        Handles a request of the batch protocol (see BatchSubmit.py): {"id": request id, "command": command}.  Fits are always queued
+        and the queue dispatched so every fit gets its job ID right away.  The request is answered to this client alone with its "id"
+        and the "job" ID of a fit, the "group" name of a -dAvrange, -dAvsearch or -sweep, the "result" of a show or an "error".
+        """
+        answer = {"id": None}
+        try:
+            request = json.loads(line)
+            answer["id"] = request.get("id")
+            command = str(request["command"]).strip()
+            log.info("Received request %s: %s" % (answer["id"], command))
+            input = command.split(" ")
+            if input[0] in ("calcsfh", "sleep") and "-dAvrange" not in command and "-dAvsearch" not in command \
+               and "-sweep=" not in command:
+                answer["job"] = queueCommand(command)
+                dispatchQueue()
+                wakeCondor()
+            else:
+                cp = CommandParser()
+                data = cp.parse(command)
+                if cp.group is not None:
+                    answer["group"] = cp.group
+                if data is not None:
+                    answer["result"] = str(data)
+        except Exception as e:
+            log.info("Bad request %s: %s" % (line, e))
+            answer["error"] = "%s: %s" % (type(e).__name__, e)
+        self.sendLine(json.dumps(answer))
+
     def sendData(self, data):
         """
         Decorator method to self.sendMessage(...) so that it
@@ -161,19 +239,28 @@ class MatchExecuterFactory(protocol.ServerFactory):
 class CommandParser(object):
     def __init__(self):
         self.commands = CommandMethods()
+        self.group = None # name of the group the parsed command started
         
-    def parse(self, input=None):
+    def parse(self, input=None, jobId=None):
         """
         Input must start with a keyword argument. For example, if the user wants to
         cancel a command then they must have the "cancel" key followed by the Matching command.
+        "jobId" is passed in when the command was queued and already has an ID.
         """
         line = input
         input = input.split(" ")
         print("Split input:", input)
         
         if input[0] == "calcsfh":
+            # fit every cell of a grid of parameter file values (e.g. -sweep=m-M=24.0:24.4:0.2+BF=0.3,0.35)
+            if "-sweep=" in line:
+                log.info("sweeping the parameter file over a grid - " + line)
+
+                self.group = newGroupName("sweep")
+                self.commands.sweep(line, self.group)
+
             # find the best dAv but can also pass in lower and upper bounds with a step (e.g. -dAvrange=0.0,1.0,0.1)
-            if "-dAvrange" in line:
+            elif "-dAvrange" in line:
                 # get attributes
                 dAv = ""
                 for i, arg in enumerate(input):
@@ -186,28 +273,39 @@ class CommandParser(object):
                 step = float(dAv[2])
 
                 log.info("generating dAv commands in the specified range with step - " + line)
-                
-                t = MatchThread(line, target=self.commands.dAvRange, args=(line, lower, upper, step), name="dAv_%d"%getdAvName())
-                dAvRangeThreads[t.name] = t
-                t.start()
+
+                self.group = newGroupName("dAv")
+                self.commands.dAvRange(line, self.group, lower, upper, step)
+
+            # search for the best dAv in rounds instead of fitting a whole grid (e.g. -dAvsearch=0.0,1.0,0.02)
+            elif "-dAvsearch" in line:
+                dAv = [arg for arg in input if "-dAvsearch" in arg][0]
+                lower, upper, tol = [float(value) for value in dAv.split("=")[1].split(",")]
+
+                log.info("searching for the best dAv down to the given tolerance - " + line)
+
+                self.group = newGroupName("dAv")
+                self.commands.dAvSearch(line, self.group, lower, upper, tol)
 
             else:
                 log.info("run calcsfh command - " + line)
-                startCommand(line, self.commands.calcsfh, (line,), name=getThreadNumber())
+                startCommand(line, self.commands.calcsfh, (line,), name=getThreadNumber(), jobId=jobId)
             return None
         
         if input[0] == "group":
             groupName = input[1]
             command = " ".join(input[2:])
-            print("GROUP COMMANDS:", dAvRangeGroup[groupName])
             print(groupName, command)
-            dAvRangeGroup[groupName][command] = True
-            startCommand(None, runGroup, (dAvRangeGroup[groupName],), name=getThreadNumber())
-            runGroup(dAvRangeGroup[groupName])
+            if groupName not in groups:
+                log.info("No group %s for %s" % (groupName, command))
+                return None
+            startCommand("group " + groupName, self.commands.groupMember, (groupName, command), name=None, durable=False)
 
         if input[0] == "cancel":
             if input[1] == "all":
                 self.commands.clearAll()
+            elif len(input) == 2 and input[1].isdigit():
+                self.commands.cancelId(int(input[1]))
             else:
                 line = " ".join(input[1:])
                 self.commands.cancel(line)
@@ -220,27 +318,503 @@ class CommandParser(object):
 
         # sleep for testing object based MatchExecuter
         if input[0] == "sleep":
-            print("starting object sleep thread")
-            log.info("starting object sleep thread")
+            print("starting object sleep job")
+            log.info("starting object sleep job")
 
-            startCommand(line, self.commands.sleep2, (input[1],), name=getThreadNumber())
+            startCommand(line, self.commands.sleep2, (input[1],), name=getThreadNumber(), jobId=jobId)
             return None
             
         # for testing purposes
         """
         if input[0] == "sleep":
-            log.info("starting sleep thread")
-            t = MatchThread(line, target=self.commands.sleep, args=(input[1],), name=getThreadNumber())
-            activeThreads[t.name] = t
-            t.start()
+            log.info("starting sleep job")
+            startCommand(line, self.commands.sleep, (input[1],), name=getThreadNumber())
             return None
         """
 
-def startCommand(line, method, args, name):
-    t = MatchThread(line, target=method, args=args, name=name)
-    activeThreads[t.name] = t
-    t.start()
+def queueCommand(line, jobId=None):
+    """
+    Puts a command in the work queue and returns its job ID.  New commands (no "jobId") are journaled.  The command is queued with
+    the default runtime and moved to its place in the queue once its runtime has been estimated.
+    """
+    if jobId is None:
+        jobId = workQueue.put(line, priority=priorityOf(line))
+        journal.submitted(jobId, line)
+    else:
+        workQueue.put(line, jobId, priority=priorityOf(line))
+    d = threads.deferToThread(history.expected, line)
+    d.addCallbacks(lambda estimate: workQueue.reprioritize(jobId, estimate[0], memory=estimate[1]),
+                   lambda failure: log.info("Could not estimate job %d: %s" % (jobId, failure.getErrorMessage())))
+    d.addCallback(lambda result: dispatchQueue()) # a smaller estimate may fit in the memory that is left
+    return jobId
+
+def priorityOf(command):
+    """
+    Returns the priority given by the -priority= flag of a command or 0.
+    """
+    for arg in command.split():
+        if arg.startswith("-priority="):
+            try:
+                return int(arg.split("=")[-1])
+            except ValueError:
+                return 0
+    return 0
+
+def startCommand(line, method, args, name, jobId=None, durable=True):
+    """
+    Makes a MatchJob that runs "method" and puts it in a slot.  When the job is done, canceled or fails its slot is freed and
+    the next queued command is started.  A "name" of None starts the job without a slot, like a fit that moved on to
+    post-processing (see releaseSlot).  Jobs that are not "durable" (eg group processing) are not journaled.
+    """
+    if jobId is None:
+        jobId = workQueue.newId()
+        if durable:
+            journal.submitted(jobId, line)
+        else:
+            journal.issued(jobId)
+    job = MatchJob(line, target=method, args=args, name="post" if name is None else name, jobId=jobId)
+    job.durable = durable
+    job.cpus = postCpus if name is None else cpusOfSlot(name)
+    job.started = time.time()
+    job.features = None # set by CommandMethods.calcsfh, see RunHistory.features
+    job.expected = DEFAULT_RUNTIME
+    job.memory = DEFAULT_JOB_MEMORY # expected peak memory, see memoryFree
+    job.fitting = None # DefaultCalcsfh while its calcsfh stage runs, see findStragglers
+    job.twin = None # speculative duplicate of the calcsfh stage, see speculate
+    if name is not None:
+        activeJobs[job.name] = job
+    workQueue.running(jobId, job)
+    if durable:
+        journal.started(jobId)
+    d = job.start()
+    d.addCallbacks(lambda result: "done", jobFailed, errbackArgs=(job,))
+    d.addBoth(jobFinished, job)
+    return job
+
+def jobFailed(failure, job):
+    if failure.check(ProcessCanceled):
+        log.info("Job canceled (%s)" % job.command)
+        return "canceled"
+    else:
+        log.error("Job failed (%s)\n%s" % (job.command, failure.getTraceback()))
+        return "failed"
+
+def jobFinished(state, job):
+    if activeJobs.get(job.name) is job:
+        activeJobs.pop(job.name)
+    workQueue.finished(job.id)
+    if job.durable:
+        journal.finished(job.id, state)
+    dispatchQueue()
+
+def runStage(job, runner, stage):
+    """
+    Runs the current command of "runner" unless the journal says this stage finished before the server was restarted.
+    The finished stage is journaled and its times and memory use are added to the run history.
+    """
+    if stage in journal.stagesDone(job.id):
+        log.info("Job %d already finished %s, skipping it" % (job.id, stage))
+        return defer.succeed(None)
+    d = job.run(runner, postCpus if stage in POST_STAGES else None)
+    d.addCallback(stageDone, job, stage)
+    return d
+
+def stageDone(result, job, stage):
+    """
+    Journals a finished stage and records it in the run history.  Passes the ProcessResult on.  A calcsfh stage that was killed because
+    its speculative duplicate finished first is recorded as the duplicate's run (see CommandMethods.speculate).
+    """
+    if job.durable:
+        journal.stage(job.id, stage)
+    recorded = result
+    if stage == "calcsfh" and job.twin is not None and job.twin.won:
+        recorded = job.twin.result
+    d = threads.deferToThread(history.recordStage, job.features, stage, recorded)
+    d.addErrback(lambda failure: log.info("Could not record %s of job %d: %s" % (stage, job.id, failure.getErrorMessage())))
+    return result
+
+def runPostStage(job, stage, task, script):
+    """
+    Runs a post-processing stage as "task" ((name, arguments), see scripts/post_worker.py) on a post-processing worker.  "script" makes
+    the ProcessRunner that runs the stage's script instead, which is done when there are no workers or they can't run the task.  Like
+    runStage the stage is skipped if it finished before the server was restarted, is canceled with its job and is journaled and
+    recorded in the run history when it is done.  A task that fails is logged and not journaled so a restarted server runs it again.
+    A "task" of None always runs the script.
+    """
+    if postWorkers is None or task is None or stage in journal.stagesDone(job.id):
+        return runStage(job, script(), stage)
+
+    def failed(failure):
+        if failure.check(WorkerUnavailable):
+            log.info("No post-processing worker for the %s of job %d, running its script: %s" % (stage, job.id,
+                                                                                                failure.getErrorMessage()))
+            return runStage(job, script(), stage)
+        failure.trap(PostTaskFailed)
+        log.error("The %s of job %d failed (%s)\n%s" % (stage, job.id, job.command, failure.getErrorMessage()))
+
+    d = job.run(PostTask(postWorkers, *task))
+    d.addCallbacks(stageDone, failed, callbackArgs=(job, stage))
+    return d
+
+def lookupResult(job, calcsfh, combineStage):
+    """
+    Looks for an earlier run of the same fit in the result cache.  Fires with (key, True) if its outputs were copied in, in which case
+    the calcsfh and combine stages are journaled as done, or (key, False) if the fit has to be run.  Hashing the input files happens in
+    a thread so large fake files don't block the reactor.
+    """
+    if resultCache is None or calcsfh.skip or "calcsfh" in journal.stagesDone(job.id):
+        return defer.succeed((None, False))
+
+    def lookup():
+        key = resultCache.key(calcsfh)
+        return key, resultCache.fetch(key, calcsfh)
+
+    def found(result):
+        key, hit = result
+        if hit:
+            log.info("Job %d: result cache hit %s for %s" % (job.id, key, calcsfh.fit))
+            journal.stage(job.id, "calcsfh")
+            journal.stage(job.id, combineStage)
+        return result
+
+    def failed(failure):
+        # eg a missing input file; calcsfh will report it when it runs
+        log.info("Job %d: result cache lookup failed: %s" % (job.id, failure.getErrorMessage()))
+        return (None, False)
+
+    d = threads.deferToThread(lookup)
+    d.addCallbacks(found, failed)
+    return d
+
+def storeResult(key, calcsfh):
+    """
+    Copies the outputs of a fit that just ran into the result cache.
+    """
+    if key is None:
+        return defer.succeed(None)
+    d = threads.deferToThread(resultCache.store, key, calcsfh)
+    d.addErrback(lambda failure: log.info("Storing %s in the result cache failed: %s" % (calcsfh.fit, failure.getErrorMessage())))
+    return d
+
+def makeDAvCommand(line, dAv, group):
+    """
+    Turns a calcsfh command with a -dAvrange or -dAvsearch flag into the command that fits a single dAv.  The flag becomes -dAv=,
+    the fit and output names get a "_dAv_0-10" like suffix (the names scripts/ProcessDAv.py looks for) and the custom flag
+    -group=group is added.
+    """
+    # There may be a 'cd' at the beginning edit for this change
+    cd = None
+    if "cd" == line[:2]:
+        cd = " ".join(line.split()[:2])
+        line = line.split()[2:]
+    else:
+        line = line.split()
+
+    suffix = ("_dAv_%.2f" % dAv).replace(".", "-")
+    newLine = list(line)
+    for j, arg in enumerate(line):
+        if "-dAvrange" in arg or "-dAvsearch" in arg:
+            # add the dAv in
+            newLine[j] = "-dAv=%.3f" % dAv
+            # put in new file names
+            newLine[4] = line[4] + suffix
+
+            output = line[-1].split("/")
+            outputName = output[-1].split(".")
+            outputName[0] += suffix
+            output[-1] = ".".join(outputName)
+            newLine[-1] = "/".join(output)
+
+            # put in a custom flag called -group=groupName
+            newLine.insert(-2, "-group=%s" % group)
+
+    if cd is not None:
+        return "%s %s" % (cd, " ".join(newLine))
+    return " ".join(newLine)
+
+def journalGroup(group):
+    """
+    Journals a group with all of its members.
+    """
+    journal.group(group.name, list(group.members.keys()), group.meta())
+
+def searchStep(group):
+    """
+    Queues the next round of fits of a -dAvsearch group if its current round is done.  The whole group is journaled again so a restart
+    knows every fit that was handed out.
+    """
+    search = group.search
+    dAvs = search.nextPoints()
+    if len(dAvs) == 0:
+        return
+    commands = [makeDAvCommand(group.line, dAv, group.name) for dAv in dAvs]
+    log.info("dAv search %s fitting %s (bracket %.2f to %.2f)" % (group.name, ", ".join("%.2f" % dAv for dAv in dAvs), search.lower,
+                                                                  search.upper))
+    for command in commands:
+        group.add(command)
+    journalGroup(group)
+    for command in commands:
+        queueCommand(command)
+
+    wakeCondor()
+    dispatchQueue()
+
+@defer.inlineCallbacks
+def memberDone(group, calcsfh):
+    """
+    Reports a finished member to its group: the running best fit and the summary file are updated, a -dAvsearch moves on to its
+    next round and a -sweep prunes the cells that are now clearly worse than its best.
+    """
+    result = yield threads.deferToThread(calcsfh.bestFitAv)
+    if not group.done(calcsfh.original, result):
+        return
+    value = None if result is None else result[0]
+    if group.search is not None:
+        group.search.report(calcsfh.dAv, value)
+        searchStep(group)
+    if group.sweep is not None:
+        pruneSweep(group, group.sweep.report(calcsfh.original, value))
+    if not group.dag: # the group script of a DAG may be reading the fits already
+        yield threads.deferToThread(group.writeSummary)
+
+def queueGroup(group, commands):
+    """
+    Queues the fits of a new group.  With CONDOR_DAGS a group that is too big for the free local slots is sent to Condor whole as a DAG
+    instead (see submitGroupDag).  -dAvsearch groups grow as they go and pruned sweeps drop fits so they are always queued.
+    """
+    if (condor is not None and CONDOR_DAGS and group.search is None and (group.sweep is None or group.sweep.margin is None) and
+        len(commands) > CORE_COUNT - len(activeJobs)):
+        submitGroupDag(group, commands)
+        return
+    for command in commands:
+        queueCommand(command)
+    wakeCondor()
+    dispatchQueue()
+
+def submitGroupDag(group, commands):
+    """
+    Submits a group as a Condor DAG whose fits are the parents of its group script, so the group is processed on Condor without a round
+    trip through the server.  The fits are still followed through the event log (see condorEnded) to keep the group's best fit up to
+    date.  If the submit fails the fits are queued like any others.
+    """
+    jobs = []
+    for command in commands:
+        jobId = workQueue.newId()
+        journal.submitted(jobId, command)
+        jobs.append((jobId, command))
+    group.dag = True
+    group.reducing = True
+    reducer = GroupProcess(group.reducer, group.workingD, group.baseName, commands).stage.argv
+
+    def submit():
+        if os.path.exists(group.summaryFile()): # left by an earlier run, the group script would read it
+            os.remove(group.summaryFile())
+        return condor.submitGroup(group.name, [(jobId, command, condorRunner(command).condorCommands(), history.expected(command)[0])
+                                               for jobId, command in jobs], reducer)
+
+    def submitted(result):
+        journalGroup(group)
+        for jobId, command in jobs:
+            journal.finished(jobId, "condor")
+        log.info("Sent group %s to Condor as a DAG of %d fits" % (group.name, len(jobs)))
+
+    def failed(failure):
+        log.error("Could not submit group %s as a DAG, queuing its fits: %s" % (group.name, failure.getErrorMessage()))
+        group.dag = False
+        group.reducing = False
+        for jobId, command in jobs:
+            queueCommand(command, jobId)
+        wakeCondor()
+        dispatchQueue()
+
+    d = threads.deferToThread(submit)
+    d.addCallbacks(submitted, failed)
+    return d
+
+def formatSeconds(seconds):
+    """
+    Formats seconds as H:MM:SS.
+    """
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+def groupOf(command):
+    """
+    Returns the group name given by the -group= flag of a calcsfh command or None.
+    """
+    for arg in command.split():
+        if arg.startswith("-group="):
+            return arg.split("=")[-1]
+    return None
+
+def replayJournal():
+    """
+    Puts the server back into the state it was in before it was stopped.  Unfinished jobs are queued again (keeping their job IDs),
+    unfinished groups are rebuilt and finished groups whose processing never ran are processed.
+    """
+    jobs, journaled, lastId = journal.replay()
+    workQueue.reserve(lastId)
+
+    live = set(job["command"] for job in jobs.values() if job["state"] not in FINISHED)
+    if condor is not None: # still running on Condor
+        live.update(condor.commands())
+    for name, record in journaled.items():
+        if name.split("_")[-1].isdigit():
+            workQueue.reserve(int(name.split("_")[-1])) # group names are job IDs too
+        if not record["reduced"]:
+            groups[name] = replayGroup(name, record, live)
+
+    count = 0
+    for jobId, job in jobs.items():
+        if job["state"] not in FINISHED:
+            queueCommand(job["command"], jobId)
+            count += 1
+    log.info("Replayed journal: %d unfinished jobs queued again, %d unfinished groups" % (count, len(groups)))
+
+    journal.compact([jobId for jobId, job in jobs.items() if job["state"] in FINISHED],
+                    [name for name, record in journaled.items() if record["reduced"]])
+
+    for name, group in groups.items():
+        if group.search is not None:
+            searchStep(group)
+        threads.deferToThread(group.writeSummary)
+        if group.finished:
+            startCommand("group " + name, CommandMethods().reduceGroup, (name,), name=None, durable=False)
+    dispatchQueue()
+
+def replayGroup(name, record, live):
+    """
+    Rebuilds an unprocessed group from its journal record.  Members that are not live anymore have finished (their journal entries
+    may have been compacted) and report their best fits again.  A -dAvsearch starts over from its last bracket and a -sweep counts
+    members that finished without output as pruned, so only fits that never ran are queued.
+    """
+    meta = record["meta"]
+    if meta is None: # journaled before groups kept their metadata, only -dAvrange made groups then
+        group = JobGroup(name, "dAvrange", record["commands"][0], "bestdAv")
+        group.baseName = "_".join(group.baseName.split("_")[:-2]) # drop the "_dAv_0-10" of the member
+    else:
+        group = JobGroup(name, meta["kind"], meta["line"], meta["reducer"])
+        group.dag = meta.get("dag", False)
+        group.reducing = group.dag # its group script runs on Condor
+    if group.kind == "dAvsearch":
+        group.search = DAvSearch(meta["search"]["lower"], meta["search"]["upper"], meta["search"]["tol"], DAV_SEARCH_POINTS)
+    elif group.kind == "sweep":
+        group.sweep = ParamSweep(group.line, name, group.reducer, SWEEP_PRUNE_MARGIN)
+
+    for command in record["commands"]:
+        group.add(command)
+        calcsfh = DefaultCalcsfh(command)
+        if command in live:
+            if group.search is not None:
+                group.search.pending.add(round(calcsfh.dAv, 2))
+            continue
+        result = calcsfh.bestFitAv()
+        group.done(command, result)
+        if group.search is not None:
+            group.search.values[round(calcsfh.dAv, 2)] = None if result is None else result[0]
+        if group.sweep is not None:
+            if result is None:
+                group.sweep.pruned.add(group.sweep.cellOf[command])
+            else:
+                group.sweep.values[group.sweep.cellOf[command]] = result[0]
+    if group.search is not None:
+        for dAv, value in list(group.search.values.items()):
+            group.search.report(dAv, value)
+    return group
+
+def pruneSweep(group, commands):
+    """
+    Drops the queued fits of pruned -sweep cells.  They count as done for the group.  Cells that are already running are left to
+    finish.
+    """
+    for command in commands:
+        ids = workQueue.cancelQueued(command)
+        if len(ids) == 0:
+            group.sweep.pruned.discard(group.sweep.cellOf[command])
+            continue
+        for jobId in ids:
+            journal.finished(jobId, "canceled")
+            log.info("Pruned job %d of sweep %s (%s)" % (jobId, group.name, command))
+        group.done(command)
+
+def findStragglers():
+    """
+    Looks for group members whose fit has run SPECULATE_FACTOR times longer than the median of their finished siblings and, while
+    nothing is queued and slots are idle, starts a duplicate of each (slowest first) in a free slot (see CommandMethods.speculate).
+    Called every SPECULATE_INTERVAL seconds.
+    """
+    if workQueue.qsize() > 0:
+        return
+    now = time.time()
+    slow = []
+    for job in activeJobs.values():
+        calcsfh = getattr(job, "fitting", None)
+        if calcsfh is None or job.twin is not None or calcsfh._group not in groups:
+            continue
+        typical = groups[calcsfh._group].typicalRuntime(SPECULATE_MIN_SIBLINGS)
+        if typical is not None and now - job.fitStarted > SPECULATE_FACTOR*typical:
+            slow.append(((now - job.fitStarted) / max(typical, 1e-3), job))
+    slow.sort(key=lambda pair: pair[0], reverse=True)
+    for ratio, job in slow:
+        if len(activeJobs) >= CORE_COUNT or memoryFree() < job.memory:
+            break
+        log.info("Job %d has run %.1f times as long as its group's median fit, starting a duplicate" % (job.id, ratio))
+        twin = startCommand("speculate %d" % job.id, CommandMethods().speculate, (job,), name=getThreadNumber(), durable=False)
+        job.twin = twin
+
+def dispatchQueue():
+    """
+    Starts queued commands while there are open slots and the next command fits in the memory that is left.  This is called every
+    time a job finishes, commands are added to the queue and the memory of running jobs is measured.  A job is always started when
+    nothing is running so a job bigger than MEMORY_BUDGET still runs, alone.
+    """
+    while len(activeJobs) < CORE_COUNT:
+        try:
+            # the condor thread may have emptied the queue
+            jobId, line, memory = workQueue.take(None if len(activeJobs) == 0 else max(memoryFree(), 0))
+        except Empty:
+            break
+        log.info("Slot open starting queued job %d - %s" % (jobId, line))
+        cp = CommandParser()
+        cp.parse(line, jobId)
+        state = workQueue.lookup(jobId)
+        if state is not None and state[0] == "running":
+            state[1].memory = memory
+
+def releaseSlot(job):
+    """
+    Frees the fit slot of a job that moves on to post-processing and starts the next queued command in it.  The job stays in the job
+    registry so it can still be listed and canceled.
+    """
+    if activeJobs.get(job.name) is job:
+        activeJobs.pop(job.name)
+    liveMemory.pop(job.id, None)
+    job.name = "post"
+    job.cpus = postCpus
+    dispatchQueue()
+
+def memoryFree():
+    """
+    Returns how many bytes of MEMORY_BUDGET are left once every running job reaches its peak.  A running job is expected to use the
+    larger of its estimate and what it is using right now.
+    """
+    used = 0
+    for job in activeJobs.values():
+        used += max(job.memory, liveMemory.get(job.id, 0))
+    return MEMORY_BUDGET - used
+
+def pollMemory():
+    """
+    Measures the resident memory of the process group of every running job (called every MEMORY_POLL_INTERVAL seconds).
+    """
+    usage = processGroupMemory()
+    liveMemory.clear()
+    for job in activeJobs.values():
+        if job.process is not None:
+            liveMemory[job.id] = usage.get(job.process.pid, 0)
+    dispatchQueue()
     
+
 class CommandMethods(object):
     """
     This method executes the commands that are sent to this server.  Examples include calcsfh and the find best
@@ -249,344 +823,387 @@ class CommandMethods(object):
     def __init__(self):
         pass
 
-    def calcsfh(self, line):
+    @defer.inlineCallbacks
+    def calcsfh(self, job, line):
+        """
+        Runs each command of a fit in turn.  Every "yield" hands control back to the reactor until that process exits.  Once calcsfh
+        is done the fit gives up its slot and waits for the post-processing pool to run zcombine/sspcombine and processFit, so the
+        slot can start the next fit right away.  The time a fit held its slot is learned by the run history.
+        """
+        started = time.time()
+        features = yield threads.deferToThread(history.features, line)
+        job.features = features
+        job.expected = yield threads.deferToThread(history.estimate, features)
+        job.memory = yield threads.deferToThread(history.memory, features)
+        resumed = len(journal.stagesDone(job.id)) > 0
         if "-ssp" not in line:
             calcsfh = DefaultCalcsfh(line)
-            if not calcsfh.skip:
-                # run the initial command
-                calcsfh.run()
-                
-            # run zcombine at the end
-            calcsfh.zcombine()
-            calcsfh.run()
-
-            # process calcsfh files after
-            calcsfh.processFit()
-            calcsfh.run()
-            
+            combine, combineStage = calcsfh.zcombine, "zcombine"
         else: # SSP run
             calcsfh = SSPCalcsfh(line)
-            if not calcsfh.skip:
-                # Run the initial command
-                calcsfh.run()
-
-            # run sspcombine
-            calcsfh.sspcombine()
-            calcsfh.run()
-
-            # process ssp files after
-            calcsfh.processFit()
-            calcsfh.run()
-            
-        # check for group and run if it is the last one in the group
-        if calcsfh._group is not None:
-            dAvRangeGroup[calcsfh._group][calcsfh.original] = True
-            self.runGroup(dAvRangeGroup[calcsfh._group])
-            
-        # cleanup the thread that is done
-        cleanupThread(doneThreads)
+            combine, combineStage = calcsfh.sspcombine, "sspcombine"
+
+        key, cached = yield lookupResult(job, calcsfh, combineStage)
+        if not calcsfh.skip and not cached:
+            # run the initial command, a duplicate may be raced against it if it is much slower than its group (see findStragglers)
+            job.fitting = calcsfh
+            job.fitStarted = time.time()
+            try:
+                yield runStage(job, calcsfh, "calcsfh")
+            finally:
+                job.fitting = None
+                twin, job.twin = job.twin, None
+                if twin is not None and not twin.won:
+                    twin.cancel()
+            if twin is not None and twin.won:
+                yield threads.deferToThread(calcsfh.adoptSpeculative)
+                started = time.time() - twin.result.wallTime # learn how long the run that finished took, not the killed one
+            if calcsfh._group in groups:
+                groups[calcsfh._group].recordRuntime(time.time() - job.fitStarted)
+        fitSeconds = time.time() - started
+
+        # the fit slot takes the next queued fit while this one is post-processed
+        releaseSlot(job)
+        yield postPool.acquire()
+        try:
+            # run zcombine (sspcombine for SSP runs)
+            combine()
+            if not cached:
+                yield runStage(job, calcsfh, combineStage)
+                yield storeResult(key, calcsfh)
 
-    def dAvRange(self, line, lower=0.0, upper=1.0, step=0.2):
+            # process calcsfh files after
+            def script():
+                calcsfh.processFit()
+                return calcsfh
+            yield runPostStage(job, "processFit", calcsfh.postTask(), script)
+
+            if not (calcsfh.skip or cached or resumed):
+                yield threads.deferToThread(history.learn, features, fitSeconds)
+
+            # check for group and run if it is the last one in the group
+            if calcsfh._group in groups:
+                yield memberDone(groups[calcsfh._group], calcsfh)
+                yield self.runGroup(job, calcsfh._group)
+        finally:
+            postPool.release()
+
+    def dAvRange(self, line, name, lower=0.0, upper=1.0, step=0.2):
         """
         This method takes in a calcsfh command along with the custom -dAvRange and makes several calcsfh commands
-        that will comprise of the total dAv range.  These commands are added to the queue for later.
+        that will comprise of the total dAv range.  These commands are added to the queue for later.  "name" is the
+        name of the group the commands belong to.
         """
-        t = threading.current_thread()
-
-        # There may be a 'cd' at the beginning edit for this change
-        cd = None
-        if "cd" == line[:2]:
-            cd = " ".join(line.split()[:2])
-            line = line.split()[2:]
-        else:
-            line = line.split()
-            
         numSteps = int((upper - lower) / step) + 1 # will underestimate by one so I add one
 
         commands = [] # list of commands to be added to queue
 
         currentDaV = lower
         for i in xrange(numSteps):
-            newLine = list(line)
-            for j, arg in enumerate(line):
-                if "-dAvrange" in arg:
-                    # add the dAv in 
-                    newLine[j] = "-dAv=%.3f" % currentDaV
-                    # put in new file names
-                    args = list(line)
-
-                    name = args[4].split("/")
-                    name[-1] += ("_dAv_%.2f" % currentDaV).replace(".", "-")
-                    name = "/".join(name)
-                    newLine[4] = name
-
-                    output = args[-1].split("/")
-                    outputName = output[-1].split(".")
-                    outputName[0] += ("_dAv_%.2f" % currentDaV).replace(".", "-")
-                    outputName = ".".join(outputName)
-                    output[-1] = outputName
-                    output = "/".join(output)
-                    newLine[-1] = output
-
-                    # put in a custom flag called -group=groupName
-                    newLine.insert(-2, "-group=%s" % (t.name))
-                    
-
-            if cd is not None:
-                commands.append("%s %s" % (cd, " ".join(newLine)))
-            else:
-                commands.append(" ".join(newLine))
-
-            print(newLine)
+            commands.append(makeDAvCommand(line, currentDaV, name))
             print(commands[i])
             print()
             currentDaV += step
 
-        dAvRangeGroup[t.name] = {} # add a dictionary 
-            
+        group = JobGroup(name, "dAvrange", line, "bestdAv")
         for command in commands:
-            dAvRangeGroup[t.name][command] = False # add that this command is not done
-            workQueue.put(command)
-            #print(command)
+            group.add(command)
+        groups[name] = group
+        journalGroup(group)
 
-        t.cancel = True
-        doneThreads.put(dAvRangeThreads.pop(t.name))
+        queueGroup(group, commands)
 
-        condorEvent.set()
-        condorEvent.clear()
-        
-        watcherEvent.set()
-        watcherEvent.clear()
+    def dAvSearch(self, line, name, lower=0.0, upper=1.0, tol=0.02):
+        """
+        Takes in a calcsfh command with the custom -dAvsearch=lower,upper,tol and searches for its best dAv.  DAV_SEARCH_POINTS
+        dAvs are fit at a time and every round narrows the bracket around the best one (see DAvSearch.py) until it is "tol" wide.
+        The fits make up the group "name" which is processed like a -dAvrange group once the search is done.
+        """
+        group = JobGroup(name, "dAvsearch", line, "bestdAv")
+        group.search = DAvSearch(lower, upper, tol, DAV_SEARCH_POINTS)
+        groups[name] = group
+        searchStep(group)
+
+    def sweep(self, line, name):
+        """
+        Takes in a calcsfh command with the custom -sweep flag (see ParamSweep.py), writes the parameter file of every cell of the
+        grid and queues a fit for each.  The fits make up the group "name" whose reducer runs once every cell is done or pruned.
+        """
+        try:
+            sweep = ParamSweep(line, name, SWEEP_REDUCER, SWEEP_PRUNE_MARGIN)
+        except ValueError as e:
+            log.info("Bad -sweep (%s): %s" % (e, line))
+            return
+        group = JobGroup(name, "sweep", line, sweep.reducer)
+        group.sweep = sweep
+        groups[name] = group
+
+        def queue(commands):
+            for command in commands:
+                group.add(command)
+            journalGroup(group)
+            queueGroup(group, commands)
+            log.info("Sweep %s queued %d fits" % (name, len(commands)))
+
+        def failed(failure):
+            log.info("Could not write the parameter files of sweep %s: %s" % (name, failure.getErrorMessage()))
+            groups.pop(name, None)
+
+        d = threads.deferToThread(sweep.writeParams)
+        d.addCallbacks(queue, failed)
+        return d
 
     def show(self, input):
+        """
+        "show" lists running jobs and the first page of the queue, "show queue <page>" pages through the queue, "show threads" lists
+        running jobs, "show job <id>" looks up a single job, "show number" counts them, "show eta [page]" predicts when each job
+        will finish, "show groups" lists the groups being fit and "show condor" lists the jobs Condor is running.  Listings are
+        taken from the job registry so the queue is never touched.
+        """
         try:
             input[1] # test if there is another key
             if input[1] == "queue":
-                size = workQueue.qsize()
-                line = ""
-                # show all the commands from the queue
-                if size > 0:
-                    tempQ = Queue()
-                    # get and print all queue commands
-                    for i in range(size):
-                        command = workQueue.get()
-                        line += command + "\n"
-                        tempQ.put(command)
-                    # requeue commands
-                    for i in range(size):
-                        workQueue.put(tempQ.get())
-                else:
+                page = 0
+                if len(input) > 2 and input[2].isdigit():
+                    page = int(input[2])
+                line = self._showQueue(page)
+                if line == "":
                     line += "no queued commands"
                 return line
             if input[1] == "threads":
-                # show all the commands being run on active threads
-                keys = activeThreads.keys()
+                # show all the commands being run by active jobs with their slots and CPUs
+                line = ""
+                for jobId, job in workQueue.runningJobs():
+                    line += "%d: slot %s on cpus %s: %s\n" % (jobId, job.name, formatCpus(job.cpus), job.command)
+                if line == "":
+                    line += "no current jobs running\n"
+                if len(slotCpus) > 0 or postCpus is not None:
+                    line += "slot cpus: %s\n" % ", ".join("%d=%s" % (slot, formatCpus(cpus)) for slot, cpus in sorted(slotCpus.items()))
+                    line += "post-processing cpus: %s" % formatCpus(postCpus)
+                return line
+            if input[1] == "job":
+                state = workQueue.lookup(int(input[2]))
+                if state is None:
+                    return "no job %s" % input[2]
+                if state[0] == "queued":
+                    return "%s queued: %s" % (input[2], state[1])
+                return "%s running in slot %s: %s" % (input[2], state[1].name, state[1].command)
+            if input[1] == "eta":
+                page = 0
+                if len(input) > 2 and input[2].isdigit():
+                    page = int(input[2])
+                return self._showEta(page)
+            if input[1] == "groups":
+                line = ""
+                for name, group in sorted(groups.items()):
+                    best = "" if group.best is None else ", best fit %s" % group.best[1]
+                    line += "%s: %s, %d of %d done%s: %s\n" % (name, group.kind, len(group.members) - group.remaining, len(group.members),
+                                                               best, group.line)
+                if line == "":
+                    line += "no groups"
+                return line
+            if input[1] == "condor":
                 line = ""
-                if len(keys) > 0:
-                    for key in keys:
-                        t = activeThreads[key]
-                        line += t.command + "\n"
-                else:
-                    line += "no current threads running"
+                if condor is not None:
+                    for job, entry in sorted(list(condor.jobs.items()) + list(condor.nodes.items())):
+                        line += "%s: condor job %s: %s\n" % ("group" if entry[0] is None else entry[0], job, entry[1])
+                if line == "":
+                    line += "no condor jobs"
                 return line
             if input[1] == "number":
-                count = len(activeThreads) + workQueue.qsize()
+                count = len(workQueue.runningJobs()) + workQueue.qsize()
                 line = "Process to run: " + str(count)
                 return line
         except IndexError:
-            # show all commands in queue and in thread
-            line = ""
-            size = workQueue.qsize()
-            # show all the commands from the queue
-            if size > 0:
-                tempQ = Queue()
-                # get and print all queue commands
-                for i in range(size):
-                    command = workQueue.get()
-                    line += command + "\n"
-                    tempQ.put(command)
-                # requeue commands
-                for i in range(size):
-                    workQueue.put(tempQ.get())
-
-            keys = activeThreads.keys()
-            if len(keys) > 0:
-                for key in keys:
-                    t = activeThreads[key]
-                    line += t.command + "\n"
+            # show all commands in running jobs and the first page of the queue
+            line = self._showRunning() + self._showQueue(0)
 
             if line == "":
                 return "no commands to show"
             else:
                 return line
 
-    def runGroup(self, dictionary):
-        """
-        Passed in is a list of commands belonging to a group of commands.
-        This method will run a script to process these grouped fits.
-        """
-        # check if all the commands in the dictionary are set to true
-        done = dictionary.values()
-        if all(bool is True for bool in done) is True:
-            ## run code on group
-            # isolate working directory
-            print("DONE:", done)
-            keys = dictionary.keys()
-            #print("KEYS:", keys[0])
-            workingD = keys[0].split(" ")
-            workingD = workingD[4].split("/")[:-1]
-            workingD = "/".join(workingD) + "/"
-            print("WORKING DIRECTORY:", workingD)
-
-            # isolate base name
-            baseName = keys[1].split(" ")
-            baseName = baseName[4].split("/")[-1]
-            baseName = baseName.split("_")
-            baseName = "_".join(baseName[:-2])
-            print("BASE NAME:", baseName)
-
-            group = GroupProcess('bestdAv', workingD, baseName, keys)
-            group.run()
+    def _showQueue(self, page):
+        line = ""
+        for jobId, command in workQueue.snapshot(page*SHOW_PAGE_SIZE, SHOW_PAGE_SIZE):
+            line += "%d: %s\n" % (jobId, command)
+        size = workQueue.qsize()
+        if size > (page + 1)*SHOW_PAGE_SIZE:
+            line += "... %d queued commands (page %d of %d)\n" % (size, page, (size - 1) // SHOW_PAGE_SIZE)
+        return line
+
+    def _showEta(self, page):
+        """
+        Plays the queue out over CORE_COUNT slots using the expected runtime of every job (see RunHistory.py).  Running jobs are
+        expected to finish when their expected runtime is up (or now if they are over it).
+        """
+        now = time.time()
+        slots = []
+        line = ""
+        for jobId, job in workQueue.runningJobs():
+            if activeJobs.get(job.name) is not job: # post-processing, not holding a slot
+                continue
+            left = max(job.expected - (now - job.started), 0.0)
+            slots.append(left)
+            line += "%d: running, done in %s: %s\n" % (jobId, formatSeconds(left), job.command)
+        if CORE_COUNT <= 0:
+            return line + "no cores to run the queue on"
+        slots.sort()
+        slots = slots[len(slots) - CORE_COUNT:] if len(slots) > CORE_COUNT else slots + [0.0]*(CORE_COUNT - len(slots))
+        heapq.heapify(slots)
+
+        first = page*SHOW_PAGE_SIZE
+        drain = max(slots) if len(slots) > 0 else 0.0
+        scheduled = workQueue.scheduled()
+        for i, (jobId, command, expected) in enumerate(scheduled):
+            done = heapq.heappop(slots) + expected
+            heapq.heappush(slots, done)
+            drain = max(drain, done)
+            if first <= i < first + SHOW_PAGE_SIZE:
+                line += "%d: queued, done in %s: %s\n" % (jobId, formatSeconds(done), command)
+        if len(scheduled) > first + SHOW_PAGE_SIZE:
+            line += "... %d queued commands (page %d of %d)\n" % (len(scheduled), page, (len(scheduled) - 1) // SHOW_PAGE_SIZE)
+        line += "queue drains in %s on %d cores" % (formatSeconds(drain), CORE_COUNT)
+        return line
+
+    def _showRunning(self):
+        line = ""
+        for jobId, job in workQueue.runningJobs():
+            line += "%d: %s\n" % (jobId, job.command)
+        return line
+
+    @defer.inlineCallbacks
+    def speculate(self, twin, job):
+        """
+        Runs a duplicate of the calcsfh stage of a slow group member ("job") in a slot of its own.  If the duplicate finishes first the
+        member's process group is killed and the member carries on with the duplicate's outputs.  If the member finishes first the
+        duplicate is killed and its files are removed.
+        """
+        twin.won = False
+        twin.memory = job.memory
+        calcsfh = job.fitting
+        result = yield twin.run(SpeculativeRun(calcsfh))
+        releaseSlot(twin) # only the duplicate's calcsfh holds a slot, cleaning up after it doesn't
+        if job.twin is not twin: # the member finished in the meantime
+            yield threads.deferToThread(calcsfh.discardSpeculative)
+        elif result.returncode != 0:
+            log.info("Speculative duplicate of job %d failed, keeping the original" % job.id)
+            job.twin = None
+            yield threads.deferToThread(calcsfh.discardSpeculative)
         else:
+            log.info("Speculative duplicate of job %d finished first, killing the original" % job.id)
+            twin.won = True
+            twin.result = result
+            if job.process is not None:
+                job.process.kill()
+
+    def groupMember(self, job, name, command):
+        """
+        A member of a group finished somewhere else (a Condor job ended, see condorEnded, or "group name command" was sent).
+        Reports it to its group and runs the group script if it was the last one.
+        """
+        d = memberDone(groups[name], DefaultCalcsfh(command))
+        d.addCallback(lambda result: self.reduceGroup(job, name))
+        return d
+
+    def reduceGroup(self, job, name):
+        """
+        Runs the group script of "name" (see runGroup) in the post-processing pool.  Used by jobs that don't come from a fit, which
+        already holds a place in the pool when it runs its group's script.
+        """
+        return postPool.run(self.runGroup, job, name)
+
+    def runGroup(self, job, name):
+        """
+        Passed in is the name of a group of commands.
+        This method will run a script to process these grouped fits.  Returns a Deferred that fires when the
+        script is done (right away if the group is not finished).
+        """
+        group = groups.get(name)
+        if group is None or not group.claim():
             # do nothing to group
-            print("CURRENTLY DONE:", done)
-        pass
+            if group is not None:
+                print("CURRENTLY DONE: %d of %d" % (len(group.members) - group.remaining, len(group.members)))
+            return defer.succeed(None)
+
+        ## run code on group
+        if group.best is not None:
+            log.info("Group %s done, %d fits, best %s (fit %s, Av %s)" % ((name, len(group.results)) + group.best))
+        print("WORKING DIRECTORY:", group.workingD)
+        print("BASE NAME:", group.baseName)
+        commands = group.fitted() or list(group.members.keys())
+
+        d = runPostStage(job, "group", ("group", [group.reducer, group.workingD, commands]),
+                         lambda: GroupProcess(group.reducer, group.workingD, group.baseName, commands))
+        d.addCallback(lambda result: journal.reduced(name))
+        d.addCallback(lambda result: groups.pop(name, None))
+        return d
 
         
-    def sleep(self, stime):
+    @defer.inlineCallbacks
+    def sleep(self, job, stime):
         """
         Testing command by running a script that sleeps a process.
         """
-        t = threading.current_thread()
-        
-        pipe = subprocess.Popen("./sleep.sh %s" % stime, shell=True, preexec_fn=os.setsid)
-        
-        while pipe.poll() is None:
-            if t.cancel:
-                os.killpg(os.getpgid(pipe.pid), signal.SIGTERM) # kills group of processes when present
-                break
-            time.sleep(0.5) # add sleep so this isn't as intensive
-            
-        t.cancel = True # says this thread is ready to be joined and removed from the dictionary
-        doneThreads.put(activeThreads.pop(t.name))
-        
-        watcherEvent.set()
-        watcherEvent.clear()
+        yield job.run(ProcessRunner(["./sleep.sh", stime]))
 
-    def sleep2(self, stime):
+    @defer.inlineCallbacks
+    def sleep2(self, job, stime):
         """
         Testing command for running object oriented MatchExecuter.
         """
         sleepObj = Sleep(stime)
-        sleepObj.run()
+        yield job.run(sleepObj)
 
         print("Done sleeping")
-        time.sleep(0.5)
         sleepObj.afterSleep()
-        sleepObj.run()
-
-        cleanupThread(doneThreads)
+        yield job.run(sleepObj)
         
     def clearAll(self):
         """
-        This method, when called, will clear all the commands to be run in the queue as well as the threads.
+        This method, when called, will clear all the commands to be run in the queue as well as the running jobs.
         """
-    
-        if workQueue.qsize() > 0:
-            # empty queue
-            size = workQueue.qsize()
-            for i in range(size):
-                workQueue.get()
-                
-        for key in activeThreads:
-            # cancel all the threads
-            t = activeThreads[key]
-            t.cancel = True
+        ids = workQueue.clear()
+        for jobId in ids:
+            journal.finished(jobId, "canceled")
+        log.info("Removed %d queued commands" % len(ids))
+
+        for jobId, job in workQueue.runningJobs():
+            # cancel all the jobs, including those being post-processed
+            job.cancel()
     
         return
+
+    def cancelId(self, jobId):
+        """
+        Cancels the queued or running job with the passed in job ID.
+        """
+        state = workQueue.cancel(jobId)
+        if state == "queued":
+            journal.finished(jobId, "canceled") # running jobs are journaled when they stop
+        if state is not None:
+            log.info("Canceled job %d" % jobId)
+        else:
+            log.info("Couldn't find job %d to cancel" % jobId)
         
     def cancel(self, line):
         """
-        Matches the sent line to the internally set thread variable command.  If the same
+        Matches the sent line to the command of a running job or a queued command.  If the same
         it will set this to cancel
         TODO: Add cleanup of files for the command that is being canceled. Calcsfh's have predictable pattern
         for grabing the fit name.
         """
-
-        for key in activeThreads:
-            t = activeThreads[key]
-            if line == t.command:
-                log.info("Canceled command in running thread (%s)" % line)
-                t.cancel = True
-                return
-            
-        if workQueue.qsize() > 0:
-            # empty queue into temporary one and check for the right command to get rid of.
-            # at end put tempQ commands back into the workQueue
-            tempQ = Queue()
-            size = workQueue.qsize()
-            for i in range(size):
-                command = workQueue.get()
-                print(command)
-                if line == command:
-                    log.info("Canceled command in queue (%s)" % line)
-                else:
-                    tempQ.put(command)
-            size = tempQ.qsize()
-            
-            # refill work queue
-            for i in range(size):
-                print(command)
-                workQueue.put(tempQ.get())
+        canceled = workQueue.cancelCommand(line)
+        for jobId, state in canceled:
+            if state == "queued":
+                journal.finished(jobId, "canceled")
+        if len(canceled) > 0:
+            log.info("Canceled command as job(s) %s (%s)" % (", ".join(str(jobId) for jobId, state in canceled), line))
             return
 
         # if a return was not reached then there was no similarly found command
         log.info("Couldn't find command to cancel (%s)" % line)
 
-def runGroup(dictionary):
-    """
-    Passed in is a list of commands belonging to a group of commands.
-    This method will run a script to process these grouped fits.
-    """
-    # check if all the commands in the dictionary are set to true
-    done = dictionary.values()
-    if all(bool is True for bool in done) is True:
-        ## run code on group
-        # isolate working directory
-        print("DONE:", done)
-        keys = dictionary.keys()
-        #print("KEYS:", keys[0])
-        workingD = keys[0].split(" ")
-        workingD = workingD[4].split("/")[:-1]
-        workingD = "/".join(workingD) + "/"
-        print("WORKING DIRECTORY:", workingD)
-
-        # isolate base name
-        baseName = keys[1].split(" ")
-        baseName = baseName[4].split("/")[-1]
-        baseName = baseName.split("_")
-        baseName = "_".join(baseName[:-2])
-        print("BASE NAME:", baseName)
-
-        group = GroupProcess('bestdAv', workingD, baseName, keys)
-        group.run()
-    else:
-        # do nothing to group
-        print("CURRENTLY DONE:", done)
-        pass
-
-def cleanupThread(threadQueue):
-    """
-    Passed in thread must be MatchThread
-    """
-    t = threading.current_thread()
-    t.cancel = True
-
-    threadQueue.put(activeThreads.pop(t.name))
-
-    watcherEvent.set()
-    watcherEvent.clear()
-        
 def stripCalcsfh(line):
     """
     This takes a calcsfh command line and will strip away the directory information and return
@@ -608,198 +1225,167 @@ def stripCalcsfh(line):
 
     return " ".join(line)
 
-def emptyQueue(queue):
-    size = queue.qsize()
-    for i in xrange(size):
-        queue.get()
+def condorRunner(command):
+    """
+    Takes in a command as a string.  Splits it up and parses it to feed it to the right, associated, object.
+    """
+    if "-ssp" in command.split():
+        return SSPCalcsfh(command)
+    return DefaultCalcsfh(command)
 
+def wakeCondor():
+    """
+    Sends queued fits to Condor once the queue has stopped changing for CONDOR_SETTLE seconds, so a burst of submissions goes out as
+    one batch.  Called whenever fits are queued and when Condor jobs end.
+    """
+    global condorCall
+    if condor is None:
+        return
+    if condorCall is not None and condorCall.active():
+        condorCall.reset(CONDOR_SETTLE)
+    else:
+        condorCall = reactor.callLater(CONDOR_SETTLE, submitCondor)
 
-class CondorWatcher(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-
-    def run(self):
-        currentSize = 0
-        while True:
-            print("CONDOR WAITING")
-            if currentSize == 0:
-                condorEvent.wait()
-            print("CONDOR NOT WAITING")
-            currentSize = workQueue.qsize()
-            print("SIZE:", currentSize)
-            while True:
-                time.sleep(1)
-                newSize = workQueue.qsize()
-                if newSize - currentSize != 0:
-                    currentSize = workQueue.qsize()
-                    print("QUEUE SIZE CHANGING")
-                else:
-                    print("QUEUE SIZE CONSTANT")
-                    break
-            # when things are added to queue but all are run by thread this will continue the condor thread to wait.
-            if currentSize == 0:
-                continue
-            # grab commands from queue and make a list of sfh objects
-            commands = self.makeCommandList()
-            print(commands)
-            # write config file
-            self.makeCondorConfig(commands)
-            print("STARTING CONDOR")
-            self.runCondor()
-
-            # wait for job to end
-            while self.condorRunning():
-                time.sleep(300)
-                print("JOBS STILL RUNNING")
-            currentSize = workQueue.qsize()
-            
-    ### Put condor_thread_watcher methods here
-    def filterCommand(self, command):
-        """
-        Takes in a command a command as a string.  Splits it up and parses it 
-        to feed it to the right, associated, object.
-        """
-        command_list = command.split()
-        if command_list[0] == "calcsfh":
-            if "-ssp" in command_list:
-                return SSPCalcsfh(command)
-            
-            return DefaultCalcsfh(command)
-    
-    def makeCommandList(self):
-        commands = []
-        size = workQueue.qsize()
-        stop = 0
-        if size < MAX_CONDOR_SIZE:
-            stop = size
-        else:
-            stop = MAX_CONDOR_SIZE
-        for i in range(stop):
-            commands.append(self.filterCommand(workQueue.get()))
-
-        return commands
-
-    def makeCondorConfig(self, commands):
-        f = open("jobs.cfg", 'w') # create config file in the ServerMatch directory
-        self.to_job_config = MATCH_SERVER_DIR + "/jobs.cfg"
-        # write condor config header information
-        f.write("Notification = never\n")
-        f.write("getenv = true\n")
-        f.write("Executable = %s/scripts/condor_script.sh\n" % MATCH_SERVER_DIR)
-        f.write("Initialdir = %s/scripts/\n" % MATCH_SERVER_DIR)
-        f.write("Universe = vanilla\n\n")
-
-        # write commands as queued jobs
-        for i, job in enumerate(commands):
-            f.write("Log = /dev/null\n")
-            f.write("Output = /dev/null\n")
-            f.write("Error = /dev/null\n")
-            #f.write("Log = /astro/users/tjhillis/M83/test.log\n")
-            #f.write("Output = /astro/users/tjhillis/M83/test.out\n")
-            #f.write("Error = /astro/users/tjhillis/M83/test.err\n")
-            # string of commands
-            analysis = job.condorCommands()
-            analysis = " | ".join(analysis)
-            f.write("Arguments = \"%s\"\n" % analysis)
-            f.write("Queue\n\n")
-
-        f.close()
-
-    def runCondor(self):
-        ssh = subprocess.Popen('ssh -xtt condor', stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        ssh.stdin.write("condor_submit %s\n" % self.to_job_config)
-        ssh.stdin.write("condor_q -sub %s\n" % getpass.getuser())
-        ssh.stdin.write("exit\n")
-        ssh.stdin.close()
-        ssh.wait()
-
-        lines = ssh.stdout.readlines()
-        lines = [line.rstrip() for line in lines]
-        for line in lines:
-            print(line)
-
-    def condorRunning(self):
-        """
-        Checks to see if there is still jobs and returns True if there is.
-        """
-        ssh = subprocess.Popen('ssh -xtt condor', stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        ssh.stdin.write("condor_q -sub %s\n" % getpass.getuser())
-        ssh.stdin.write("exit\n")
-        ssh.stdin.close()
-        ssh.wait()
-
-        lines = ssh.stdout.readlines()
-        lines = [line.rstrip() for line in lines]
-        status = int(lines[-3][0])
-
-        if status == 0:
-            return False
+def submitCondor():
+    """
+    Sends the queued calcsfh commands that would finish sooner on Condor than on the local slots (see CondorBackend.planSpill) as one
+    batch, keeping at most MAX_CONDOR_SIZE jobs in Condor.  Members of groups that are nearly done always stay local.  The jobs are
+    journaled as sent to Condor once the submit succeeds and are queued again if it fails.
+    """
+    global condorSubmitting
+    if condorSubmitting:
+        return
+    now = time.time()
+    queued = []
+    expected = {}
+    for jobId, command, seconds in workQueue.scheduled():
+        if command.split()[0] != "calcsfh":
+            continue
+        group = groups.get(groupOf(command))
+        queued.append((jobId, seconds, group is not None and group.remaining <= max(CORE_COUNT, 1)))
+        expected[jobId] = seconds
+    spill = planSpill(queued, localBusy(now), condor.busy(now), condor.overhead)
+    taken = []
+    for jobId in spill[:max(MAX_CONDOR_SIZE - condor.outstanding(), 0)]:
+        command = workQueue.takeId(jobId)
+        if command is not None: # local slots may have taken it
+            taken.append((jobId, command))
+    if len(taken) == 0:
+        return
+
+    def submit():
+        return condor.submitJobs([(jobId, command, condorRunner(command).condorCommands(), expected[jobId]) for jobId, command in taken])
+
+    def submitted(cluster):
+        for jobId, command in taken:
+            journal.finished(jobId, "condor") # followed through the event log from now on, see condorEnded
+        log.info("Sent %d of %d queued jobs to Condor as cluster %d" % (len(taken), len(queued), cluster))
+
+    def failed(failure):
+        log.error("Could not submit %d jobs to Condor, queuing them again: %s" % (len(taken), failure.getErrorMessage()))
+        for jobId, command in taken:
+            queueCommand(command, jobId)
+
+    def finished(result):
+        global condorSubmitting
+        condorSubmitting = False
+        if workQueue.qsize() > 0 and condor.outstanding() < MAX_CONDOR_SIZE:
+            wakeCondor()
+
+    condorSubmitting = True
+    d = threads.deferToThread(submit)
+    d.addCallbacks(submitted, failed)
+    d.addBoth(finished)
+    return d
+
+def localBusy(now):
+    """
+    Returns the seconds until each local slot is expected to be free.
+    """
+    slots = sorted(max(job.expected - (now - job.started), 0.0) for job in activeJobs.values())[-CORE_COUNT:] if CORE_COUNT > 0 else []
+    return slots + [0.0]*(CORE_COUNT - len(slots))
+
+def pollCondor():
+    """
+    Reads the new events of the Condor event log (called every CONDOR_POLL_INTERVAL seconds).  Queued commands are planned again
+    since the local slots have moved on.
+    """
+    d = threads.deferToThread(condor.poll)
+    d.addCallback(condorEnded)
+    d.addCallback(lambda result: rebalanceCondor())
+    d.addErrback(lambda failure: log.error("Could not read the Condor event log\n%s" % failure.getTraceback()))
+    return d
+
+def condorEnded(ended):
+    """
+    Reports the Condor jobs that ended to their groups and sends more queued fits to Condor now that there is room.  Groups whose
+    DAG ran their group script are done.
+    """
+    for jobId, command, returnValue in ended:
+        if jobId is None: # the group script node of a DAG, command is the group name
+            log.info("Group %s was processed on Condor (%s)" % (command, returnValue))
+            journal.reduced(command)
+            groups.pop(command, None)
+            continue
+        if returnValue == 0:
+            log.info("Condor job %d finished - %s" % (jobId, command))
         else:
-            return True
-
-def threadWatcher():
-    """
-    This method waits for a thread to set an event and will then join that thread.  An example of
-    such an event is sending a command for the thread to be canceled or if the thread encounters an error.
-    """
-    while True:
-        print("WAITING")
-        watcherEvent.wait()
-
-        log.info("Thread finished starting more processes")
-        print("TRIGGERED THREAD WATCHER")
-        # find thread that activated event using "cancel" internal boolean
-        size = doneThreads.qsize()
-
-        print("ACTIVE THREADS:", activeThreads)
-        for i in xrange(size):            
-            t = doneThreads.get()
-            # join thread
-            t.join()
-
-            print("THREAD NAME:", t.name)
-            # Start all the dAv commands that were fed to queue as long as there are
-            # threads open.
-            if "dAv" in t.name: # if the name is None then it is a run that used dAvrange
-                activeCount = len(activeThreads)
-                left = CORE_COUNT - activeCount
-                print("CORES LEFT", left)
-                if left > 0:
-                    workSize = workQueue.qsize()
-                    if workSize > left:
-                        for j in xrange(left):
-                            cp = CommandParser()
-                            cp.parse(workQueue.get())
-                            print("Queue is large: Parsing dAv line")
-                    else:
-                        for j in xrange(workSize):
-                            cp = CommandParser()
-                            cp.parse(workQueue.get())
-                            print("Queue is small: Parsing dAv line")
-                continue
-            
-            # if something is in the work queue set another thread to the task
-            if workQueue.qsize() > 0:
-                print(workQueue)
-                cp = CommandParser()
-                cp.parse(workQueue.get())
+            log.info("Condor job %d %s - %s" % (jobId, "was removed" if returnValue is None else "exited with %d" % returnValue,
+                                                  command))
+        name = groupOf(command)
+        if name in groups:
+            startCommand("group " + name, CommandMethods().groupMember, (name, command), name=None, durable=False)
+    if workQueue.qsize() > 0:
+        wakeCondor()
+
+def rebalanceCondor():
+    """
+    Takes back jobs that are stuck waiting for a Condor slot (Condor has less room for us than expected) when local slots are idle
+    and nothing is queued.  They are queued again under new job IDs.
+    """
+    idle = CORE_COUNT - len(activeJobs)
+    if idle <= 0 or workQueue.qsize() > 0:
+        return
+    stuck = condor.stuck()[:idle]
+    if len(stuck) == 0:
+        return
+
+    def requeue(removed):
+        for jobId, command in removed:
+            log.info("Condor job %d waited too long, taken back as job %d - %s" % (jobId, queueCommand(command), command))
+        dispatchQueue()
+
+    d = threads.deferToThread(condor.removeJobs, [name for name, jobId, command in stuck])
+    d.addCallback(requeue)
+    return d
 
-        print("BACK TO WAITING")
-                
 if __name__ == "__main__":
     # Check if we are running from the executable directory
     if MATCH_SERVER_DIR != os.getcwd() + "/":
         os.chdir(MATCH_SERVER_DIR)
     print(os.getcwd())
 
-    watcher = Thread(target=threadWatcher, name="watcher")
-    watcher.daemon = True
-    watcher.start()
+    journal = JobJournal(JOURNAL_FILE, JOURNAL_FLUSH_INTERVAL)
+    reactor.addSystemEventTrigger("before", "shutdown", journal.flush)
+    reactor.callWhenRunning(replayJournal)
+    history = RunHistory(RUNTIME_HISTORY_FILE, DEFAULT_RUNTIME, DEFAULT_JOB_MEMORY)
+    makeCpuMap()
+    task.LoopingCall(pollMemory).start(MEMORY_POLL_INTERVAL, now=False)
+    if SPECULATE_ON:
+        task.LoopingCall(findStragglers).start(SPECULATE_INTERVAL, now=False)
+    if POST_WORKERS:
+        worker = [sys.executable, MATCH_SERVER_DIR + "/scripts/post_worker.py"]
+        if postCpus is not None:
+            worker = ["taskset", "-c", formatCpus(postCpus)] + worker
+        postWorkers = PostWorkerPool(worker, POST_PROCESS_SLOTS, MATCH_SERVER_DIR + "/scripts/")
+        reactor.callWhenRunning(postWorkers.start)
+    if RESULT_CACHE_ON:
+        resultCache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_SIZE)
 
     if CONDOR_ON:
-        condor_watcher_thread = CondorWatcher()
-        condor_watcher_thread.daemon = True
-        condor_watcher_thread.start()
+        condor = CondorBackend(CONDOR_SUBMIT, CONDOR_SUBMIT_DAG, CONDOR_RM, CONDOR_EVENT_LOG, CONDOR_STATE_FILE, MATCH_SERVER_DIR, CONDOR_SLOTS,
+                               CONDOR_OVERHEAD)
+        task.LoopingCall(pollCondor).start(CONDOR_POLL_INTERVAL)
 
     reactor.listenTCP(PORT_NUMBER, MatchExecuterFactory())
     reactor.run()
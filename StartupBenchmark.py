@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+from __future__ import print_function, division, absolute_import
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Synopsis
+--------
+Guards the startup time of MatchRunner.py, which gets called thousands of times from shell loops when submitting runs.  "calcsfh" (with
+a filled out parameter file) and "list" are each run RUNS times in a new interpreter on the files in "examples".  The commands are built
+like always but not sent to the server.  The median time above starting a bare interpreter is printed for each, along with any of the
+HEAVY modules that got imported on the way.
+
+Exits with 1 if either takes more than the limit or imports a heavy module, so it can be run before committing changes to MatchRunner.py
+or MatchParam.py.
+
+Usage
+-----
+./StartupBenchmark.py [runs] [limit in milliseconds]
+"""
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+HEAVY = ["numpy", "pandas", "matplotlib", "seaborn", "scipy", "astropy"] # none of these are needed to build a command
+RUNS = 10
+LIMIT = 100.0 # milliseconds on top of a bare interpreter
+
+# Runs MatchRunner.main() with send replaced so nothing goes to the server and prints the heavy modules that were imported.
+RUNNER = """
+import sys
+sys.argv = %r
+sys.path.insert(0, %r)
+import MatchRunner
+MatchRunner.send = lambda commandList: None
+MatchRunner.main()
+print("HEAVY " + " ".join(name for name in %r if name in sys.modules))
+"""
+
+def timeRun(argv, cwd):
+    """
+    Returns (seconds, output) of running argv.
+    """
+    start = time.time()
+    process = subprocess.Popen(argv, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0].decode()
+    elapsed = time.time() - start
+    if process.returncode != 0:
+        print(output)
+        raise RuntimeError("%s exited with %d" % (" ".join(argv[:2]), process.returncode))
+    return elapsed, output
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def benchmark(args, workingD, runs):
+    """
+    Returns (median milliseconds, heavy modules imported) of MatchRunner.py run with args in workingD.
+    """
+    # sys.argv[0] in the working directory keeps the logs MatchRunner.py writes out of the real logs directory
+    code = RUNNER % ([workingD + "/MatchRunner.py"] + args, HERE, HEAVY)
+    times = []
+    heavy = ""
+    for i in range(runs):
+        elapsed, output = timeRun([sys.executable, "-c", code], workingD)
+        times.append(elapsed)
+        heavy = [line for line in output.splitlines() if line.startswith("HEAVY")][-1][len("HEAVY "):]
+    return median(times) * 1000.0, heavy.split()
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    limit = float(sys.argv[2]) if len(sys.argv) > 2 else LIMIT
+
+    workingD = tempfile.mkdtemp(prefix="startup_benchmark_")
+    try:
+        os.mkdir(workingD + "/logs")
+        shutil.copy(HERE + "/examples/photometry.phot", workingD + "/bench.phot")
+        shutil.copy(HERE + "/examples/fake.fake", workingD + "/bench.fake")
+        shutil.copy(HERE + "/examples/no_zinc_2filters_woback.param", workingD + "/bench.param")
+        f = open(workingD + "/bench.ls", 'w')
+        for i in range(100):
+            f.write("bench.param bench.phot bench.fake fit_%03d -dAv=0.1\n" % i)
+        f.close()
+
+        bare = median([timeRun([sys.executable, "-c", "pass"], workingD)[0] for i in range(runs)]) * 1000.0
+        print("bare interpreter: %.1f ms" % bare)
+        failed = False
+        for name, args in (("calcsfh", ["calcsfh", "bench.param", "bench.phot", "bench.fake", "fit_bench"]),
+                           ("list", ["list", "bench.ls"])):
+            elapsed, heavy = benchmark(args, workingD, runs)
+            print("%s: %.1f ms above bare interpreter%s" % (name, elapsed - bare, "" if len(heavy) == 0 else ", imported " + " ".join(heavy)))
+            if elapsed - bare > limit or len(heavy) > 0:
+                failed = True
+    finally:
+        shutil.rmtree(workingD)
+
+    if failed:
+        print("Startup is over %.0f ms or imports a heavy module" % limit)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
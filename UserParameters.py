@@ -17,8 +17,47 @@ CONDOR_ON = False # Changes this to False if you don't want to use condor
 #USER_ID = getpass.getuser() # This will keep track of the user id
 PORT_NUMBER = 42424 # Change this if somebody else is using the same port
 HOST_IP_ADDRESS = "10.155.88.139" # Change to IP address that your server is running on.  Currently set to Eagle.
+SUBMIT_WINDOW = 500 # Commands MatchRunner.py and telnetSend.py send ahead of the server's answers.
+SUBMIT_TIMEOUT = 60.0 # Seconds they wait for an answer before giving up.
 MATCH_SERVER_DIR = "/astro/users/tjhillis/M83/MatchExecuter" # This sets the path to the MatchServer directory. Missing forward slash on purpose.
 MATCH_EXECUTABLE_BIN = "/astro/apps6/opt/match2.6/bin/" # Change this to the disired match install. Forward slash on purpose.
+JOURNAL_FILE = MATCH_SERVER_DIR + "/logs/journal.db" # Server state is journaled here and replayed when the server restarts.
+JOURNAL_FLUSH_INTERVAL = 1.0 # Seconds between commits of the journal.  At most this much is lost if the server dies.
+RESULT_CACHE_ON = False # True: resubmitted fits with the same inputs and flags are copied from the result cache instead of being run again.
+RESULT_CACHE_DIR = MATCH_SERVER_DIR + "/cache/results"
+RESULT_CACHE_SIZE = 20 * 1024**3 # Bytes.  Least recently used results are evicted past this size.
+RUNTIME_HISTORY_FILE = MATCH_SERVER_DIR + "/logs/history.db" # Runtimes of finished fits, used to run the shortest queued fits first.
+DEFAULT_RUNTIME = 3600.0 # Seconds a fit is expected to take before anything like it has run.
+SCHEDULER_AGING = 1.0 # Each second a fit waits counts as this many seconds off its expected runtime so long fits still get run.
+MEMORY_BUDGET = int(0.8 * os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")) # Bytes the running fits may use together.
+DEFAULT_JOB_MEMORY = 2 * 1024**3 # Bytes a fit is expected to use before anything like it has run.
+MEMORY_POLL_INTERVAL = 5.0 # Seconds between measurements of the memory used by running fits.
+CPU_AFFINITY = None # None lets fits float over all CPUs, "numa" spreads the slots over the NUMA nodes (sockets) and pins each slot to
+                    # its node, or give one CPU list per slot, eg [[0, 1], [2, 3]] (slots past the end of the list wrap around).
+POST_PROCESS_CPUS = None # CPUs zcombine, sspcombine and the post-processing scripts are pinned to, eg [14, 15].  None lets them float.
+POST_PROCESS_SLOTS = 4 # zcombine, sspcombine and the post-processing scripts of this many fits run at once, outside the CORE_COUNT slots.
+POST_WORKERS = False # True runs the Python of hybridMC_script.sh and group_script.sh in POST_PROCESS_SLOTS long lived workers
+                     # (scripts/post_worker.py) that import numpy, matplotlib, ... once instead of a new Python for every fit or group.
+DAV_SEARCH_POINTS = 4 # dAvs fit side by side in each round of a -dAvsearch.
+SWEEP_REDUCER = "sweep" # group script run when a -sweep finishes (see scripts/group_python_script.py), -reducer= overrides it.
+SWEEP_PRUNE_MARGIN = None # fit value by which a -sweep cell has to be worse than the best to prune the cells behind it, -prune=
+                          # overrides it.  None never prunes.
+SPECULATE_ON = False # True runs a duplicate of a group member that is much slower than its siblings when slots are idle.
+SPECULATE_FACTOR = 2.0 # a member is slow once its fit has run this many times the median fit time of its finished siblings.
+SPECULATE_MIN_SIBLINGS = 3 # siblings that have to finish before the median is trusted.
+SPECULATE_INTERVAL = 30.0 # seconds between looks for slow members.
+CONDOR_SUBMIT = ["ssh", "-x", "condor", "condor_submit"] # Submits a batch to Condor, the submit file is added at the end.  Use
+                                                        # ["condor_submit"] on a submit host or scripts/fake_condor_submit.py to test.
+CONDOR_SUBMIT_DAG = ["ssh", "-x", "condor", "condor_submit_dag"] # Submits a group as a DAG, the DAG file is added at the end.
+CONDOR_DAGS = False # True sends dAv and sweep groups too big for the free local slots to Condor whole, as DAGs that run the group
+                    # script last.
+CONDOR_RM = ["ssh", "-x", "condor", "condor_rm"] # Removes jobs from Condor, their cluster.proc are added at the end.
+CONDOR_SLOTS = 100 # Condor slots expected to run our jobs at once, lowered while jobs wait on Condor for long (see CondorBackend.py).
+CONDOR_OVERHEAD = 300.0 # Seconds a job is expected to wait on Condor before it starts, updated from the event log.
+CONDOR_EVENT_LOG = MATCH_SERVER_DIR + "/logs/condor_events.log" # Condor writes job events here, must be shared with the Condor host.
+CONDOR_STATE_FILE = MATCH_SERVER_DIR + "/logs/condor_jobs.json" # Jobs Condor has and how far the event log was read.
+CONDOR_POLL_INTERVAL = 5.0 # Seconds between reads of the event log.
+CONDOR_SETTLE = 1.0 # Seconds the queue has to stop growing before queued fits are sent to Condor.
 ####
 
 #MATCH_SERVER_DIR = "/home/tristan/BenResearch/executer" # This line is for testing purposes
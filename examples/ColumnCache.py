@@ -0,0 +1 @@
+../ColumnCache.py
\ No newline at end of file
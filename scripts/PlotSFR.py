@@ -4,10 +4,6 @@ from __future__ import print_function, division
 import sys
 
 import numpy as np
-import matplotlib as mpl
-mpl.use("Agg")
-import matplotlib.pyplot as plt
-import seaborn
 
 __author__ = "Tristan J. Hillis"
 
@@ -17,6 +13,8 @@ from MATCH; either from "zcombine" or "zcmerge".  The user can specify command l
 to, potentially, multiple star formation history (SFH) files that will all be plotted on the same axes.  Otherwise, if
 no command line arguements are specified, the user can manually point to the files of choice by editing this
 program.
+
+matplotlib and seaborn are imported by the plot functions, the SFH class (used by ProcessDAv.py) only needs numpy.
 """
 
 def main():
@@ -239,10 +237,21 @@ def main():
 
 
 
+def pyplot():
+    """
+    Imports and returns matplotlib.pyplot (with the seaborn style) the first time something is plotted.
+    """
+    import matplotlib as mpl
+    mpl.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn
+    return plt
+
 def plotAllSFR(SFH_list, startLineWidth=3.0, endLineWidth=0.0, legendLoc=1):
     """
     Takes a list of SFH objects and plots all the SFR on one axis.
     """
+    plt = pyplot()
     lineWidthStep = (startLineWidth - endLineWidth) / len(SFH_list)
     lineWidth = startLineWidth
     legend = False
@@ -277,6 +286,7 @@ def plotAllSF(SFH_list, startLineWidth=3.0, endLineWidth=0.5):
     """
     Takes a list of SFH objects and plot all the SF on one axis
     """
+    plt = pyplot()
     lineWidthStep = (startLineWidth - endLineWidth) / len(SFH_list)
     lineWidth = startLineWidth
     legend = False
@@ -306,6 +316,7 @@ def plotAllCSF(SFH_list, startLineWidth=3.0, endLineWidth=0.5):
     """
     Takes passed in list of SFH objects and plots them for cumulative SF.
     """
+    plt = pyplot()
     lineWidthStep = (startLineWidth - endLineWidth) / len(SFH_list)
     lineWidth = startLineWidth
     legend = False
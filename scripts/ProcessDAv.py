@@ -2,22 +2,17 @@
 from __future__ import print_function, division, absolute_import
 
 import glob
+import os
 import subprocess
 import sys
 
 import numpy as np
 import pandas as pd
-import matplotlib as mpl
-mpl.use("Agg") # IMPORTANT for server to be able plot
-import matplotlib.pyplot as plt
-plt.ioff() # turn interactive maptlotlib off
-from scipy.interpolate import interp1d
-from astropy.io import fits
-import seaborn
 
 #########################
 #### Internal imports####
 #########################
+from ColumnCache import loadColumns
 from PlotSFR import SFH
 from MatchParam import MatchParam
 from UserParameters import *
@@ -46,27 +41,42 @@ class ProcessDAv(object):
 
         path = path.strip("")
         print("PATH:", path)
-        files = glob.glob(path+baseName+"_dAv_?-??")
+        summary = path + baseName + "_group.ls"
+        if os.path.isfile(summary):
+            # the server wrote down the best fit of every fit as it finished (see JobGroup.py) so no output has to be read again
+            rows = [line.split() for line in open(summary, 'r') if line.strip() != ""]
+            rows = [row for row in rows if row[3] != "nan"]
+            files = np.asarray([path + row[0] for row in rows])
+            dAvs = np.asarray([float(row[3]) for row in rows])
+            bestFits = np.asarray([float(row[1]) for row in rows])
+            bestAvs = np.asarray([float(row[2]) for row in rows])
+
+            # sort by increasing dAv
+            idxs = np.argsort(dAvs)
+            files, dAvs, bestFits, bestAvs = files[idxs], dAvs[idxs], bestFits[idxs], bestAvs[idxs]
+            print("FILES:", files)
+        else:
+            files = glob.glob(path+baseName+"_dAv_?-??")
 
-        files = np.asarray([file for file in files if "." not in file]) # get rid of extraneous files ending with a suffix
-        #print(files)
+            files = np.asarray([file for file in files if "." not in file]) # get rid of extraneous files ending with a suffix
+            #print(files)
 
-        print("FILES:", files)
-        
-        # order files in increasing dAv
-        dAvs = np.asarray([float(file.split("/")[-1].split("_")[-1].replace("-", ".")) for file in files])
-        #print(dAvs)
+            print("FILES:", files)
 
-        # sort by increasing dAv
-        idxs = np.argsort(dAvs)
-        files = files[idxs]
-        dAvs = dAvs[idxs]
-        #print(files, dAvs)
+            # order files in increasing dAv
+            dAvs = np.asarray([float(file.split("/")[-1].split("_")[-1].replace("-", ".")) for file in files])
+            #print(dAvs)
 
-        # get best fits values
-        vec_getBestFit = np.vectorize(self.getBestFit) # vectorize function
-        bestFits, bestAvs = vec_getBestFit(files)
-        #print(bestFits)
+            # sort by increasing dAv
+            idxs = np.argsort(dAvs)
+            files = files[idxs]
+            dAvs = dAvs[idxs]
+            #print(files, dAvs)
+
+            # get best fits values
+            vec_getBestFit = np.vectorize(self.getBestFit) # vectorize function
+            bestFits, bestAvs = vec_getBestFit(files)
+            #print(bestFits)
 
         # make the fit with the best fit value the fit with the main string name.
         best_idx = np.argmin(bestFits)
@@ -97,6 +107,14 @@ class ProcessDAv(object):
             name = new_names[j]
             subprocess.call(['cp', file, name])
 
+        # the plotting modules are only imported once there is something to plot
+        import matplotlib as mpl
+        mpl.use("Agg") # IMPORTANT for server to be able plot
+        import matplotlib.pyplot as plt
+        plt.ioff() # turn interactive maptlotlib off
+        from scipy.interpolate import interp1d
+        import seaborn
+
         plt.rc('font', family='sans-serif')
         params = {'mathtext.default': 'regular' }
         plt.rcParams.update(params)
@@ -248,10 +266,10 @@ class ProcessDAv(object):
         if param.parameters['background'] is not None:
             noback = False
             background_path = path + param.parameters['background']
-            background_data = np.loadtxt(background_path, unpack=True)
+            background_data = loadColumns(background_path)
 
         # get photometry data
-        photemetry_data = np.loadtxt(path+photFile, unpack=True)
+        photemetry_data = loadColumns(path+photFile)
 
         # get the number of columns: 2 - one CMD | 3 - 2 CMDs
         numCols = len(photemetry_data)
@@ -409,6 +427,7 @@ class ProcessDAv(object):
         ages = [float(log_years[age1_idx]), float(log_years[age2_idx])]
         masses = [isochrones[log_year_string[age1_idx]]['M_ini'].values[-1], isochrones[log_year_string[age2_idx]]['M_ini'].values[-1]]
 
+        from scipy.interpolate import interp1d
         f = interp1d(ages, masses)
         mass_interp = f(age_to_interp)
 
@@ -0,0 +1 @@
+../ProcessStage.py
\ No newline at end of file
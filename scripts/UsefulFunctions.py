@@ -2,8 +2,6 @@
 from __future__ import print_function, division, absolute_import
 
 import numpy as np
-import pandas as pd
-from astropy.wcs import WCS
 import pointCross
 import sys
 
@@ -58,6 +56,7 @@ def matchDensities(threshold, fakes, densities):
             #print(i+1, curr_id, None)
 
     #print("Number of snrs matched to a relative density:", run_count)
+    import pandas as pd
     data = pd.DataFrame({"id":densities['id'].values, "match":matched})
     #print(data)
     #print(unique, len(unique))
@@ -110,6 +109,9 @@ def getShiftedSNRFK5(snr):
     """
     Pass in an snr id and then return the shifted RA and DEC coordinates using x_off and y_off in the master list.
     """
+    import pandas as pd
+    from astropy.wcs import WCS # astropy is slow to import and only needed here
+
     # Read in master list
     master = pd.read_csv("/home/tristan/BenResearch/M83/code/textFiles/master_list.txt")
 
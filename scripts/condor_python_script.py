@@ -5,11 +5,24 @@ import subprocess
 import telnetlib
 import sys
 
+from UserParameters import HOST_IP_ADDRESS, PORT_NUMBER
+
 #stdout = sys.stdout
 #sys.stdout = StringIO.StringIO()
 commands = " ".join(sys.argv[1:])
 commands = commands.split("|")
 commands = [command.split() for command in commands]
+# stderr redirections are written last (see Stage.__str__ in ProcessStage.py), take them off before looking for the stdout file
+errors = []
+for i, command in enumerate(commands):
+    if len(command) > 0 and command[-1] == "2>&1":
+        errors.append(subprocess.STDOUT)
+        commands[i] = command[:-1]
+    elif len(command) > 1 and command[-2] == "2>":
+        errors.append(command[-1])
+        commands[i] = command[:-2]
+    else:
+        errors.append(None)
 print(commands[0])
 print()
 print(commands[1])
@@ -30,21 +43,21 @@ commands = [" ".join(command) for command in commands]
 print()
 print(commands)
 for i, redirect in enumerate(redirects):
+    stderr = open(errors[i], 'w') if errors[i] not in (None, subprocess.STDOUT) else errors[i]
     if redirect is not None:
         command = " ".join(commands[i].split()[:-2])
         f = open(redirect, 'w')
-        subprocess.call(command, stdout=f, shell=True)
+        subprocess.call(command, stdout=f, stderr=stderr, shell=True)
         f.close()
     else:
 
         firstArg = commands[i].split()[0]
         print("FIRST ARGUEMENT:", firstArg)
         if firstArg == "group":
-            HOST = "10.155.88.139" # eagle
-            PORT = 42424
-
-            tn = telnetlib.Telnet(HOST, PORT)
+            tn = telnetlib.Telnet(HOST_IP_ADDRESS, PORT_NUMBER)
             tn.write(commands[i] + "\r\n") # twisted server appears to need the \r\n at the end; write to port
             tn.close()
         else:
-            subprocess.call(commands[i], shell=True)
+            subprocess.call(commands[i], stderr=stderr, shell=True)
+    if stderr not in (None, subprocess.STDOUT):
+        stderr.close()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+from __future__ import print_function, division, absolute_import
+
+import fcntl
+import os
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+"""
+Stands in for condor_submit so the Condor backend of the server (see CondorBackend.py) can be tried on one machine.  Set
+
+    CONDOR_SUBMIT = [MATCH_SERVER_DIR + "/scripts/fake_condor_submit.py"]
+    CONDOR_RM = [MATCH_SERVER_DIR + "/scripts/fake_condor_submit.py", "-rm", CONDOR_EVENT_LOG]
+
+in UserParameters.py.  The jobs of the submit file are run here, FAKE_CONDOR_SLOTS (environment, default 4) at a time, in the
+background, and their submit, execute and terminate events are written to the Log of the submit file the way Condor writes them.
+With -rm the jobs (cluster.proc) that haven't started yet get an abort event and are never run.  Only the submit commands the server
+writes are understood.
+"""
+
+
+def readSubmitFile(path):
+    """
+    Returns (settings, list of argument strings) of a submit file.  Every Queue line queues one job with the current Arguments.
+    """
+    settings = {}
+    jobs = []
+    for line in open(path):
+        line = line.strip()
+        if line.lower() == "queue":
+            jobs.append(settings.get("arguments", ""))
+        elif "=" in line:
+            key, value = line.split("=", 1)
+            settings[key.strip().lower()] = value.strip()
+    return settings, jobs
+
+def writeEvent(log, code, job, text):
+    """
+    Appends one event to the event log.  Events are written whole under a lock so runs side by side don't mix.
+    """
+    f = open(log, 'a')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    f.write("%s (%03d.%03d.000) %s %s\n...\n" % (code, job[0], job[1], time.strftime("%m/%d %H:%M:%S"), text))
+    f.close()
+
+def nextCluster(log):
+    clusters = [0]
+    if os.path.exists(log):
+        clusters += [int(cluster) for cluster in re.findall(r"^\d{3} \((\d+)\.", open(log).read(), re.M)]
+    return max(clusters) + 1
+
+def removed(log, job):
+    return ("009 (%03d.%03d.000)" % job) in open(log).read()
+
+def run(settings, job, arguments, slots):
+    with slots:
+        if removed(settings["log"], job):
+            return
+        writeEvent(settings["log"], "001", job, "Job executing on host: <127.0.0.1:9618>")
+        argv = [settings["executable"]] + shlex.split(arguments.strip('"'))
+        devnull = open(os.devnull, 'w')
+        returnValue = subprocess.call(argv, cwd=settings.get("initialdir"), stdout=devnull, stderr=devnull)
+        devnull.close()
+        if returnValue < 0:
+            text = "Job terminated.\n\t(0) Abnormal termination (signal %d)" % -returnValue
+        else:
+            text = "Job terminated.\n\t(1) Normal termination (return value %d)" % returnValue
+        writeEvent(settings["log"], "005", job, text)
+
+def remove(log, jobs):
+    for job in jobs:
+        cluster, proc = [int(part) for part in job.split(".")[:2]]
+        writeEvent(log, "009", (cluster, proc), "Job was aborted by the user.")
+        print("Job %s marked for removal" % job)
+
+def main():
+    if sys.argv[1] == "-rm":
+        remove(sys.argv[2], sys.argv[3:])
+        return
+    settings, jobs = readSubmitFile(sys.argv[1])
+    log = settings["log"]
+    lock = open(log + ".lock", 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX) # cluster numbers are handed out one submit at a time
+    cluster = nextCluster(log)
+    for proc in range(len(jobs)):
+        writeEvent(log, "000", (cluster, proc), "Job submitted from host: <127.0.0.1:9618>")
+    lock.close()
+    print("Submitting job(s)%s" % ("." * len(jobs)))
+    print("%d job(s) submitted to cluster %d." % (len(jobs), cluster))
+    sys.stdout.flush()
+
+    if os.fork() != 0: # condor_submit returns once the jobs are queued
+        return
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    slots = threading.Semaphore(int(os.environ.get("FAKE_CONDOR_SLOTS", 4)))
+    threads = [threading.Thread(target=run, args=(settings, (cluster, proc), arguments, slots)) for proc, arguments in enumerate(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+if __name__ == "__main__":
+    main()
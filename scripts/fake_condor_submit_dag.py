@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+from __future__ import print_function, division, absolute_import
+
+import fcntl
+import os
+import sys
+import threading
+
+from fake_condor_submit import nextCluster, readSubmitFile, run, writeEvent
+
+"""
+Stands in for condor_submit_dag the way scripts/fake_condor_submit.py stands in for condor_submit.  Set
+
+    CONDOR_SUBMIT_DAG = [MATCH_SERVER_DIR + "/scripts/fake_condor_submit_dag.py"]
+
+in UserParameters.py.  Every node of the DAG is run once all of its parents are done (whether they failed or not, like the server's DAGs
+ask for with their POST scripts), FAKE_CONDOR_SLOTS at a time.  Each node gets a cluster of its own whose submit event names the node
+the way DAGMan's do.  Only JOB and PARENT ... CHILD lines are understood.
+"""
+
+
+def readDag(path):
+    """
+    Returns (list of (node, submit file), dict of node -> set of parents) of a DAG file.
+    """
+    nodes = []
+    parents = {}
+    for line in open(path):
+        words = line.split()
+        if len(words) == 0:
+            continue
+        if words[0] == "JOB":
+            nodes.append((words[1], words[2]))
+            parents.setdefault(words[1], set())
+        elif words[0] == "PARENT":
+            split = words.index("CHILD")
+            for child in words[split + 1:]:
+                parents.setdefault(child, set()).update(words[1:split])
+    return nodes, parents
+
+def runNode(node, submitFile, parents, done, slots):
+    for parent in parents:
+        done[parent].wait()
+    settings, jobs = readSubmitFile(submitFile)
+    lock = open(settings["log"] + ".lock", 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    job = (nextCluster(settings["log"]), 0)
+    writeEvent(settings["log"], "000", job, "Job submitted from host: <127.0.0.1:9618>\n    DAG Node: %s" % node)
+    lock.close()
+    run(settings, job, jobs[0], slots)
+    done[node].set()
+
+def main():
+    nodes, parents = readDag(sys.argv[1])
+    print("Submitting job(s).")
+    print("1 job(s) submitted to cluster %d." % os.getpid()) # the DAGMan job itself, which never shows up in the event log
+    sys.stdout.flush()
+
+    if os.fork() != 0:
+        return
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    slots = threading.Semaphore(int(os.environ.get("FAKE_CONDOR_SLOTS", 4)))
+    done = dict((node, threading.Event()) for node, submitFile in nodes)
+    threads = [threading.Thread(target=runNode, args=(node, submitFile, parents[node], done, slots)) for node, submitFile in nodes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,10 @@
 
 from __future__ import print_function, division, absolute_import
 
+import os
 import sys
 
 #### Internal imports
-from ProcessDAv import ProcessDAv
 from Calcsfh import DefaultCalcsfh
 
 # Invoke python scripts here after to process commands
@@ -24,6 +24,7 @@ def runProcessDav(path, commands):
     -------
     out : None
     """
+    from ProcessDAv import ProcessDAv # pulls in the plotting modules, which sweeps don't need
     print("Group run:", commands)
     # extract the baseName, global photometry and parameter file used the best dAv fits
     davFit = DefaultCalcsfh(commands[0])
@@ -35,14 +36,56 @@ def runProcessDav(path, commands):
     return None
 
 
-def main():
-    grouping = str(sys.argv[1])
-    path = sys.argv[2]
-    commands = sys.argv[3:]
+def runSweep(path, commands):
+    """Summarizes the fits of a -sweep.  Every fit is listed with its best fit value, best first, in baseName_sweep.ls.
+
+    Parameters
+    ----------
+    path : string
+           Points to directory containing the fits of the sweep.
+    commands : list of strings
+           Contains a list of the passed in commands from group_script.py.
+
+    Returns
+    -------
+    out : None
+    """
+    print("Sweep run:", commands)
+    fits = []
+    for command in commands:
+        fit = DefaultCalcsfh(command)
+        value = fit.bestFit()
+        if value is not None:
+            fits.append((value, fit.fit, fit.parameter))
+    if len(fits) == 0:
+        return None
+    fits.sort()
+    # every fit is the fit name the sweep was given plus the suffix of its cell
+    names = [fit for value, fit, parameter in fits]
+    baseName = os.path.commonprefix(names)
+    if any(not name[len(baseName):].startswith("_") for name in names): # cut inside a suffix
+        baseName = baseName.rsplit("_", 1)[0]
+    f = open(path + baseName + "_sweep.ls", 'w')
+    for value, fit, parameter in fits:
+        f.write("%s %f %s\n" % (fit, value, parameter))
+    f.close()
+
+    return None
+
+
+def runGroup(grouping, path, commands):
+    """Runs the processing of a grouping (eg bestdAv) on its commands.  Also called by scripts/post_worker.py.
+    """
     print("Commands:", commands)
 
     if grouping == 'bestdAv':
         runProcessDav(path, commands)
+    elif grouping == 'sweep':
+        runSweep(path, commands)
+
+
+def main():
+    runGroup(str(sys.argv[1]), sys.argv[2], sys.argv[3:])
 
 if __name__ == "__main__":
     main()
@@ -21,5 +21,7 @@ echo "command 2: ${commands[1]}"
 
 #echo "Passed in quantities ${1}, ${2}, ${3}, and ${4}"
 #"$SCRIPTPATH/ProcessDAv.py" $1 $2 $3 $4
-"$SCRIPTPATH/group_python_script.py" $grouping $directory "${commands}" # pass in commands as string or it separates it out in the
-                                                                        # python script
+# a post-processing worker sets MATCH_IN_WORKER and runs group_python_script.py itself, see post_worker.py
+if [ -z "$MATCH_IN_WORKER" ]; then
+    "$SCRIPTPATH/group_python_script.py" $grouping $directory "${commands[@]}" # every command stays a single argument
+fi
@@ -2,14 +2,7 @@
 from __future__ import print_function, division, absolute_import
 
 import numpy as np
-import pandas as pd
-import matplotlib as mpl
-mpl.use("Agg") # IMPORTANT for server to be able plot
-import matplotlib.pyplot as plt
-plt.ioff() # turn interactive maptlotlib off
-import seaborn
 import sys
-from scipy.interpolate import interp1d
 
 from UsefulFunctions import SFH # Calculates the CSF for plotting
 from UserParameters import *
@@ -29,6 +22,15 @@ def plotCSFComplete(completeFile):
     the 50th percentile of the errors.  With 3 ages for "original", "plus", and "minus" the closest age is found which then gives us the
     initial mass.  A plot is then saved with the CSF and the SFH for the area of interest.
     """
+    # the plotting modules are only imported when a plot is made
+    import pandas as pd
+    import matplotlib as mpl
+    mpl.use("Agg") # IMPORTANT for server to be able plot
+    import matplotlib.pyplot as plt
+    plt.ioff() # turn interactive maptlotlib off
+    import seaborn
+    from scipy.interpolate import interp1d
+
     # Get the id from the path above.
     snr_id = completeFile.split("/")[-2]
     # Get the fit name for when saving.
@@ -169,6 +171,7 @@ def interpMass(age_to_interp, age1_idx, age2_idx, isochrones, log_year_string):
     ages = [float(log_years[age1_idx]), float(log_years[age2_idx])]
     masses = [isochrones[log_year_string[age1_idx]]['M_ini'].values[-1], isochrones[log_year_string[age2_idx]]['M_ini'].values[-1]]
     
+    from scipy.interpolate import interp1d
     f = interp1d(ages, masses)
     mass_interp = f(age_to_interp)
 
@@ -40,5 +40,7 @@ zcombine -unweighted -medbest -jeffreys $mcmcFile > $mcmcZCFile
 # Run zcmerge to complete the analysis main fit should come first
 zcmerge $6 $mcmcZCFile -absolute > $completeFile
 
-# Pass completeFile in to plot the data
-"$SCRIPTPATH/hybridMC_python_script.py" $completeFile
+# Pass completeFile in to plot the data (a post-processing worker sets MATCH_IN_WORKER and plots it itself, see post_worker.py)
+if [ -z "$MATCH_IN_WORKER" ]; then
+    "$SCRIPTPATH/hybridMC_python_script.py" $completeFile
+fi
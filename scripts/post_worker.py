@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+from __future__ import print_function, division, absolute_import
+
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+import traceback
+
+"""
+A long lived post-processing worker (see PostWorkers.py).  numpy, pandas, scipy, matplotlib, seaborn (and astropy if it is installed)
+are imported once when the worker starts instead of once per fit or group by the Python scripts the post-processing scripts start.
+
+Requests come in on stdin, one JSON object per line: {"task": name, "args": [...]}.  Each is answered on stdout with
+{"ok": true, "wall": seconds, "utime": seconds, "stime": seconds, "maxrss": kilobytes} or {"ok": false, "error": traceback,
+"unavailable": true if the task couldn't be imported}.  The CPU times are those of the task and the scripts it ran, "maxrss" is the
+peak memory of the worker or of the largest script it has run so far.  Anything the tasks print goes to stderr so it can't get mixed
+up with the answers.
+
+SIGTERM (how the server cancels a task) kills the script being run along with the worker.
+
+The tasks are "hybridMC" and "group".  Each runs its script (hybridMC_script.sh, group_script.sh) with MATCH_IN_WORKER set, which makes
+the script skip the new Python it would start at the end, and then calls that Python (hybridMC_python_script.plotCSFComplete,
+group_python_script.runGroup) in this process.  Everything else in the scripts, including changes made to them, still runs.  A script
+whose Python step no longer checks MATCH_IN_WORKER is run as it is.  calcsfh_script.sh and ssp_script.sh don't start Python so they are
+always run by the server itself.
+"""
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+IN_WORKER = 'if [ -z "$MATCH_IN_WORKER" ]' # how the scripts skip their Python step, see leavesPython
+
+TASKS = {}
+MISSING = {} # task -> why it couldn't be imported
+running = None # Popen of the script being run
+
+
+def task(name):
+    def register(function):
+        TASKS[name] = function
+        return function
+    return register
+
+@task("hybridMC")
+def hybridMC(parameter, phot, fake, fit, console, zcombine, cmd, mcdata):
+    """
+    Runs hybridMC_script.sh and plots its ".complete" file in this process.
+    """
+    inWorker = leavesPython("hybridMC_script.sh")
+    runScript("hybridMC_script.sh", [parameter, phot, fake, fit, console, zcombine, cmd, mcdata], inWorker)
+    if inWorker:
+        import hybridMC_python_script
+        hybridMC_python_script.plotCSFComplete(fit + ".complete")
+
+@task("group")
+def group(grouping, path, commands):
+    """
+    Runs group_script.sh and then group_python_script.py in this process.
+    """
+    inWorker = leavesPython("group_script.sh")
+    runScript("group_script.sh", [grouping, path] + list(commands), inWorker)
+    if inWorker:
+        import group_python_script
+        group_python_script.runGroup(grouping, path, commands)
+
+
+def leavesPython(script):
+    """
+    True if "script" still skips its Python step when MATCH_IN_WORKER is set.  If it was changed to run its Python some other way it
+    is just run as it is.
+    """
+    with open(os.path.join(HERE, script)) as f:
+        return IN_WORKER in f.read()
+
+def runScript(script, args, inWorker=False):
+    """
+    Runs one of the scripts in this directory with "args" and waits for it, with MATCH_IN_WORKER set if "inWorker".  Like the server,
+    its exit status isn't checked.
+    """
+    global running
+    env = dict(os.environ, MATCH_IN_WORKER="1") if inWorker else None
+    running = subprocess.Popen([os.path.join(HERE, script)] + args, env=env, preexec_fn=os.setsid) # own process group so it can be killed
+    try:
+        running.wait()
+    finally:
+        running = None
+
+def terminate(signum, frame):
+    """
+    Kills the script being run (and everything it started) and exits.
+    """
+    if running is not None:
+        try:
+            os.killpg(running.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    os._exit(1)
+
+def usage():
+    """
+    Returns (CPU seconds, peak memory in kilobytes) of the worker and the scripts it has waited on.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + children.ru_utime, own.ru_stime + children.ru_stime), max(own.ru_maxrss, children.ru_maxrss)
+
+def preload():
+    """
+    Imports what the tasks need up front.  A task whose modules are missing is answered as unavailable so the server runs its script.
+    """
+    try:
+        import astropy
+    except ImportError:
+        pass
+    try:
+        import matplotlib
+        matplotlib.use("Agg") # before anything imports pyplot
+    except ImportError:
+        pass
+    # the scripts only import the plotting modules once they plot, so these are named here too
+    plotting = ("pandas", "matplotlib.pyplot", "seaborn", "scipy.interpolate")
+    for name, modules in (("hybridMC", ("hybridMC_python_script",) + plotting),
+                          ("group", ("group_python_script", "ProcessDAv") + plotting)):
+        try:
+            for module in modules:
+                __import__(module)
+        except Exception:
+            MISSING[name] = traceback.format_exc()
+
+def main():
+    answers = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1) # prints of the tasks go to stderr
+    sys.path.insert(0, HERE)
+    signal.signal(signal.SIGTERM, terminate)
+    preload()
+    for line in iter(sys.stdin.readline, ""):
+        request = json.loads(line)
+        name = request["task"]
+        if name not in TASKS or name in MISSING:
+            answer = {"ok": False, "unavailable": True, "error": MISSING.get(name, "no task %s" % name)}
+        else:
+            try:
+                started = time.time()
+                (utime, stime), maxrss = usage()
+                TASKS[name](*request["args"])
+                (utimeEnd, stimeEnd), maxrss = usage()
+                answer = {"ok": True, "wall": time.time() - started, "utime": utimeEnd - utime, "stime": stimeEnd - stime,
+                          "maxrss": maxrss}
+            except Exception:
+                answer = {"ok": False, "error": traceback.format_exc()}
+            finally:
+                sys.stdout.flush()
+                if "matplotlib.pyplot" in sys.modules:
+                    sys.modules["matplotlib.pyplot"].close("all")
+        answers.write(json.dumps(answer) + "\n")
+        answers.flush()
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,22 @@
 #!/usr/bin/env python
 from __future__ import print_function, division
 
+import json
 import sys
 import telnetlib
 import threading
 import time
 
+import BatchSubmit
 from UserParameters import *
 HOST = HOST_IP_ADDRESS
 #HOST = "10.155.88.135" # astrolab18
 PORT = PORT_NUMBER
 
 def main():
+    if not sys.stdin.isatty(): # commands piped in, eg ./telnetSend.py < commands.ls, are sent as one batch
+        sendBatch()
+        return
     tn = telnetlib.Telnet(HOST, PORT)
 
     # start take commands method
@@ -27,6 +32,21 @@ def main():
         time.sleep(1)
 
 
+def sendBatch():
+    """
+    Sends every line of stdin and prints the answer of the server to each.
+    """
+    commands = [line.strip() for line in sys.stdin if line.strip() != ""]
+
+    def answered(command, answer):
+        print(json.dumps(answer), command)
+
+    try:
+        BatchSubmit.submit(commands, HOST, PORT, window=SUBMIT_WINDOW, timeout=SUBMIT_TIMEOUT, answered=answered)
+    except BatchSubmit.SubmitError as e:
+        print("Sending failed:", e)
+        sys.exit(1)
+
 def printAll(tn):
     print(tn.read_all())
 